@@ -3,7 +3,8 @@ import shutil
 from pathlib import Path
 from traceback import format_exception
 from os.path import abspath, join, basename, splitext
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
 from datetime import datetime
@@ -580,38 +581,283 @@ def get_inputs_from_file_list(file_list_path, config_dir):
     return filtered_paths
 
 
-def average(img_paths: List[Path]) -> sitk.Image:
+AVERAGE_METHODS = ('mean', 'median', 'trimmed_mean')
+
+
+def average(img_paths: List[Path],
+            method: str = 'mean',
+            trim_fraction: float = 0.1,
+            with_variance: bool = False,
+            memory_budget: float = None,
+            threads: int = None) -> Union[sitk.Image, Tuple[sitk.Image, sitk.Image]]:
     """
-    Make a mean itensity volume given a list of volume paths
+    Make an average intensity volume given a list of volume paths
+
+    The volumes are streamed in z-slabs, as many slices at a time as fit in the memory budget, and summed into a
+    float64 accumulator. Slabs of the next volumes are read in parallel while the current one is added. For the median
+    and trimmed mean the slab of every volume is held at once, so these use more slabs. Formats that cannot be read in
+    part (such as nrrd, see supports_slab_reads) are decoded in full for each slab read, so fewer of them are read at
+    once and, if there is memory for a single slab, each volume is read only once.
+
+    Parameters
+    ----------
+    img_paths
+        The volumes to average. Any that are not the size of the first are left out
+    method
+        'mean', 'median' or 'trimmed_mean' (the mean without the trim_fraction highest and lowest values at each voxel)
+    trim_fraction
+        For method='trimmed_mean'. The fraction to cut from each end
+    with_variance
+        Also return the variance of each voxel over the volumes
+    memory_budget
+        Bytes of memory to use. Defaults to half the available memory
+    threads
+        Number of volumes to read at once
 
     Returns
     -------
-    Mean volume
-
+    The average volume, which has the same pixel type as the first volume (rounded for integer types).
+    If with_variance, (average volume, float32 variance volume)
     """
+    if method not in AVERAGE_METHODS:
+        raise ValueError(f'method should be one of {AVERAGE_METHODS}, not {method}')
+
     img_paths = list(map(str, img_paths))
 
-    # sum all images together
-    first = LoadImage(img_paths[0])
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img_paths[0])
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    direction_cos = reader.GetDirection()  # Get the direction from the first image.
+    dtype = image_header(img_paths[0])[1]
 
-    # Get the direction from the first image.
-    direction_cos = first.direction
+    paths = []
+    for path in img_paths:
+        reader.SetFileName(path)
+        reader.ReadImageInformation()
+        if reader.GetSize() == size:
+            paths.append(path)
+        else:
+            logging.warning(f"Numpy can't average this volume {path}. Size {reader.GetSize()} is not {size}")
+
+    num_imgs = len(paths)
+    threads = threads or min(8, os.cpu_count() or 1)
+    memory_budget = memory_budget or available_memory() / 2
+    full_reads = not all(supports_slab_reads(path) for path in paths)
+
+    slab_depth, ahead = _average_slab_plan(size, dtype, num_imgs, method, with_variance, threads, memory_budget,
+                                           full_reads)
+    logging.info(f'Averaging {num_imgs} volumes in slabs of {slab_depth} of {size[2]} slices')
+
+    avg = np.empty(size[::-1], dtype=dtype)
+    variance = np.empty(size[::-1], dtype=np.float32) if with_variance else None
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for z0 in range(0, size[2], slab_depth):
+            z1 = min(z0 + slab_depth, size[2])
+            slabs = _read_slabs_ahead(pool, paths, z0, z1, ahead)
+
+            if method == 'mean':
+                moments = _RunningMoments(with_variance)
+                for slab in slabs:
+                    moments.add(slab)
+                slab_avg = moments.mean()
+            else:
+                stack = np.stack(list(slabs))
+                moments = _RunningMoments(with_variance)
+                if with_variance:
+                    for slab in stack:
+                        moments.add(slab)
+                if method == 'median':
+                    slab_avg = np.median(stack, axis=0)
+                else:
+                    slab_avg = _trimmed_mean(stack, trim_fraction)
+                del stack
 
-    summed = sitk.GetArrayFromImage(sitk.ReadImage(img_paths[0]))
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                slab_avg = np.clip(np.rint(slab_avg), info.min, info.max)
+            avg[z0:z1] = slab_avg
 
-    for image in img_paths[1:]:  # Ommit the first as that is in 'summed'
-        np_array = sitk.GetArrayFromImage(sitk.ReadImage(image))
-        try:
-            summed += np_array
-        except ValueError as e:
-            print(("Numpy can't average this volume {0}".format(image)))
+            if with_variance:
+                variance[z0:z1] = moments.variance()
 
-    # Now make average
-    summed //= len(img_paths)
-    avg_img = sitk.GetImageFromArray(summed)
+    avg_img = sitk.GetImageFromArray(avg)
     avg_img.SetDirection(direction_cos)
 
-    return avg_img
+    if not with_variance:
+        return avg_img
+
+    var_img = sitk.GetImageFromArray(variance)
+    var_img.SetDirection(direction_cos)
+    return avg_img, var_img
+
+
+def _average_slab_plan(size: Tuple[int, int, int],
+                       dtype: np.dtype,
+                       num_imgs: int,
+                       method: str,
+                       with_variance: bool,
+                       threads: int,
+                       memory_budget: float,
+                       full_reads: bool) -> Tuple[int, int]:
+    """
+    Work out how many slices to average at a time, and how many slab reads to have in flight, to keep within
+    memory_budget. See average
+
+    Parameters
+    ----------
+    full_reads
+        Whether the whole volume has to be decoded for each slab read (see supports_slab_reads)
+
+    Returns
+    -------
+    slab depth, number of reads ahead
+    """
+    slice_voxels = size[0] * size[1]
+    ahead = 2 * threads
+    read_bytes = 0
+
+    if full_reads:
+        # Each read running holds a whole volume, so limit them to half the budget. With enough memory for a single
+        # slab, each volume is only read once
+        volume_bytes = slice_voxels * size[2] * dtype.itemsize
+        ahead = int(max(1, min(ahead, memory_budget / 2 // volume_bytes)))
+        read_bytes = min(threads, ahead) * volume_bytes
+
+    # Bytes per slice of a slab: the float64 accumulators and the slabs being read
+    if method == 'mean':
+        slice_bytes = slice_voxels * (8 * (3 if with_variance else 1) + ahead * dtype.itemsize)
+    else:
+        # Every volume's slab, the copy that is sorted, and the float64 results
+        slice_bytes = slice_voxels * (2 * num_imgs * dtype.itemsize + 8 * 3)
+
+    slab_depth = int(max(1, min(size[2], (memory_budget - read_bytes) // slice_bytes)))
+    return slab_depth, ahead
+
+
+class _RunningMoments:
+    """
+    Accumulate the mean (and optionally the variance, with Welford's method) of arrays in float64 one at a time
+    """
+    def __init__(self, with_variance: bool):
+        self.with_variance = with_variance
+        self.n = 0
+        self.total = None
+        self.m2 = None
+
+    def add(self, x: np.ndarray):
+        self.n += 1
+        if not self.with_variance:
+            if self.total is None:
+                self.total = x.astype(np.float64)
+            else:
+                self.total += x
+            return
+
+        x = x.astype(np.float64)
+        if self.total is None:  # The running mean
+            self.total = x
+            self.m2 = np.zeros_like(x)
+            return
+        delta = x - self.total
+        self.total += delta / self.n
+        x -= self.total
+        x *= delta
+        self.m2 += x
+
+    def mean(self) -> np.ndarray:
+        return self.total if self.with_variance else self.total / self.n
+
+    def variance(self) -> np.ndarray:
+        """
+        The variance of the values at each position (ddof=0)
+        """
+        return self.m2 / self.n
+
+
+def _trimmed_mean(stack: np.ndarray, trim_fraction: float) -> np.ndarray:
+    """
+    The mean over axis 0 leaving out the trim_fraction lowest and highest values. Like scipy.stats.trim_mean
+    """
+    n = stack.shape[0]
+    cut = int(trim_fraction * n)
+    if cut == 0:
+        return stack.mean(axis=0, dtype=np.float64)
+    if 2 * cut >= n:
+        raise ValueError(f'Cannot trim {trim_fraction} from each end of {n} volumes')
+
+    partitioned = np.partition(stack, (cut, n - cut - 1), axis=0)
+    return partitioned[cut: n - cut].mean(axis=0, dtype=np.float64)
+
+
+SLAB_READ_EXTENSIONS = ('.mha', '.mhd', '.nii', '.nii.gz')  # Formats SimpleITK reads part of. Not nrrd or tif
+
+
+def supports_slab_reads(path: Union[str, Path]) -> bool:
+    """
+    Whether only the requested slices of a file are decoded by read_slab. Other formats are read in full each time
+    """
+    return str(path).lower().endswith(SLAB_READ_EXTENSIONS)
+
+
+def image_header(path: Union[str, Path]) -> Tuple[Tuple[int, ...], np.dtype, int]:
+    """
+    Get the size, numpy type of each pixel component, and number of components of an image without reading its pixels
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    dtype = sitk.GetArrayViewFromImage(sitk.Image([1] * reader.GetDimension(), reader.GetPixelID())).dtype
+    return reader.GetSize(), dtype, reader.GetNumberOfComponents()
+
+
+def read_slabs(path: Union[str, Path], slab_depth: int):
+    """
+    Yield (z0, z1, slices z0 to z1) covering a volume. Files that cannot be read in part are read once and split
+    """
+    size = image_header(path)[0]
+
+    if supports_slab_reads(path):
+        for z0 in range(0, size[2], slab_depth):
+            z1 = min(z0 + slab_depth, size[2])
+            yield z0, z1, read_slab(str(path), z0, z1)
+        return
+
+    array = sitk.GetArrayFromImage(sitk.ReadImage(str(path)))
+    for z0 in range(0, size[2], slab_depth):
+        z1 = min(z0 + slab_depth, size[2])
+        yield z0, z1, array[z0: z1]
+
+
+def read_slab(path: str, z0: int, z1: int) -> np.ndarray:
+    """
+    Read slices z0 to z1 of a volume. Only that part of the file is read where the format allows (see
+    supports_slab_reads). Otherwise the whole file is decoded for each call
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+
+    if (z0, z1) != (0, size[2]):
+        reader.SetExtractIndex([0, 0, z0])
+        reader.SetExtractSize([size[0], size[1], z1 - z0])
+
+    return sitk.GetArrayFromImage(reader.Execute())
+
+
+def _read_slabs_ahead(pool: ThreadPoolExecutor, paths: List[str], z0: int, z1: int, ahead: int):
+    """
+    Yield the z0 to z1 slab of each volume in order, reading up to 'ahead' of them in advance
+    """
+    pending = deque()
+    for path in paths:
+        pending.append(pool.submit(read_slab, path, z0, z1))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 #
 # def rebuid_subsamlped_output(array, shape, chunk_size):
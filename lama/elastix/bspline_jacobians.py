@@ -0,0 +1,189 @@
+"""
+Jacobian determinants of an elastix B-spline transform, computed directly from the B-spline coefficients in its
+TransformParameters file rather than with transformix.
+
+The displacement at a point is u(x) = sum over control points k of c_k * B(xi - k), where xi is the position of x in
+grid units (xi = (x - GridOrigin) / GridSpacing) and B is the product of cubic B-spline kernels along each axis. As the
+output image and the control point grid are both regular, the kernel weights along each axis are a matrix and the
+derivatives of u on the whole image are sums of products of these matrices with the coefficients. The jacobian
+determinant is then det(I + du/dx), worked out a z-slab at a time. As in ITK/elastix, points where the B-spline
+support is not inside the grid are not displaced, so have a jacobian determinant of 1.
+
+Only a single cubic B-spline transform (no initial transform) with axis-aligned image and grid directions is supported.
+For others UnsupportedTransform is raised and transformix should be used.
+"""
+
+from pathlib import Path
+from typing import Iterator, Tuple, Union
+
+import numpy as np
+import SimpleITK as sitk
+
+from lama.elastix.transform_parameters import read_transform_parameters
+
+SLAB_BYTES = 256 * 1024 ** 2  # Roughly the memory of the derivative arrays for one slab
+
+
+class UnsupportedTransform(ValueError):
+    pass
+
+
+def jacobian_determinant(tform_file: Union[Path, str], dtype=np.float64) -> sitk.Image:
+    """
+    The jacobian determinant of a B-spline transform on its output image grid, as made by 'transformix -jac all'
+
+    Parameters
+    ----------
+    tform_file
+        elastix TransformParameters file of a B-spline transform
+    dtype
+        np.float64, or np.float32 to save time and memory
+
+    Returns
+    -------
+    float32 image
+    """
+    grid = BSplineGrid(tform_file, dtype)
+
+    jac = np.empty(grid.size[::-1], dtype=np.float32)
+    for z0, z1, slab in grid.jacobian_slabs():
+        jac[z0: z1] = slab
+
+    img = sitk.GetImageFromArray(jac)
+    img.SetOrigin(grid.origin)
+    img.SetSpacing(grid.spacing)
+    img.SetDirection(grid.direction)
+    return img
+
+
+class BSplineGrid:
+    def __init__(self, tform_file: Union[Path, str], dtype=np.float64):
+        """
+        Parameters
+        ----------
+        tform_file
+            elastix TransformParameters file of a B-spline transform
+        dtype
+            The float type to calculate in
+
+        Raises
+        ------
+        UnsupportedTransform
+            If the jacobians cannot be calculated here
+        """
+        tp = read_transform_parameters(tform_file)
+
+        if tp.transform != 'BSplineTransform':
+            raise UnsupportedTransform(f'{tform_file} is a {tp.transform}, not a BSplineTransform')
+        if tp.get('InitialTransformParametersFileName', 'NoInitialTransform') != 'NoInitialTransform':
+            raise UnsupportedTransform(f'{tform_file} has an initial transform')
+        if tp.get('BSplineTransformSplineOrder', 3) != 3:
+            raise UnsupportedTransform(f'{tform_file} is not a cubic B-spline')
+        if tp.get('UseCyclicTransform', 'false') == 'true':
+            raise UnsupportedTransform(f'{tform_file} is a cyclic B-spline')
+
+        self.dtype = dtype
+        self.size = tuple(int(x) for x in tp.get_list('Size'))
+        self.origin = tuple(float(x) for x in tp.get_list('Origin'))
+        self.spacing = tuple(float(x) for x in tp.get_list('Spacing'))
+        self.direction = tuple(float(x) for x in tp.get_list('Direction', list(np.eye(3).ravel())))
+        self.grid_size = tuple(int(x) for x in tp.get_list('GridSize'))
+        grid_origin = np.array(tp.get_list('GridOrigin'), dtype=np.float64)
+        grid_spacing = np.array(tp.get_list('GridSpacing'), dtype=np.float64)
+        grid_direction = np.array(tp.get_list('GridDirection', list(np.eye(3).ravel())), dtype=np.float64).reshape(3, 3)
+
+        if len(self.size) != 3:
+            raise UnsupportedTransform(f'{tform_file} is not 3D')
+
+        # Voxel index to grid units: xi = M @ idx + offset. Each axis of the image must map to the same grid axis
+        direction = np.array(self.direction).reshape(3, 3)
+        to_grid = np.diag(1 / grid_spacing) @ grid_direction.T
+        matrix = to_grid @ direction @ np.diag(self.spacing)
+        if not np.allclose(matrix, np.diag(np.diag(matrix))):
+            raise UnsupportedTransform(f'{tform_file} image and grid directions are not aligned')
+        offset = to_grid @ (np.array(self.origin) - grid_origin)
+
+        # Derivatives with respect to grid position to derivatives with respect to physical position
+        self.to_grid = to_grid.astype(dtype)
+
+        num_points = int(np.prod(self.grid_size))
+        if tp.parameters is None or tp.parameters.size != 3 * num_points:
+            raise UnsupportedTransform(f'{tform_file} does not have 3 coefficients for each point of {self.grid_size}')
+        coefs = tp.coefficients().astype(dtype)
+        # (3, gz, gy, gx): the x, y and z displacement coefficients, with x varying fastest as in the file
+        self.coefs = coefs.T.reshape((3,) + self.grid_size[::-1])
+
+        # Kernel weights and their derivatives for each axis (x, y, z): (image size, grid size)
+        self.weights = []
+        self.derivatives = []
+        for axis in range(3):
+            xi = matrix[axis, axis] * np.arange(self.size[axis]) + offset[axis]
+            w, dw = _kernel_matrices(xi, self.grid_size[axis])
+            self.weights.append(w.astype(dtype))
+            self.derivatives.append(dw.astype(dtype))
+
+    def jacobian_slabs(self, slab_bytes: int = SLAB_BYTES) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """
+        Yields
+        ------
+        z0, z1, the float32 jacobian determinants of slices z0 to z1
+        """
+        wx, wy, wz = self.weights
+        dwx, dwy, dwz = self.derivatives
+
+        # Contract the coefficients along x and y for the whole image: (3, gz, ny * nx) for each derivative
+        ny, nx = self.size[1], self.size[0]
+        cx = self.coefs @ wx.T
+        dcx = self.coefs @ dwx.T
+        by_x = np.einsum('igbx,yb->igyx', dcx, wy, optimize=True).reshape(3, -1, ny * nx)  # d/dx, yet to be summed along z
+        by_y = np.einsum('igbx,yb->igyx', cx, dwy, optimize=True).reshape(3, -1, ny * nx)
+        by_z = np.einsum('igbx,yb->igyx', cx, wy, optimize=True).reshape(3, -1, ny * nx)
+        del cx, dcx
+
+        slice_bytes = 13 * 3 * ny * nx * np.dtype(self.dtype).itemsize
+        slab_depth = int(max(1, min(self.size[2], slab_bytes // slice_bytes)))
+
+        for z0 in range(0, self.size[2], slab_depth):
+            z1 = min(z0 + slab_depth, self.size[2])
+
+            # Derivatives of each displacement component (i) along each grid axis (j) in grid units: du[i][j]
+            du = [[wz[z0: z1] @ by_x[i], wz[z0: z1] @ by_y[i], dwz[z0: z1] @ by_z[i]] for i in range(3)]
+
+            # Spatial jacobian I + du/dx, where du/dx = du/dxi @ dxi/dx
+            jac = [[sum(du[i][j] * self.to_grid[j, k] for j in range(3) if self.to_grid[j, k] != 0) + (i == k)
+                    for k in range(3)] for i in range(3)]
+            del du
+
+            det = (jac[0][0] * (jac[1][1] * jac[2][2] - jac[1][2] * jac[2][1])
+                   - jac[0][1] * (jac[1][0] * jac[2][2] - jac[1][2] * jac[2][0])
+                   + jac[0][2] * (jac[1][0] * jac[2][1] - jac[1][1] * jac[2][0]))
+
+            yield z0, z1, det.reshape(z1 - z0, ny, nx).astype(np.float32)
+
+
+def _kernel_matrices(xi: np.ndarray, grid_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cubic B-spline weights of each grid point for each position, and their derivatives
+
+    Parameters
+    ----------
+    xi
+        Positions in grid units
+    grid_size
+        Number of control points along this axis
+
+    Returns
+    -------
+    (len(xi), grid_size) weights, (len(xi), grid_size) derivatives of the weights with respect to xi.
+    Rows for positions outside the valid region (where the B-spline support is not inside the grid) are 0
+    """
+    t = xi[:, None] - np.arange(grid_size)[None, :]
+    a = np.abs(t)
+
+    weights = np.where(a < 1, 2 / 3 - a ** 2 + a ** 3 / 2, np.where(a < 2, (2 - a) ** 3 / 6, 0))
+    derivatives = np.where(a < 1, -2 * t + 1.5 * t * a, np.where(a < 2, -np.sign(t) * (2 - a) ** 2 / 2, 0))
+
+    valid = (xi >= 1) & (xi <= grid_size - 2)
+    weights[~valid] = 0
+    derivatives[~valid] = 0
+    return weights, derivatives
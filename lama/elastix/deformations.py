@@ -11,18 +11,25 @@ import os
 import sys
 import subprocess
 from pathlib import Path
-from typing import Union, Dict, List
+from typing import Union, Dict, List, Tuple, Iterator
+from functools import partial
 import shutil
 import SimpleITK as sitk
 import numpy as np
+import pandas as pd
 from lama.registration_pipeline.validate_config import LamaConfig
+from lama.elastix.elastix_registration import registration_concurrency, run_jobs
+from lama.elastix.bspline_jacobians import BSplineGrid, UnsupportedTransform
+from lama.elastix.transform_parameters import read_transform_parameters
 
 ELX_TFORM_NAME = 'TransformParameters.0.txt'
 ELX_TFORM_NAME_RESOLUTION = 'TransformParameters.0.R{}.txt'  # resoltion number goes in '{}'
 TRANSFORMIX_LOG = 'transformix.log'
+TRANSFORMIX_BYTES_PER_VOXEL = 64  # Rough peak memory of transformix making the jacobians and deformation fields
+JACOBIAN_SLAB_BYTES = 256 * 1024 ** 2  # How much of a jacobian image to check at a time
 
 
-def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Union[None, np.array]:
+def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Union[None, pd.DataFrame]:
     """
     Generate jacobian determinants and optionaly defromation vectors
 
@@ -51,7 +58,8 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
 
     Returns
     -------
-    jacobian array if there are any negative values
+    The folding summary of each specimen for each set of jacobians (see _generate_deformation_fields), with a
+    deformation_id column. None if no deformations are specified
     """
 
     if isinstance(config, (str, Path)):
@@ -68,6 +76,8 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
     write_raw_jacobians = config ['write_raw_jacobians']
     write_log_jacobians = config['write_log_jacobians']
 
+    summaries = []
+
     for deformation_id, stage_info in config['generate_deformation_fields'].items():
         reg_stage_dirs: List[Path] = []
 
@@ -100,10 +110,15 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
         log_jacobians_scale_dir = log_jacobians_dir / deformation_id
         log_jacobians_scale_dir.mkdir()
 
-        neg_jac_arr = _generate_deformation_fields(reg_stage_dirs, resolutions, deformation_scale_dir, jacobians_scale_dir,
-                                                   log_jacobians_scale_dir, write_vectors, write_raw_jacobians, write_log_jacobians,
-                                                   threads=config['threads'], filetype=config['filetype'])
-        return neg_jac_arr
+        summary = _generate_deformation_fields(reg_stage_dirs, resolutions, deformation_scale_dir, jacobians_scale_dir,
+                                               log_jacobians_scale_dir, write_vectors, write_raw_jacobians, write_log_jacobians,
+                                               threads=config['threads'], filetype=config['filetype'],
+                                               max_processes=config['registration_processes'] or None,
+                                               backend=config['jacobian_backend'])
+        summary.insert(0, 'deformation_id', deformation_id)
+        summaries.append(summary)
+
+    return pd.concat(summaries)
 
 
 def _generate_deformation_fields(registration_dirs: List,
@@ -116,23 +131,35 @@ def _generate_deformation_fields(registration_dirs: List,
                                  write_log_jacobians: bool,
                                  threads=None,
                                  filetype='nrrd',
-                                 jacmat=False):
+                                 jacmat=False,
+                                 max_processes: int = None,
+                                 backend: str = 'transformix') -> pd.DataFrame:
     """
-    Run transformix on the specified registration stage to generate deformation fields and spatial jacobians
+    Run transformix on the specified registration stage to generate deformation fields and spatial jacobians for
+    every specimen. The specimens are done a number at a time, as set by the cores and memory available
+
+    backend
+        How to make the jacobians. See _get_deformations
+
+    Returns
+    -------
+    Folding summary. index: specimen id, columns: jac_min, jac_max, num_neg_voxels, num_voxels
     """
     logging.info('### Generating deformation files ###')
 
-    specimen_list = [x for x in registration_dirs[0].iterdir() if (registration_dirs[0] / x).is_dir()]
+    specimen_list = sorted(x for x in registration_dirs[0].iterdir() if (registration_dirs[0] / x).is_dir())
 
-    # if len(specimen_list) < 1:
-    #     logging.warn('Can't find any )
+    if len(specimen_list) < 1:
+        raise FileNotFoundError(f'No specimen registrations in {registration_dirs[0]}')
+
+    transform_params = {}
 
     for specimen_path in specimen_list:
         specimen_id = specimen_path.name
         temp_transform_files_dir = deformation_dir / specimen_id
         temp_transform_files_dir.mkdir(exist_ok=True)
 
-        transform_params = []
+        specimen_tforms = []
         # Get the transform parameters for the subsequent registrations
 
         if len(resolutions) == 0:  # Use the whole stages by using the joint transform file
@@ -148,8 +175,8 @@ def _generate_deformation_fields(registration_dirs: List,
                 temp_transform_file = temp_transform_files_dir / f'{reg_dir.name}_{specimen_id}_{elastix_tform_file.name}'
 
                 shutil.copy(elastix_tform_file, temp_transform_file)
-                transform_params.append(temp_transform_file)
-            _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
+                specimen_tforms.append(temp_transform_file)
+            _chain_tforms(specimen_tforms)  # Add the InitialtransformParamtere line
 
         else:
             # The resolutdeformation_dirion paramter files are numbered from 0 but the config counts from 1
@@ -164,16 +191,45 @@ def _generate_deformation_fields(registration_dirs: List,
                 temp_transform_file = temp_transform_files_dir / (registration_dirs[0].name + '_' + elastix_tform_file.name)
 
                 shutil.copy(elastix_tform_file, temp_transform_file)
-                transform_params.append(temp_transform_file)
-
-            _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
+                specimen_tforms.append(temp_transform_file)
 
-        # Copy the tp files into the temp directory and then modify to add initail transform
+            _chain_tforms(specimen_tforms)  # Add the InitialtransformParamtere line
 
         # pass in the last tp file [-1] as the other tp files are internally referenced withinn this file
-        neg_jac_array = _get_deformations(transform_params[-1], deformation_dir, jacobian_dir, log_jacobians_dir, filetype, specimen_id,
-                                          threads, jacmat, write_vectors, write_raw_jacobians, write_log_jacobians)
-        return neg_jac_array
+        transform_params[specimen_id] = specimen_tforms[-1]
+
+    memory_per_job = _output_voxels(next(iter(transform_params.values()))) * TRANSFORMIX_BYTES_PER_VOXEL
+    processes, threads = registration_concurrency(len(transform_params), threads, memory_per_job, max_processes)
+    logging.info(f'Running transformix on {len(transform_params)} specimens, {processes} at a time with {threads} '
+                 f'threads each')
+
+    summaries = {}
+
+    def job(specimen_id, tform):
+        summaries[specimen_id] = _get_deformations(tform, deformation_dir, jacobian_dir, log_jacobians_dir, filetype,
+                                                   specimen_id, threads, jacmat, write_vectors, write_raw_jacobians,
+                                                   write_log_jacobians, backend)
+
+    failed = run_jobs({id_: partial(job, id_, tform) for id_, tform in transform_params.items()}, processes)
+
+    if failed:
+        raise RuntimeError(f"Generating deformations failed for {', '.join(sorted(failed))}")
+
+    logging.info('Finished generating deformation fields')
+
+    summary = pd.DataFrame.from_dict(summaries, orient='index').loc[list(transform_params)]
+    summary.index.name = 'specimen'
+    return summary
+
+
+def _output_voxels(tform: Path) -> int:
+    """
+    The number of voxels in the output of a transform, from its (Size x y z) line
+    """
+    size = read_transform_parameters(tform).get_list('Size')
+    if not size:
+        raise ValueError(f'No Size in {tform}')
+    return int(np.prod(size))
 
 
 def _chain_tforms(tforms: List):
@@ -188,18 +244,8 @@ def _chain_tforms(tforms: List):
     for i, tp in enumerate(tforms[1:]):
         initial_tp = tforms[i]
 
-        with open(tp, 'r') as fh:
-            lines = []
-            for line in fh:
-                if line.startswith('(InitialTransformParametersFileName'):
-                    continue
-                lines.append(line)
-
-        previous_tp_str = '(InitialTransformParametersFileName "{}")'.format(initial_tp)
-        lines.insert(0, previous_tp_str + '\n')
-        with open(tp, 'w') as wh:
-            for line in lines:
-                wh.write(line)
+        tform = read_transform_parameters(tp)
+        tform.replace({'InitialTransformParametersFileName': str(initial_tp)}, add_missing=True).write(tp)
 
 
 def _get_deformations(tform: Path,
@@ -212,17 +258,37 @@ def _get_deformations(tform: Path,
                       make_jacmat: bool,
                       write_vectors: bool = False,
                       write_raw_jacobians: bool = False,
-                      write_log_jacobians: bool = True) -> Union[None, np.array]:
+                      write_log_jacobians: bool = True,
+                      backend: str = 'transformix') -> Dict:
     """
     Generate spatial jacobians and optionally deformation files.
 
+    Parameters
+    ----------
+    backend
+        'transformix', or 'bspline'/'bspline_float32' to calculate the jacobians from the B-spline coefficients (see
+        bspline_jacobians). transformix is still used if deformation vectors or jacobian matrices are wanted or the
+        transform is not supported
+
     Returns
     -------
-    the jacobian array if there are any values < 0
+    The folding summary of the jacobian: {'jac_min', 'jac_max', 'num_neg_voxels', 'num_voxels'}
     """
+    if backend in ('bspline', 'bspline_float32') and not write_vectors and not make_jacmat:
+        dtype = np.float32 if backend == 'bspline_float32' else np.float64
+        try:
+            grid = BSplineGrid(tform, dtype)
+        except UnsupportedTransform as e:
+            logging.info(f'Using transformix for the jacobians of {specimen_id}: {e}')
+        else:
+            return _bspline_deformations(grid, jacobian_dir, log_jacobians_dir, filetype, specimen_id,
+                                         write_raw_jacobians, write_log_jacobians)
+
+    # Each specimen gets its own transformix output folder so they can be run at the same time
+    transformix_out = tform.parent
 
     cmd = ['transformix',
-           '-out', str(deformation_dir),
+           '-out', str(transformix_out),
            '-tp', str(tform),
            '-jac', 'all'
            ]
@@ -242,64 +308,180 @@ def _get_deformations(tform: Path,
         logging.exception(e)
         # raise subprocess.CalledProcessError(f'### Transformix failed ###\nError message: {e}\nelastix command:{cmd}')
         raise ValueError
-    else:
-        deformation_out = deformation_dir / f'deformationField.{filetype}'
-        jacobian_out = deformation_dir / f'spatialJacobian.{filetype}'
 
-        # rename and move output
-        if write_vectors:
-            new_def = deformation_dir / (specimen_id + '.' + filetype)
-            shutil.move(deformation_out, new_def)
+    deformation_out = transformix_out / f'deformationField.{filetype}'
+    jacobian_out = transformix_out / f'spatialJacobian.{filetype}'
 
-        new_jac = jacobian_dir / (specimen_id + '.' + filetype)
+    # rename and move output
+    if write_vectors:
+        new_def = deformation_dir / (specimen_id + '.' + filetype)
+        shutil.move(deformation_out, new_def)
 
-        try:
-            shutil.move(jacobian_out, new_jac)
-        except IOError:
-            #  Bit of a hack. If trasforms conatain subtransforms from pairwise, elastix is unable to generate
-            # deformation fields. So try with itk
-            def_img = sitk.ReadImage(new_def)
-            jac_img = sitk.DisplacementFieldJacobianDeterminant(def_img)
-            sitk.WriteImage(jac_img, new_jac)
-
-        # if we have full jacobian matrix, rename and remove that
-        if make_jacmat:
-            make_jacmat.mkdir()
-            jacmat_file = deformation_dir / f'fullSpatialJacobian.{filetype}'  # The name given by elastix
-            jacmat_new = make_jacmat / (specimen_id + '.' + filetype)           # New informative name
-            shutil.move(jacmat_file, jacmat_new)
-
-        # test if there has been any folding in the jacobians
-        jac_img = sitk.ReadImage(str(new_jac))
-        jac_arr = sitk.GetArrayFromImage(jac_img)
-        jac_min = jac_arr.min()
-        jac_max = jac_arr.max()
-        logging.info("{} spatial jacobian, min:{}, max:{}".format(specimen_id, jac_min, jac_max))
-
-        if jac_min <= 0:
-            logging.warning(
-                "The jacobian determinant for {} has negative values. You may need to add a penalty term to the later registration stages".format(
-                    specimen_id))
-            # Highlight the regions folding
-            jac_arr[jac_arr > 0] = 0
-            log_jac_path = log_jacobians_dir / ('ERROR_NEGATIVE_JACOBIANS_' + specimen_id + '.' + filetype)
-            common.write_array(jac_arr, log_jac_path)
-
-        elif write_log_jacobians:
-            # Spit out the log transformed jacobians
-            log_jac = np.log(jac_arr)
-            log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
-
-            if not write_raw_jacobians:
-                new_jac.unlink()
-
-            common.write_array(log_jac, log_jac_path)
+    new_jac = jacobian_dir / (specimen_id + '.' + filetype)
+
+    try:
+        shutil.move(jacobian_out, new_jac)
+    except IOError:
+        #  Bit of a hack. If trasforms conatain subtransforms from pairwise, elastix is unable to generate
+        # deformation fields. So try with itk
+        def_img = sitk.ReadImage(new_def)
+        jac_img = sitk.DisplacementFieldJacobianDeterminant(def_img)
+        sitk.WriteImage(jac_img, new_jac)
+
+    # if we have full jacobian matrix, rename and remove that
+    if make_jacmat:
+        make_jacmat.mkdir()
+        jacmat_file = transformix_out / f'fullSpatialJacobian.{filetype}'  # The name given by elastix
+        jacmat_new = make_jacmat / (specimen_id + '.' + filetype)           # New informative name
+        shutil.move(jacmat_file, jacmat_new)
+
+    # Check for folding and make the log jacobians in one pass over the jacobian
+    summary, out_arr = jacobian_summary(new_jac, write_log_jacobians)
+    _write_jacobian_outputs(summary, out_arr, new_jac, log_jacobians_dir, filetype, specimen_id, write_raw_jacobians,
+                            write_log_jacobians)
+
+    return summary
+
+
+def _bspline_deformations(grid: BSplineGrid,
+                          jacobian_dir: Path,
+                          log_jacobians_dir: Path,
+                          filetype: str,
+                          specimen_id: str,
+                          write_raw_jacobians: bool,
+                          write_log_jacobians: bool) -> Dict:
+    """
+    Make the jacobians from the B-spline coefficients, with the same outputs as _get_deformations
+    """
+    raw = np.empty(grid.size[::-1], dtype=np.float32)
+    summary, out_arr = _summarise_jacobian_slabs(grid.jacobian_slabs(), grid.size, write_log_jacobians, raw_out=raw)
+
+    new_jac = jacobian_dir / (specimen_id + '.' + filetype)
+
+    # Only write the raw jacobians where they would be kept
+    if summary['jac_min'] <= 0 or write_raw_jacobians or not write_log_jacobians:
+        jac_img = sitk.GetImageFromArray(raw)
+        jac_img.SetOrigin(grid.origin)
+        jac_img.SetSpacing(grid.spacing)
+        jac_img.SetDirection(grid.direction)
+        sitk.WriteImage(jac_img, str(new_jac), True)
+    del raw
+
+    _write_jacobian_outputs(summary, out_arr, new_jac, log_jacobians_dir, filetype, specimen_id, write_raw_jacobians,
+                            write_log_jacobians)
+    return summary
+
+
+def _write_jacobian_outputs(summary: Dict,
+                            out_arr: np.ndarray,
+                            new_jac: Path,
+                            log_jacobians_dir: Path,
+                            filetype: str,
+                            specimen_id: str,
+                            write_raw_jacobians: bool,
+                            write_log_jacobians: bool):
+    """
+    Write the log jacobians, or the folding map if there is folding, and remove the raw jacobians if not wanted
+    """
+    logging.info("{} spatial jacobian, min:{}, max:{}".format(specimen_id, summary['jac_min'], summary['jac_max']))
 
+    if summary['jac_min'] <= 0:
+        logging.warning(
+            "The jacobian determinant for {} has negative values. You may need to add a penalty term to the later registration stages".format(
+                specimen_id))
+        # Highlight the regions folding
+        log_jac_path = log_jacobians_dir / ('ERROR_NEGATIVE_JACOBIANS_' + specimen_id + '.' + filetype)
+        common.write_array(out_arr, log_jac_path)
 
-    logging.info('Finished generating deformation fields')
+    elif write_log_jacobians:
+        # Spit out the log transformed jacobians
+        log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
+
+        if not write_raw_jacobians:
+            new_jac.unlink(missing_ok=True)
+
+        common.write_array(out_arr, log_jac_path)
+
+
+def jacobian_summary(jac_path: Path, log_jacobians: bool = True, slab_bytes: int = JACOBIAN_SLAB_BYTES) -> Tuple[Dict, Union[np.ndarray, None]]:
+    """
+    Go over a jacobian determinant image in z-slabs, getting its folding summary and log jacobians in the one pass
+
+    Parameters
+    ----------
+    jac_path
+        The jacobian determinant image
+    log_jacobians
+        Whether to make the log jacobians
+    slab_bytes
+        Roughly how much memory to use for each slab
+
+    Returns
+    -------
+    summary
+        {'jac_min', 'jac_max', 'num_neg_voxels', 'num_voxels'}
+    array
+        If there is folding (any jacobians <= 0), the jacobians with the positive values set to 0. Otherwise the log
+        jacobians, or None if log_jacobians is False
+    """
+    size, dtype, _ = common.image_header(jac_path)
+
+    # The slab (a copy for formats that are read in part) and the boolean mask of negative values
+    slice_bytes = size[0] * size[1] * (dtype.itemsize + 1)
+    slab_depth = int(max(1, min(size[2], slab_bytes // slice_bytes)))
+
+    # Formats that cannot be read in part, such as the nrrd transformix writes, are read once
+    return _summarise_jacobian_slabs(common.read_slabs(jac_path, slab_depth), size, log_jacobians)
+
+
+def _summarise_jacobian_slabs(slabs: Iterator[Tuple[int, int, np.ndarray]],
+                              size: Tuple,
+                              log_jacobians: bool,
+                              raw_out: np.ndarray = None) -> Tuple[Dict, Union[np.ndarray, None]]:
+    """
+    See jacobian_summary
+
+    Parameters
+    ----------
+    slabs
+        (z0, z1, jacobians of slices z0 to z1) covering the image in order
+    size
+        xyz size of the image
+    raw_out
+        If given, the jacobians are also copied into this
+    """
+    jac_min = np.inf
+    jac_max = -np.inf
+    num_neg = 0
+    folded = False
+    out_arr = None
+
+    for z0, z1, slab in slabs:
+
+        if out_arr is None:
+            out_arr = np.empty(size[::-1], dtype=slab.dtype)
+        if raw_out is not None:
+            raw_out[z0:z1] = slab
+
+        slab_min = slab.min()
+        jac_min = min(jac_min, slab_min)
+        jac_max = max(jac_max, slab.max())
+        num_neg += int(np.count_nonzero(slab < 0))
+
+        if slab_min <= 0 and not folded:
+            # The slices already done had no folding, so are all cleared in the folding map
+            folded = True
+            out_arr[:z0] = 0
 
-    if jac_min <=0:
-        return jac_arr
+        if folded:
+            np.minimum(slab, 0, out=out_arr[z0:z1])
+        elif log_jacobians:
+            np.log(slab, out=out_arr[z0:z1])
 
+    summary = {'jac_min': float(jac_min), 'jac_max': float(jac_max), 'num_neg_voxels': num_neg,
+               'num_voxels': int(np.prod(size))}
 
+    if not folded and not log_jacobians:
+        out_arr = None
 
+    return summary, out_arr
@@ -5,16 +5,24 @@ import os
 import shutil
 from collections import defaultdict
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Callable, Dict, List, Tuple, Union
 import yaml
+import numpy as np
 import SimpleITK as sitk
 
-from lama.elastix.folding import unfold_bsplines
+from lama.elastix.folding import BSplineParse, unfold_bsplines
 from lama import common
 from lama.elastix import ELX_TRANSFORM_NAME, RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR
 
 RESOLUTION_TP_PREFIX = 'TransformParameters.0.R'
 FULL_STAGE_TP_FILENAME = 'TransformParameters.0.txt'
 
+ELASTIX_MAX_USEFUL_THREADS = 8  # Elastix speeds up little with more threads than this
+ELASTIX_BYTES_PER_VOXEL = 40  # Rough peak memory of elastix per voxel of the fixed and moving images
+MEMORY_HEADROOM = 0.8  # The fraction of the free memory that the concurrent registrations can use
+
 
 class ElastixRegistration(object):
 
@@ -38,7 +46,7 @@ class ElastixRegistration(object):
         filetype
             Usually ?
         threads
-            How many threads to maximally use
+            The most threads to give each elastix process. Processes are run at once to use all the cores
         fixed_mask
             The binary mask for fixed image
         """
@@ -50,17 +58,24 @@ class ElastixRegistration(object):
         self.filetype = filetype
         self.threads = threads
         self.rename_output = True  # Bodge for pairwise reg, or we end up filling all the disks
+        self.max_processes = None  # Most elastix processes to run at once. None: work it out from cores and memory
+        self.retries = 1  # How many times to retry a failed registration
 
 
-    def make_average(self, out_path):
+    def make_average(self, out_path, method: str = 'mean'):
         """
         Create an average of the the input embryo volumes.
         This will search subfolders for all the registered volumes within them
+
+        Parameters
+        ----------
+        method
+            See common.average
         """
         vols = common.get_file_paths(self.stagedir, ignore_folders=[RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR])
         #logging.info("making average from following volumes\n {}".format('\n'.join(vols)))
 
-        average = common.average(vols)
+        average = common.average(vols, method=method, threads=self.threads)
 
         sitk.WriteImage(average, out_path, True)
 
@@ -74,69 +89,109 @@ class TargetBasedRegistration(ElastixRegistration):
     def set_target(self, target):
         self.fixed = target
 
-    def run(self):
-
+    def moving_images(self) -> List[Path]:
         if self.movdir.is_file():
             moving_imgs = [self.movdir]
         else:
-            moving_imgs = common.get_file_paths(self.movdir, ignore_folders=[RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR])  # This breaks if not ran from config dir
+            moving_imgs = sorted(common.get_file_paths(self.movdir, ignore_folders=[RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR]))  # This breaks if not ran from config dir
 
         if len(moving_imgs) < 1:
             raise common.LamaDataException("No volumes in {}".format(self.movdir))
 
-        for mov in moving_imgs:
-            mov_basename = mov.stem
-            outdir = self.stagedir / mov_basename
-            outdir.mkdir(parents=True)
+        names = [mov.stem for mov in moving_imgs]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise common.LamaDataException(f"Volumes with the same name in {self.movdir}: {', '.join(duplicates)}")
 
-            cmd = {'mov': str(mov),
-                   'fixed': str(self.fixed),
-                   'outdir': str(outdir),
-                   'elxparam_file': str(self.elxparam_file),
-                   'threads': self.threads,
-                   'fixed': str(self.fixed)}
-            if self.fixed_mask is not None:
-                cmd['fixed_mask'] = str(self.fixed_mask)
+        return moving_imgs
 
-            run_elastix(cmd)
+    def run(self):
 
-            # Rename the registered output.
-            if self.rename_output:
-                elx_outfile = outdir / f'result.0.{self.filetype}'
-                new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+        moving_imgs = self.moving_images()
 
-                try:
-                    shutil.move(elx_outfile, new_out_name)
-                except IOError:
-                    logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
-                    raise
-
-                move_intemediate_volumes(outdir)
-
-            # add registration metadata
-            reg_metadata_path = outdir / common.INDV_REG_METADATA
-            fixed_vol_relative = relpath(self.fixed, outdir)
-            reg_metadata = {'fixed_vol': fixed_vol_relative}
-
-            with open(reg_metadata_path, 'w') as fh:
-                fh.write(yaml.dump(reg_metadata, default_flow_style=False))
-
-            if self.fix_folding:
-                # Remove any folds folds in the Bsplines, overwtite inplace
-                tform_param_file = outdir / ELX_TRANSFORM_NAME
-                unfold_bsplines(tform_param_file, tform_param_file)
-
-                # Retransform the moving image with corrected tform file
-                cmd = [
-                    'transformix',
-                    '-in', str(mov),
-                    '-out', str(outdir),
-                    '-tp', tform_param_file
-                ]
-                subprocess.call(cmd)
-                unfolded_moving_img = outdir / 'result.nrrd'
-                new_out_name.unlink()
-                shutil.move(unfolded_moving_img, new_out_name)
+        memory_per_job = max(elastix_memory_estimate(self.fixed, mov) for mov in moving_imgs)
+        processes, threads = registration_concurrency(len(moving_imgs), self.threads, memory_per_job,
+                                                      self.max_processes)
+        logging.info(f'Registering {len(moving_imgs)} volumes, {processes} at a time with {threads} threads each')
+
+        jobs = {mov.stem: partial(self.register_specimen, mov, threads) for mov in moving_imgs}
+        failed = run_jobs(jobs, processes, self.retries)
+
+        if failed:
+            raise RuntimeError(f"Registration failed for {', '.join(sorted(failed))}")
+
+    def register_specimen(self, mov: Path, threads: int = None):
+        """
+        Register one moving image to the target. The output goes in stagedir/<moving image name>. Any output from a
+        previous failed attempt is removed first
+        """
+        mov_basename = mov.stem
+        outdir = self.stagedir / mov_basename
+        if outdir.is_dir():
+            shutil.rmtree(outdir)
+        outdir.mkdir(parents=True)
+
+        cmd = {'mov': str(mov),
+               'fixed': str(self.fixed),
+               'outdir': str(outdir),
+               'elxparam_file': str(self.elxparam_file),
+               'threads': threads or self.threads,
+               'fixed': str(self.fixed)}
+        if self.fixed_mask is not None:
+            cmd['fixed_mask'] = str(self.fixed_mask)
+
+        run_elastix(cmd)
+
+        # Rename the registered output.
+        if self.rename_output:
+            elx_outfile = outdir / f'result.0.{self.filetype}'
+            new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+
+            try:
+                shutil.move(elx_outfile, new_out_name)
+            except IOError:
+                logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
+                raise
+
+            move_intemediate_volumes(outdir)
+
+        # add registration metadata
+        reg_metadata_path = outdir / common.INDV_REG_METADATA
+        fixed_vol_relative = relpath(self.fixed, outdir)
+        reg_metadata = {'fixed_vol': fixed_vol_relative}
+
+        with open(reg_metadata_path, 'w') as fh:
+            fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+
+        if self.fix_folding:
+            # Remove any folds folds in the Bsplines, overwtite inplace
+            tform_param_file = outdir / ELX_TRANSFORM_NAME
+            bs = BSplineParse(tform_param_file)
+            unfold_bsplines(bs, tform_param_file, iterative=True)
+            if not bs.num_corrected:
+                return
+            logging.info(f'Folding correction changed {bs.num_corrected} control points of {mov_basename}')
+
+            # Retransform the moving image with corrected tform file
+            cmd = [
+                'transformix',
+                '-in', str(mov),
+                '-out', str(outdir),
+                '-tp', str(tform_param_file),
+                '-threads', str(threads or self.threads)
+            ]
+            try:
+                subprocess.check_output(cmd)
+            except Exception as e:  # can't seem to log CalledProcessError
+                logging.exception(f'transforming with the unfolded transform failed:\n\ncommand: {cmd}\n\n error: {e}')
+                raise
+
+            # Only replace the registered image once the new one has been made
+            unfolded_moving_img = outdir / f'result.{self.filetype}'
+            if not unfolded_moving_img.is_file():
+                raise FileNotFoundError(f'transformix did not make {unfolded_moving_img}')
+            registered_img = new_out_name if self.rename_output else outdir / f'result.0.{self.filetype}'
+            os.replace(unfolded_moving_img, registered_img)
 
 
 class PairwiseBasedRegistration(ElastixRegistration):
@@ -250,6 +305,151 @@ class PairwiseBasedRegistration(ElastixRegistration):
             shutil.move(elx_outfile, new_out_name)
 
 
+def registration_concurrency(num_jobs: int,
+                             threads: int = None,
+                             memory_per_job: int = None,
+                             max_processes: int = None) -> Tuple[int, int]:
+    """
+    Work out how many elastix processes to run at once and how many threads to give each. The cores of the machine
+    are shared out between the processes
+
+    Parameters
+    ----------
+    num_jobs
+        The number of registrations to do
+    threads
+        The most threads to give one elastix process (the config 'threads' option). Defaults to
+        ELASTIX_MAX_USEFUL_THREADS
+    memory_per_job
+        Estimated peak memory of one registration in bytes (see elastix_memory_estimate). If given, the number of
+        processes is limited so that they fit in the free memory
+    max_processes
+        Upper limit on the number of processes
+
+    Returns
+    -------
+    number of processes, threads per process
+    """
+    cores = os.cpu_count() or 1
+    threads_each = max(1, min(threads or ELASTIX_MAX_USEFUL_THREADS, cores))
+
+    processes = max(1, cores // threads_each)
+
+    if memory_per_job:
+        processes = min(processes, int(common.available_memory() * MEMORY_HEADROOM // memory_per_job))
+
+    if max_processes:
+        processes = min(processes, max_processes)
+
+    processes = max(1, min(processes, num_jobs))
+
+    return processes, threads_each
+
+
+def elastix_memory_estimate(fixed: Path, moving: Path) -> int:
+    """
+    Roughly estimate the peak memory in bytes of registering moving to fixed from the image sizes in their headers
+    """
+    num_voxels = 0
+    for path in (fixed, moving):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(path))
+        reader.ReadImageInformation()
+        num_voxels += int(np.prod(reader.GetSize()))
+
+    return num_voxels * ELASTIX_BYTES_PER_VOXEL
+
+
+def run_pipelined(stages: List[TargetBasedRegistration], max_processes: int = None, retries: int = 1):
+    """
+    Register each specimen through all the stages, starting its next stage as soon as it has finished the previous one
+    rather than when all the specimens have. The stages' targets must all be known at the start, so this cannot be
+    used when a new target is made from each stage's average
+
+    Parameters
+    ----------
+    stages
+        The registrations, in order, each with its target set. The moving images are taken from the first stage. Each
+        later stage uses the output of the one before (the same layout as when running the stages one by one)
+    max_processes
+        Upper limit on the number of elastix processes to run at once
+    retries
+        How many more times to try a registration stage that fails
+    """
+    moving_imgs = stages[0].moving_images()
+
+    memory_per_job = max(elastix_memory_estimate(stage.fixed, mov) for stage in stages for mov in moving_imgs)
+    processes, threads = registration_concurrency(len(moving_imgs), stages[0].threads, memory_per_job, max_processes)
+    logging.info(f'Registering {len(moving_imgs)} volumes through {len(stages)} stages, {processes} at a time with '
+                 f'{threads} threads each')
+
+    jobs = {}
+    for mov in moving_imgs:
+        name = mov.stem
+        steps = []
+        for stage in stages:
+            steps.append(partial(stage.register_specimen, mov, threads))
+            mov = stage.stagedir / name / f'{name}.{stage.filetype}'  # The registered image is the next moving image
+        jobs[name] = steps
+
+    failed = run_jobs(jobs, processes, retries)
+
+    if failed:
+        raise RuntimeError(f"Registration failed for {', '.join(sorted(failed))}")
+
+
+def run_jobs(jobs: Dict[str, Union[Callable, List[Callable]]], processes: int, retries: int = 1) -> Dict[str, Exception]:
+    """
+    Run independent registration jobs, a number at a time. The work is done in elastix/transformix subprocesses, so
+    threads are used to run them. A job that fails is retried, and does not stop the other jobs
+
+    Parameters
+    ----------
+    jobs
+        {name: function taking no arguments} or {name: [functions]} for jobs with steps to be run in order, such as
+        the registration stages of a specimen
+    processes
+        How many jobs to run at once
+    retries
+        How many more times to try a job (or step) that raises an exception
+
+    Returns
+    -------
+    {name: the last exception} for the jobs that failed on every attempt
+    """
+    retries = max(0, retries)
+
+    def attempt(name, steps):
+        if callable(steps):
+            steps = [steps]
+
+        for step_num, step in enumerate(steps):
+            step_name = name if len(steps) == 1 else f'{name} (step {step_num + 1})'
+            for i in range(retries + 1):
+                try:
+                    step()
+                    break
+                except Exception as e:
+                    if i == retries:
+                        raise
+                    logging.warning(f'{step_name} failed ({e}). Retrying ({i + 1} of {retries})')
+
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(attempt, name, job): name for name, job in jobs.items()}
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f'{name} failed: {e}')
+                failed[name] = e
+
+    return failed
+
+
 def run_elastix(args):
     cmd = ['elastix',
            '-f', args['fixed'],
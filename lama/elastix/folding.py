@@ -2,10 +2,14 @@
 Folding in the deformations cn casue problems with the inversions.
 This module corrects overafolding and ensures injectivity of the transform
 """
-import numpy as np 
+import numpy as np
 from pathlib import Path
 from typing import Union
 
+from logzero import logger as logging
+
+from lama.elastix.transform_parameters import read_transform_parameters
+
 
 K2 = 2.046392675
 K3 = 2.479472335
@@ -16,6 +20,10 @@ A3 = np.sqrt(
     ((3/2)**2 + (K2 - (3/2))**2 + (K3 - K2)**2)
 )
 
+MAX_ITERATIONS = 10
+ITERATION_SHRINK = 1e-3  # Fraction the correction length is reduced by on each iteration
+PARAMETER_DECIMALS = 6  # As the coefficients are written to file
+
 
 class BSplineParse():
 
@@ -32,6 +40,8 @@ class BSplineParse():
         ----------
         coefs: np.ndarray
             m*n array. m number of control points, n = num axes
+        num_corrected: int
+            The number of control points changed by unfold_bsplines
 
         Returns
         -------
@@ -48,31 +58,17 @@ class BSplineParse():
 
         """
 
-        with open(tform_file, 'r') as fh:
-
-            other_data = []
-
-            bspline = False
-
-            for line in fh:
-                if line.startswith('(TransformParameters '):
-                    tform_str = line.strip()
-                    tform_str = tform_str.strip(')')
-                    tform_str = tform_str.lstrip('(TransformParameters ')
-                    tform_params = tform_str.split(' ')
-
-                    tform_params= [float(x) for x in tform_params]
-                else:
-                    other_data.append(line)
+        tp = read_transform_parameters(tform_file)
 
-                if line.startswith('(Transform "BSplineTransform")'):
-                    bspline = True
-
-            if bspline:
-                tform_params = np.array(np.array_split(tform_params, 3)).T
+        if tp.transform == 'BSplineTransform':
+            tform_params = tp.coefficients().copy()
+        else:
+            tform_params = np.array(tp.parameters)
 
-            self.coefs = tform_params
-            self.elastix_params = other_data
+        self.transform_parameters = tp
+        self.coefs = tform_params
+        self.elastix_params = [line for line in tp.lines if line is not None]
+        self.num_corrected = 0
 
     def control_point_coords(self):
 
@@ -96,78 +92,101 @@ def condition_1(coefs):
     -------
 
     """
-    t = np.abs(coefs) < 1/K3
-    condition_met = np.apply_along_axis(np.all, 1, t)
-    return condition_met
+    return np.all(np.abs(coefs) < 1/K3, axis=1)
 
 
 def condition_2(coefs):
-    # def f(x):
-    #     # s = np.sum(x) < (1 / A3) ** 2
-    #     s = np.linalg.norm(x) < (1 / A3)
-    #     return s
-    # t = coefs**2
-    # condition_met = np.apply_along_axis(f, 1, t)
-    # return condition_met
     return np.linalg.norm(coefs, axis=1) < (1 / A3)
 
 
-# def correct_1(coefs, potential_fold_indices):
-#     for idx in potential_fold_indices:
-#         bounds = (1 / A3) ** 2
-#         coefs[idx, :] = bounds
-#     return coefs
+def fold_risk(coefs: np.ndarray) -> np.ndarray:
+    """
+    Boolean mask of the control points that meet neither of the conditions for a positive jacobian
 
+    Parameters
+    ----------
+    coefs
+        n_coefs * dims array of coefficients in units of the grid spacing
+    """
+    return ~(condition_1(coefs) | condition_2(coefs))
 
-def correct(coefs):
-    coefs = np.copy(coefs)
 
-    result = []
-    for c in coefs:
+def correct(coefs, bound=1 / A3):
+    """
+    Scale each vector of coefs to a length of bound so that it satisfies condition 2
 
-        # Make this vector satisfy condition 2
-        unfolded = np.array(c) / np.linalg.norm(c) * (1 / A3)
-        # unfolded = c * (max_bound / np.sum(c))
+    Parameters
+    ----------
+    coefs
+        n_coefs * dims array of coefficients to correct, in units of the grid spacing
+    bound
+        The length to scale to
+    """
+    coefs = np.asarray(coefs, dtype=np.float64)
+    norms = np.linalg.norm(coefs, axis=1, keepdims=True)
+    return coefs * (bound / norms)
 
-        # Replace the vector of coefs
-        result.append(unfolded)
 
-    return result
+def unfold_bsplines(bs: Union[BSplineParse, str], outfile=None, iterative: bool = False,
+                    max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    """
+    Correct the B-spline coefficients that could cause folding (a negative jacobian determinant)
 
+    Parameters
+    ----------
+    bs
+        The parsed transform, or the path to a TransformParameters file
+    outfile
+        Where to write the corrected transform. It can be the file that was read
+    iterative
+        After each correction re-check the conditions on the coefficients as they will be written to file (to 6
+        decimal places). Any that still fail are corrected to a slightly smaller length, until all pass or
+        max_iterations is reached
+    max_iterations
+        For iterative mode
 
-def unfold_bsplines(bs: Union[BSplineParse, str], outfile=None) -> np.ndarray:
+    Returns
+    -------
+    The n_coefs * dims corrected coefficients in the units of the transform. bs.num_corrected is set to the number of
+    control points that were changed
+    """
 
     if isinstance(bs, (str, Path)):
         bs = BSplineParse(bs)
 
-    # Scale the coeficents by the grid size
-    spacing_str = bs.elastix_params[21].split(' ')[1:4]
-    grid_size = [float(x.strip().strip(')')) for x in spacing_str]
-
-    # this conversion may be needed if bs.coefs doesn't accept numpy array operations
-    # scale to (1, 1)-spacing grid
-
-    bs.coefs[:, 0] /= grid_size[0]
-    bs.coefs[:, 1] /= grid_size[1]
-    bs.coefs[:, 2] /= grid_size[2]
-    # grid points that need to be corrected
-    idx_to_correct = ~(condition_1(bs.coefs) | condition_2(bs.coefs))
-
-    if not np.any(idx_to_correct): # No folding so write or return orginal
-        if outfile:
-            write_tform(bs.coefs, bs.elastix_params, outfile)
-            return
-        else:
-            return bs
-    # correct potentially problematic grid points
-    bs.coefs[idx_to_correct, :] = correct(bs.coefs[idx_to_correct, :])
-    # rescale to original grid spacing
-    bs.coefs[:, 0] *= grid_size[0]
-    bs.coefs[:, 1] *= grid_size[1]
-    bs.coefs[:, 2] *= grid_size[2]
+    # Scale to a grid with a spacing of 1
+    grid_spacing = np.array(bs.transform_parameters.get_list('GridSpacing'), dtype=np.float64)
+    coefs = bs.coefs / grid_spacing
+
+    to_correct = fold_risk(coefs)
+    corrected = np.zeros(len(coefs), dtype=bool)
+    bound = 1 / A3
+
+    for i in range(max_iterations if iterative else 1):
+        if not np.any(to_correct):
+            break
+        coefs[to_correct] = correct(coefs[to_correct], bound)
+        corrected |= to_correct
+
+        if iterative:
+            coefs = np.round(coefs * grid_spacing, PARAMETER_DECIMALS) / grid_spacing
+            to_correct = fold_risk(coefs)
+            bound *= 1 - ITERATION_SHRINK
+    else:
+        if iterative and np.any(to_correct):
+            logging.warning(f'{np.count_nonzero(to_correct)} B-spline control points could still fold after '
+                            f'{max_iterations} iterations of folding correction')
+
+    bs.num_corrected = int(np.count_nonzero(corrected))
+    if bs.num_corrected:
+        # Rescale to the original grid spacing
+        bs.coefs = coefs * grid_spacing
 
     if outfile:
-        write_tform(bs.coefs, bs.elastix_params, outfile)
+        if bs.num_corrected:
+            bs.transform_parameters.with_parameters(bs.coefs).write(outfile)
+        elif Path(outfile).resolve() != Path(bs.transform_parameters.path).resolve():
+            bs.transform_parameters.write(outfile)  # No folding so write the original
 
     return bs.coefs
 
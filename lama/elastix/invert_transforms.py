@@ -1,22 +1,30 @@
 from pathlib import Path
-import tempfile
 import os
 import subprocess
+import hashlib
+import time
 from collections import defaultdict
-from multiprocessing import Pool
-from os.path import join, abspath, isfile
+from functools import partial
+from os.path import abspath, isfile
 from typing import Union, List, Dict
 
 from logzero import logger as logging
+import pandas as pd
 import yaml
 
 from lama import common
 from lama.common import cfg_load
 from lama.registration_pipeline.validate_config import LamaConfig
+from lama.elastix.transform_parameters import read_transform_parameters
+from lama.elastix.elastix_registration import registration_concurrency, run_jobs, elastix_memory_estimate
 
 from lama.elastix import (ELX_TRANSFORM_NAME, ELX_PARAM_PREFIX, PROPAGATE_LABEL_TRANFORM,
                           PROPAGATE_IMAGE_TRANSFORM, PROPAGATE_CONFIG, RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR)
 
+INVERSION_PARAMS_FILE = 'inversion_parameters.txt'  # Made once for each stage
+INVERSION_HASH_FILE = 'inversion_inputs.sha1'
+INVERSION_TIMINGS_FILE = 'inversion_timings.csv'
+
 LABEL_REPLACEMENTS = {
     'FinalBSplineInterpolationOrder': '0',
     'FixedInternalImagePixelType': 'short',
@@ -38,28 +46,37 @@ IMAGE_REPLACEMENTS = {
 
 
 def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
-                                      clobber=True, new_log:bool=False):
+                                      clobber=False, new_log:bool=False):
     """
     Create new elastix TransformParameter files that can then be used by transformix to invert labelmaps, stats etc
 
+    The inversions are run a number at a time, sized from the cores and memory available, with config['threads'] threads
+    each (see registration_concurrency).
+    Each stage's inversion parameter file is made once and shared by its specimens. A job is skipped if its inverted
+    parameter files were made from the same inputs, as recorded in a hash of them in its output folder. The time of each
+    job is logged and written to inversion_timings.csv
+
     Parameters
     ----------
     config
         path to original reg pipeline config file
 
     clobber
-        if True overwrite inverted parameters present
+        if True redo the inversions even if they are up to date
 
     new_log:
         Whether to create a new log file. If called from another module, logging may happen there
+
+    Raises
+    ------
+    RuntimeError
+        If any of the inversions fail
     """
     common.test_installation('elastix')
 
     if isinstance(config, (Path, str)):
         config = LamaConfig(config)
 
-    threads = str(config['threads'])
-
     if new_log:
         common.init_logging(config / 'invert_transforms.log')
 
@@ -73,35 +90,37 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
 
     stages_to_invert = defaultdict(list)
 
-    jobs: List[Dict] = []
+    jobs: Dict[str, Dict] = {}
 
     reg_stage_dir: Path
 
-    for i, vol_id in enumerate(volume_names):
+    for reg_stage_dir in reg_dirs:
 
-        for reg_stage_dir in reg_dirs:
+        if not reg_stage_dir.is_dir():
+            logging.error('cannot find {}'.format(reg_stage_dir))
+            raise FileNotFoundError(f'Cannot find registration dir {reg_stage_dir}')
 
-            if not reg_stage_dir.is_dir():
-                logging.error('cannot find {}'.format(reg_stage_dir))
-                raise FileNotFoundError(f'Cannot find registration dir {reg_stage_dir}')
+        inv_stage_dir = inv_outdir / reg_stage_dir.name
 
-            inv_stage_dir = inv_outdir / reg_stage_dir.name
+        # Create the folder to put the specimen inversion parameter files in.
+        inv_stage_dir.mkdir(exist_ok=True)
 
-            specimen_stage_reg_dir = reg_stage_dir / vol_id
-            specimen_stage_inversion_dir = inv_stage_dir / vol_id
+        # Add the stage to the inversion order config (in reverse order)
+        stages_to_invert['label_propagation_order'].insert(0, reg_stage_dir.name)
 
-            transform_file = common.getfile_startswith(specimen_stage_reg_dir, ELX_TRANSFORM_NAME)
-            parameter_file = common.getfile_startswith(reg_stage_dir, ELX_PARAM_PREFIX)
+        # Modify the elastix registration input parameter file to enable inversion (Change metric and don't write
+        # image results). This is the same for all the specimens of the stage
+        parameter_file = common.getfile_startswith(reg_stage_dir, ELX_PARAM_PREFIX)
+        inversion_params = inv_stage_dir / INVERSION_PARAMS_FILE
+        if not make_elastix_inversion_parameter_file(abspath(parameter_file), inversion_params, IMAGE_REPLACEMENTS):
+            raise RuntimeError(f'Cannot make the inversion parameter file for {reg_stage_dir.name}')
 
-            # Create the folder to put the specimen inversion parameter files in.
-            inv_stage_dir.mkdir(exist_ok=True)
+        for vol_id in volume_names:
 
-            # Add the stage to the inversion order config (in reverse order), if not already.
-            if reg_stage_dir.name not in stages_to_invert['label_propagation_order']:
-                stages_to_invert['label_propagation_order'].insert(0, reg_stage_dir.name)
+            specimen_stage_reg_dir = reg_stage_dir / vol_id
+            specimen_stage_inversion_dir = inv_stage_dir / vol_id
 
-            if clobber:
-                common.mkdir_force(specimen_stage_inversion_dir)  # Overwrite any inversion file that exist for a single specimen
+            transform_file = common.getfile_startswith(specimen_stage_reg_dir, ELX_TRANSFORM_NAME)
 
             # Each registration directory contains a metadata file, which contains the relative path to the fixed volume
             reg_metadata = cfg_load(specimen_stage_reg_dir / common.INDV_REG_METADATA)
@@ -111,30 +130,54 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
 
             job = {
                 'specimen_stage_inversion_dir': specimen_stage_inversion_dir,
-                'parameter_file': abspath(parameter_file),
+                'inversion_params': inversion_params,
                 'transform_file': transform_file,
                 'fixed_volume': fixed_volume,
-                'param_file_output_name': 'inversion_parameters.txt',
-                'image_replacements': IMAGE_REPLACEMENTS,
                 'label_replacements': LABEL_REPLACEMENTS,
                 'image_transform_file': PROPAGATE_IMAGE_TRANSFORM,
                 'label_transform_file': PROPAGATE_LABEL_TRANFORM,
-                'clobber': clobber,
-                'threads': threads
+                'clobber': clobber
             }
 
-            jobs.append(job)
-
-    # By putting each inverison job (a single job per registration stage) we can speed things up a bit
-    # If we can get multithreded inversion in elastix we can remove this python multithreading
-    pool = Pool(8)
-    try:
-        pool.map(_invert_transform_parameters, jobs)
-
-    except KeyboardInterrupt:
-        print('terminating inversion')
-        pool.terminate()
-        pool.join()
+            jobs[f'{reg_stage_dir.name}/{vol_id}'] = job
+
+    # The inversion registers the fixed volume to itself
+    memory_estimates = {}
+    for job in jobs.values():
+        fixed = job['fixed_volume']
+        if fixed not in memory_estimates:
+            memory_estimates[fixed] = elastix_memory_estimate(fixed, fixed)
+
+    processes, threads = registration_concurrency(len(jobs), config['threads'], max(memory_estimates.values()),
+                                                  config['registration_processes'] or None)
+    logging.info(f'Inverting {len(jobs)} transforms, {processes} at a time with {threads} threads each')
+
+    timings = {}
+
+    def run(name, job):
+        start = time.perf_counter()
+        status = _invert_transform_parameters({**job, 'threads': str(threads)})
+        timings[name] = (status, time.perf_counter() - start)
+        logging.info(f'Inverting {name}: {status} in {timings[name][1]:.1f}s')
+        if status == 'failed':
+            raise RuntimeError(f'Inversion failed for {name}')
+
+    failed = run_jobs({name: partial(run, name, job) for name, job in jobs.items()}, processes,
+                      config['registration_retries'])
+
+    timings = pd.DataFrame.from_dict(timings, orient='index', columns=['status', 'seconds'])
+    timings.index.name = 'job'
+    timings.sort_index().to_csv(inv_outdir / INVERSION_TIMINGS_FILE)
+    done = timings[timings.status == 'inverted']
+    up_to_date = int((timings.status == 'up to date').sum())
+    if len(done):
+        logging.info(f'Inverted {len(done)} transforms (mean {done.seconds.mean():.1f}s, slowest '
+                     f'{done.seconds.idxmax()} {done.seconds.max():.1f}s). {up_to_date} were up to date')
+    elif up_to_date:
+        logging.info(f'All {up_to_date} inverted transforms were up to date')
+
+    if failed:
+        raise RuntimeError(f"Inversion failed for {', '.join(sorted(failed))}")
 
     # TODO: Should we replace the need for this invert.yaml?
     reg_dir = Path(os.path.relpath(reg_stage_dir, inv_outdir))
@@ -146,50 +189,72 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
         yf.write(yaml.dump(dict(stages_to_invert), default_flow_style=False))
 
 
-def _invert_transform_parameters(args: Dict):
+def _invert_transform_parameters(args: Dict) -> str:
     """
     Generate a single inverted elastix transform parameter file. This can then be used to invert labels, masks etc.
     If any of the step fail, return as subsequent steps will also fail. The logging of failures is handled
     within each function
-    """
 
-    # If we have both the image and label inverted transforms, don't do anything if noclobber is True
-    clobber = args['clobber']
-    threads = args['threads']
+    Returns
+    -------
+    'inverted', 'up to date' or 'failed'
+    """
+    inversion_dir = Path(args['specimen_stage_inversion_dir'])
 
-    image_transform_param_path = abspath(join(args['specimen_stage_inversion_dir'], args['image_transform_file']))
-    label_transform_param_path = abspath(join(args['specimen_stage_inversion_dir'], args['label_transform_file']))
+    image_transform_param_path = abspath(inversion_dir / args['image_transform_file'])
+    label_transform_param_path = abspath(inversion_dir / args['label_transform_file'])
 
-    if not clobber and isfile(label_transform_param_path) and isfile(image_transform_param_path):
-        logging.info('skipping {} as noclobber is True and inverted parameter files exist')
-        return
+    # If we have both the image and label inverted transforms made from the same inputs, don't do anything unless
+    # clobber is True
+    inputs_hash = _inversion_inputs_hash(args)
+    hash_file = inversion_dir / INVERSION_HASH_FILE
+    if (not args['clobber'] and isfile(label_transform_param_path) and isfile(image_transform_param_path)
+            and hash_file.is_file() and hash_file.read_text() == inputs_hash):
+        return 'up to date'
 
-    # Modify the elastix registration input parameter file to enable inversion (Change metric and don't write image results)
-    inversion_params = abspath(join(args['specimen_stage_inversion_dir'], args['param_file_output_name'])) # The elastix registration parameters used for inversion
-    make_elastix_inversion_parameter_file(abspath(args['parameter_file']), inversion_params, args['image_replacements'])  # I don't think we need the replacements here!!!!!!!!
+    common.mkdir_force(inversion_dir)  # Remove any previous or partial inversion
 
      # Do the inversion, making the inverted TransformParameters file
     fixed_vol = args['fixed_volume']
     forward_tform_file = abspath(args['transform_file'])
-    invert_param_dir = args['specimen_stage_inversion_dir']
 
-    if not invert_elastix_transform_parameters(fixed_vol, forward_tform_file, inversion_params, invert_param_dir, threads):
-        return
+    if not invert_elastix_transform_parameters(fixed_vol, forward_tform_file, abspath(args['inversion_params']),
+                                               inversion_dir, args['threads']):
+        return 'failed'
 
     # Get the resulting TransformParameters file, and create a transform file suitable for inverting normal volumes
-    image_inverted_tform = abspath(join(args['specimen_stage_inversion_dir'], 'TransformParameters.0.txt'))
+    image_inverted_tform = abspath(inversion_dir / 'TransformParameters.0.txt')
 
     if not _modify_inverted_tform_file(image_inverted_tform, image_transform_param_path):
-        return
+        return 'failed'
 
     # Get the resulting TransformParameters file, and create a transform file suitable for inverting label volumes
 
     # replace the parameter in the image file with label-specific parameters and save in new file. No need to
     # generate one from scratch
     if not make_elastix_inversion_parameter_file(image_transform_param_path, label_transform_param_path, args['label_replacements']):
-        return
+        return 'failed'
 
-    _modify_inverted_tform_file(label_transform_param_path)
+    if not _modify_inverted_tform_file(label_transform_param_path):
+        return 'failed'
+
+    hash_file.write_text(inputs_hash)
+    return 'inverted'
+
+
+def _inversion_inputs_hash(args: Dict) -> str:
+    """
+    Hash of the inputs of an inversion: the forward transform and inversion parameter files, the replacements and the
+    path, size and modification time of the fixed volume
+    """
+    h = hashlib.sha1()
+    for path in (args['transform_file'], args['inversion_params']):
+        h.update(Path(path).read_bytes())
+
+    fixed = Path(args['fixed_volume'])
+    stat = fixed.stat()
+    h.update(f"{fixed}|{stat.st_size}|{stat.st_mtime_ns}|{sorted(args['label_replacements'].items())}".encode())
+    return h.hexdigest()
 
 
 def get_reg_dirs(config: LamaConfig) -> List[Path]:
@@ -222,32 +287,11 @@ def make_elastix_inversion_parameter_file(elx_param_file: Path, newfile_name: st
 
     """
 
+    replacements = {'Metric': 'DisplacementMagnitudePenalty',
+                    'WriteResultImage': 'false',
+                    **replacements}
     try:
-        with open(elx_param_file) as old, open(newfile_name, "w") as new:
-
-            for line in old:
-                if line.startswith("(Metric "):
-                    line = '(Metric "DisplacementMagnitudePenalty")\n'
-                if line.startswith('(WriteResultImage '):
-                    line = '(WriteResultImage "false")\n'
-                if line.startswith('WriteResultImageAfterEachResolution '):
-                   continue
-                try:
-                    param_name = line.split()[0][1:]
-                except IndexError:
-                    continue  # comment?
-
-                if param_name in replacements:
-                    value = replacements[param_name]
-                    try:
-                        int(value)
-                    except ValueError:
-                        # Not an int, neeed quotes
-                        line = '({} "{}")\n'.format(param_name, value)
-                    else:
-                        # An int, no quotes
-                        line = '({} {})\n'.format(param_name, value)
-                new.write(line)
+        read_transform_parameters(elx_param_file).replace(replacements).write(newfile_name)
     except IOError as e:
         logging.error("Error modifying the elastix parameter file: {}".format(e))
         return False
@@ -295,21 +339,12 @@ def _modify_inverted_tform_file(elx_tform_file: Path, newfile_name: str=None):
         path to save modified transform file
     """
 
-    if not newfile_name:  # Write to temporary file before overwriting
-        new_file = tempfile.NamedTemporaryFile().name
-    else:
-        new_file = newfile_name
+    if not newfile_name:  # Overwrite. The file is read in full before writing
+        newfile_name = elx_tform_file
 
     try:
-
-        with open(new_file, "w+") as new_tform_param_fh,  open(elx_tform_file, "r") as tform_param_fh:
-
-            for line in tform_param_fh:
-                if line.startswith('(InitialTransformParametersFileName'):
-                    line = '(InitialTransformParametersFileName "NoInitialTransform")\n'
-                new_tform_param_fh.write(line)
-            new_tform_param_fh.close()
-            tform_param_fh.close()
+        tform = read_transform_parameters(elx_tform_file)
+        tform.replace({'InitialTransformParametersFileName': 'NoInitialTransform'}).write(newfile_name)
 
     except IOError:
         logging.warning("Error reading or writing transform files {}".format(elx_tform_file))
@@ -51,6 +51,7 @@ from lama import common
 from lama.common import cfg_load
 from lama.elastix import (PROPAGATE_LABEL_TRANFORM, PROPAGATE_IMAGE_TRANSFORM, ELX_PARAM_PREFIX, TRANSFORMIX_OUT,
                           ELX_TRANSFORM_NAME, ELX_INVERTED_POINTS_NAME, PROPAGATE_CONFIG)
+from lama.elastix.transform_parameters import read_transform_parameters
 
 
 class Propagate(object):
@@ -415,17 +416,9 @@ def chain_tforms(root_dir: Path, new_tform_dir, tform_name, config):
         if i == 0:
             file_for_transformix = new_tform_path
 
-        with open(tform_file, 'r') as fh, open(new_tform_path, 'w') as nfh:
-
-            for line in fh:
-                #
-                if line.startswith('(InitialTransformParametersFileName') and init_tform:
-                    line = f'(InitialTransformParametersFileName "{str(init_tform)}")\n'
-                else:
-                    for param in label_replacements:
-                        if line.startswith(f'({param}'):
-                            line = f'({param} {label_replacements[param]})\n'
-
-                nfh.write(line)
+        tform = read_transform_parameters(tform_file).replace(label_replacements, raw=True)
+        if init_tform:
+            tform = tform.replace({'InitialTransformParametersFileName': str(init_tform)})
+        tform.write(new_tform_path)
 
     return file_for_transformix
\ No newline at end of file
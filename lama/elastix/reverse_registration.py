@@ -63,6 +63,7 @@ from lama.elastix import (ELX_TRANSFORM_NAME, ELX_PARAM_PREFIX, PROPAGATE_LABEL_
 from lama.elastix.invert_transforms import (LABEL_REPLACEMENTS, IMAGE_REPLACEMENTS,
                                             )
 from lama.elastix.elastix_registration import TargetBasedRegistration
+from lama.elastix.transform_parameters import read_transform_parameters
 
 
 def reverse_registration(config: Union[str, LamaConfig]):
@@ -202,39 +203,15 @@ def modify_elx_parameter_file(elx_param_file: Path, newfile_name: str, replaceme
 
     """
 
+    replacements = {'WriteResultImage': 'false', **replacements}
     try:
-        with open(elx_param_file) as old, open(newfile_name, "w") as new:
-
-            for line in old:
-                if line.startswith('(WriteResultImage '):
-                    line = '(WriteResultImage "false")\n'
-                if line.startswith('WriteResultImageAfterEachResolution '):
-                   continue
-                try:
-                    param_name = line.split()[0][1:]
-                except IndexError:
-                    continue  # comment?
-
-                if param_name in replacements:
-                    value = replacements[param_name]
-                    try:
-                        int(value)
-                    except ValueError:
-                        # Not an int, neeed quotes
-                        line = '({} "{}")\n'.format(param_name, value)
-                    else:
-                        # An int, no quotes
-                        line = '({} {})\n'.format(param_name, value)
-                new.write(line)
+        read_transform_parameters(elx_param_file).replace(replacements).write(newfile_name)
     except IOError as e:
         logging.error("Error modifying the elastix parameter file: {}".format(e))
         return False
     return True
 
 
-
-
-
 if __name__ == '__main__':
     import sys
     cfg_path = sys.argv[1]
@@ -0,0 +1,258 @@
+"""
+Read, modify and write elastix parameter files (both the input parameter files and the TransformParameters files that
+elastix makes).
+
+A file is kept as its lines, with the values of each '(Name value ...)' line available by name. The
+(TransformParameters ...) line, which for a B-spline holds millions of coefficients, is parsed straight into a numpy
+array. Changes only rewrite the lines that change, so the rest of the file is written back as it was read.
+
+read_transform_parameters() caches the parsed files by path and modification time, as the same files are read many
+times during the inversions, staging and folding correction. The cached objects are shared, so are not changed in
+place: replace() and with_parameters() return new ones.
+"""
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Union
+
+import numpy as np
+
+CACHE_SIZE = 32  # Number of parsed files to keep
+PARAMETER_FORMAT = '%.6f'  # For writing changed TransformParameters
+TRANSFORM_PARAMETERS = 'TransformParameters'
+
+
+class TransformParameters:
+    def __init__(self, lines: Iterable[str], parameters: np.ndarray = None, path: Path = None):
+        """
+        Usually made with TransformParameters.read() or read_transform_parameters()
+
+        Parameters
+        ----------
+        lines
+            The lines of the file, each ending in a newline. The (TransformParameters ...) line is None if parameters is
+            given
+        parameters
+            The values of the (TransformParameters ...) line
+        path
+            The file this was read from
+        """
+        self.lines = tuple(lines)
+        self.path = path
+        self._parameters = parameters
+        if parameters is not None:
+            parameters.flags.writeable = False
+        self._raw_parameters_line = None
+
+        self._index = {}
+        for i, line in enumerate(self.lines):
+            name = _param_name(line) if line is not None else TRANSFORM_PARAMETERS
+            if name:
+                self._index[name] = i
+
+    @classmethod
+    def read(cls, path: Union[Path, str]) -> 'TransformParameters':
+        """
+        Parse a file without the cache
+        """
+        path = Path(path)
+        lines = []
+        parameters = None
+        raw_line = None
+
+        with open(path, 'r') as fh:
+            for line in fh:
+                if line.startswith(f'({TRANSFORM_PARAMETERS} '):
+                    raw_line = line
+                    values = line.strip()[len(TRANSFORM_PARAMETERS) + 2:].rstrip(')')
+                    parameters = np.fromstring(values, dtype=np.float64, sep=' ')
+                    lines.append(None)
+                else:
+                    lines.append(line)
+
+        tp = cls(lines, parameters, path)
+        tp._raw_parameters_line = raw_line
+        return tp
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def get(self, name: str, default=None) -> Any:
+        """
+        The value of a parameter: a str for quoted values, otherwise an int or float if it is a number. Parameters with
+        more than one value give a list. default if the parameter is not present
+        """
+        if name not in self._index:
+            return default
+        if name == TRANSFORM_PARAMETERS:
+            return self.parameters
+        values = self.get_list(name)
+        return values[0] if len(values) == 1 else values
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self._index:
+            raise KeyError(name)
+        return self.get(name)
+
+    def get_list(self, name: str, default=None) -> List:
+        """
+        As get() but always a list
+        """
+        if name not in self._index:
+            return default
+        return [_parse_value(v) for v in _split_values(self.lines[self._index[name]])]
+
+    @property
+    def transform(self) -> Union[str, None]:
+        return self.get('Transform')
+
+    @property
+    def parameters(self) -> Union[np.ndarray, None]:
+        """
+        The (read only) values of the (TransformParameters ...) line
+        """
+        return self._parameters
+
+    def coefficients(self) -> np.ndarray:
+        """
+        The parameters of a B-spline transform as (number of control points, dimensions). Column 0 is the x component
+        and so on
+        """
+        dims = int(self.get('FixedImageDimension', 3))
+        return self.parameters.reshape(dims, -1).T
+
+    def replace(self, replacements: Dict[str, Any], add_missing: bool = False, raw: bool = False) -> 'TransformParameters':
+        """
+        Change the values of parameters
+
+        Parameters
+        ----------
+        replacements
+            {name: new value}. Values are written as by format_value unless raw is True
+        add_missing
+            Add lines for any of the parameters not already in the file. Otherwise they are ignored
+        raw
+            Write the values as they are
+
+        Returns
+        -------
+        A new TransformParameters
+        """
+        lines = list(self.lines)
+        for name, value in replacements.items():
+            value_str = str(value) if raw else format_value(value)
+            line = f'({name} {value_str})\n'
+            if name in self._index:
+                lines[self._index[name]] = line
+            elif add_missing:
+                lines.append(line)
+
+        tp = TransformParameters(lines, self._parameters, self.path)
+        tp._raw_parameters_line = self._raw_parameters_line
+        return tp
+
+    def with_parameters(self, parameters: np.ndarray) -> 'TransformParameters':
+        """
+        Returns
+        -------
+        A new TransformParameters with different (TransformParameters ...) values. B-spline coefficients, as from
+        coefficients(), are accepted
+        """
+        parameters = np.array(parameters, dtype=np.float64).ravel(order='F')
+        num_params = self.get('NumberOfParameters')
+        if num_params is not None and parameters.size != num_params:
+            raise ValueError(f"stated num params: {num_params} does not match actual {parameters.size}")
+
+        lines = list(self.lines)
+        if TRANSFORM_PARAMETERS not in self._index:
+            lines.append(None)
+        return TransformParameters(lines, parameters, self.path)
+
+    def write(self, path: Union[Path, str]):
+        with open(path, 'w') as fh:
+            for line in self.lines:
+                if line is not None:
+                    fh.write(line)
+                elif self._raw_parameters_line is not None:
+                    fh.write(self._raw_parameters_line)
+                else:
+                    fh.write(f'({TRANSFORM_PARAMETERS} ')
+                    fh.flush()
+                    self._parameters.tofile(fh, sep=' ', format=PARAMETER_FORMAT)
+                    fh.write(')\n')
+
+
+def read_transform_parameters(path: Union[Path, str]) -> TransformParameters:
+    """
+    Parse an elastix parameter file, or get it from the cache if it has not changed since it was last read
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    return _read_cached(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _read_cached(path: Path, mtime_ns: int, size: int) -> TransformParameters:
+    return TransformParameters.read(path)
+
+
+def format_value(value) -> str:
+    """
+    Format a parameter value as elastix expects. Numbers (including strings of integers) are not quoted, other
+    strings are. Lists give space separated values
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return ' '.join(format_value(v) for v in value)
+    if isinstance(value, (bool, np.bool_)):
+        return f'"{str(value).lower()}"'
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return str(value)
+    try:
+        int(value)
+    except ValueError:
+        return f'"{value}"'  # Not an int, neeed quotes
+    return str(value)
+
+
+def _param_name(line: str) -> Union[str, None]:
+    line = line.lstrip()
+    if not line.startswith('('):
+        return None
+    parts = line[1:].split(None, 1)
+    if not parts:
+        return None
+    return parts[0].rstrip(')')
+
+
+def _split_values(line: str) -> List[str]:
+    """
+    The values of a '(Name value ...)' line, with quoted values kept whole (including their quotes)
+    """
+    body = line.strip()
+    body = body[1:body.rindex(')')] if ')' in body else body[1:]
+    body = body.split(None, 1)[1] if len(body.split(None, 1)) > 1 else ''
+
+    values = []
+    while body:
+        body = body.lstrip()
+        if not body:
+            break
+        if body[0] == '"':
+            end = body.find('"', 1)
+            end = len(body) if end == -1 else end + 1
+        else:
+            end = len(body.split(None, 1)[0])
+        values.append(body[:end])
+        body = body[end:]
+    return values
+
+
+def _parse_value(value: str):
+    if value.startswith('"'):
+        return value.strip('"')
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+    return value
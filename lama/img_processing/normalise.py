@@ -129,8 +129,12 @@ class IntensityMaskNormalise(Normaliser):
         logging.info('Normalising images to mask')
 
         for vol in volumes:
+            mean_difference = np.mean(vol) - self.reference_mean
+
+            if np.issubdtype(vol.dtype, np.floating):  # The stats data store is float32
+                vol -= mean_difference
+                continue
             try:
-                mean_difference = np.mean(vol) - self.reference_mean
                 vol -= mean_difference.astype(np.uint16)  # imagarr = 16bit meandiff = 64bit
             except TypeError:  # Could be caused by imgarr being a short
                 vol -= int(np.round(mean_difference))
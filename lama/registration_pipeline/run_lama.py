@@ -120,10 +120,9 @@ from lama.img_processing import glcm3d
 from lama.registration_pipeline.validate_config import LamaConfig, LamaConfigError
 from lama.elastix.deformations import make_deformations_at_different_scales
 from lama.qc.metric_charts import make_charts
-from lama.elastix.elastix_registration import TargetBasedRegistration, PairwiseBasedRegistration
+from lama.elastix.elastix_registration import TargetBasedRegistration, PairwiseBasedRegistration, run_pipelined
 from lama.staging import staging_metric_maker
 from lama.qc.qc_images import make_qc_images
-from lama.qc.folding import folding_report
 from lama.stats.standard_stats.data_loaders import DEFAULT_FWHM, DEFAULT_VOXEL_SIZE
 from lama.elastix import PROPAGATE_CONFIG, REG_DIR_ORDER_CFG
 from lama.monitor_memory import MonitorMemory
@@ -197,8 +196,9 @@ def run(configfile: Path):
         final_registration_dir = run_registration_schedule(config, first_stage_only=first_stage_only)
 
         if not first_stage_only:
-            neg_jac = make_deformations_at_different_scales(config)
-            folding_report(neg_jac, config['output_dir'], config['label_info'], outdir=config['output_dir'])
+            folding_summary = make_deformations_at_different_scales(config)
+            if folding_summary is not None:
+                folding_summary.to_csv(config['output_dir'] / common.FOLDING_FILE_NAME)
 
             create_glcms(config, final_registration_dir)
 
@@ -390,6 +390,11 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
     else:
         logging.info('Using same target for each stage')
 
+    # Without a new target each stage (or pairwise registration) the specimens do not depend on each other, so each
+    # can go on to its next stage without waiting for the others to finish the current one
+    pipelined = not regenerate_target and not config['pairwise_registration'] and not first_stage_only
+    pipelined_stages = []
+
     # Set the moving volume dir and the fixed image for the first stage
     moving_vols_dir = config['inputs']
 
@@ -455,23 +460,26 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
         if (not config['pairwise_registration']) or (config['pairwise_registration'] and euler_stage):
             registrator.set_target(fixed_vol)
 
+        registrator.max_processes = config['registration_processes'] or None
+        registrator.retries = config['registration_retries']
+
         if reg_stage['elastix_parameters']['Transform'] == 'BSplineTransform':
             if config['fix_folding']:
                 logging.info(f'Folding correction for stage {stage_id} set')
             registrator.fix_folding = config['fix_folding']  # Curently only works for TargetBasedRegistration
 
-        registrator.run()  # Do the registrations for a single stage
+        if pipelined:
+            pipelined_stages.append(registrator)  # Run after all the stages have been set up
+        else:
+            registrator.run()  # Do the registrations for a single stage
 
         # Make average from the stage outputs
         if regenerate_target:
             average_path = join(config['average_folder'], '{0}.{1}'.format(stage_id, config['filetype']))
-            registrator.make_average(average_path)
-
-        if not config['no_qc']:
+            registrator.make_average(average_path, config['average_method'])
 
-            stage_metrics_dir = qc_metric_dir / stage_id
-            common.mkdir_force(stage_metrics_dir)
-            make_charts(stage_dir, stage_metrics_dir)
+        if not config['no_qc'] and not pipelined:
+            make_stage_charts(stage_dir, qc_metric_dir / stage_id)
 
         # Setup the fixed and moving for the next stage, if there is one
         if i + 1 < len(config['registration_stage_params']):
@@ -485,11 +493,24 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
         if first_stage_only:
             return stage_dir
 
+    if pipelined:
+        logging.info(f"### Running registration stages {', '.join(config.stage_dirs)} as a pipeline ###")
+        run_pipelined(pipelined_stages, config['registration_processes'] or None, config['registration_retries'])
+
+        if not config['no_qc']:
+            for stage_id, stage_dir in config.stage_dirs.items():
+                make_stage_charts(stage_dir, qc_metric_dir / stage_id)
+
     logging.info("### Registration finished ###")
 
     return stage_dir
 
 
+def make_stage_charts(stage_dir: Path, stage_metrics_dir: Path):
+    common.mkdir_force(stage_metrics_dir)
+    make_charts(stage_dir, stage_metrics_dir)
+
+
 def create_glcms(config: LamaConfig, final_reg_dir):
     """
     Create grey level co-occurence matrices. This is done in the main registration pipeline as we don't
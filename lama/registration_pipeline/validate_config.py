@@ -107,19 +107,23 @@ class LamaConfig:
             'global_elastix_params': ('dict', 'required'),
             'registration_stage_params': ('dict', 'required'),
             'no_qc': ('bool', False),
-            'threads': ('int', 4),
+            'threads': ('int', 4),  # Threads for each elastix process. Processes are run at once to use all the cores
+            'registration_processes': ('int', 0),  # Max elastix processes at once. 0: from the cores and free memory
+            'registration_retries': ('int', 1),
             'filetype': ('func', self.validate_filetype),
             'voxel_size': ('float', 14.0),
             'generate_new_target_each_stage': ('bool', False),
+            'average_method': (['mean', 'median', 'trimmed_mean'], 'mean'),
             'skip_transform_inversion': ('bool', False),
             'pairwise_registration': ('bool', False),
             'generate_deformation_fields': ('dict', None),
+            'jacobian_backend': (['transformix', 'bspline', 'bspline_float32'], 'transformix'),
             'staging': ('func', self.validate_staging),
             'data_type': (['uint8', 'int8', 'int16', 'uint16', 'float32'], 'uint8'),
             'glcm': ('bool', False),
             'config_version': ('float', 1.1),
             'stage_targets': (Path, False),
-            'fix_folding': (bool, False),
+            'fix_folding': (bool, True),
             # 'inverse_transform_method': (['invert_transform', 'reverse_registration'], 'invert_transform')
             'label_propagation': (['invert_transform', 'reverse_registration'], 'reverse_registration'),
             'skip_forward_registration': (bool, False),
@@ -164,6 +168,7 @@ class LamaConfig:
         self.check_stages()
 
         self.check_propagation_options()
+        self.check_scheduling_options()
 
         self.check_problematic_elx_params()
 
@@ -175,6 +180,13 @@ class LamaConfig:
         # For debugging
         self.options[key] = value
 
+    def check_scheduling_options(self):
+        for option in ('registration_processes', 'registration_retries'):
+            if self.options[option] < 0:
+                raise LamaConfigError(f"'{option}' should not be negative")
+        if self.options['threads'] < 1:
+            raise LamaConfigError("'threads' should be at least 1")
+
     def check_propagation_options(self):
         if self.options['skip_forward_registration'] and self.options['label_propagation'] == 'invert_transform':
                 raise LamaConfigError("'skip_forward_registration' is only abailble when 'label_propagation "
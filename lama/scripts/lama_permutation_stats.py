@@ -37,12 +37,15 @@ def main():
     parser = argparse.ArgumentParser("Permutation-based stats")
     parser.add_argument('-c', '--config', dest='cfg_path', help='wildtype registration directory', required=True,
                         type=str)
+    parser.add_argument('-r', '--resume', dest='resume', help='Reuse the distributions and thresholds from a previous '
+                        'run on the same data. A null with fewer permutations is extended', action='store_true',
+                        default=False)
 
     args = parser.parse_args()
-    run(args.cfg_path)
+    run(args.cfg_path, args.resume)
 
 
-def run(cfg_path):
+def run(cfg_path, resume: bool = False):
 
     def p(path):
         if path is None:
@@ -85,7 +88,8 @@ def run(cfg_path):
                               label_info=label_meta,
                               label_map_path=label_map,
                               normalise_to_whole_embryo=wev_norm, qc_file=qc_file,
-                              voxel_size=voxel_size)
+                              voxel_size=voxel_size,
+                              resume=resume)
 
 
 if __name__ == '__main__':
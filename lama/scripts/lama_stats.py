@@ -39,6 +39,7 @@ def main():
     parser.add_argument('-l', '--lines', dest='lines_to_process', help="Space-separated line_ids to exclusively process", nargs='*', required=False, default=False)
     parser.add_argument('-e', '--treatment_dir', dest='treatment_dir', help="treatment registration output root directory", required=False, default=False)
     parser.add_argument('-n', '--interaction_dir', dest='interaction_dir', help="interaction registration output root directory", required=False, default=False)
+    parser.add_argument('-b', '--memory_budget', dest='memory_budget', help="GB of memory to use for the linear models. Overrides the config option", type=float, required=False, default=None)
     
     args = parser.parse_args()
 
@@ -53,7 +54,7 @@ def main():
     resolved_paths = [Path(x).expanduser() for x in paths]
 
 
-    run(*resolved_paths, args.lines_to_process)
+    run(*resolved_paths, lines_to_process=args.lines_to_process, memory_budget=args.memory_budget)
 
 
 if __name__ == '__main__':
@@ -8,11 +8,11 @@ import sys
 # Todo remove this
 sys.path.insert(0, join(dirname(__file__), '..'))
 import lib.transformations as trans
+from lama.elastix.transform_parameters import read_transform_parameters
 
 TFORM_FILE_NAME = 'TransformParameters.0.txt'
-AFFINE_INDENTIFIER = '(Transform "AffineTransform")'
-SIMILARITY_INDENTIFIER = '(Transform "SimilarityTransform")'
-TFORM_PARM_LINE_START = '(TransformParameters'
+AFFINE_TRANSFORM = 'AffineTransform'
+SIMILARITY_TRANSFORM = 'SimilarityTransform'
 
 
 def get_scaling_factor(tform_params):
@@ -31,17 +31,14 @@ def get_scaling_factor(tform_params):
 
 def extract_affine_transformation_parameters(path):
 
-    for file_ in os.listdir(path):
-        if not file_ == TFORM_FILE_NAME:
-            continue
-        with open(os.path.join(path, file_)) as reader:
-            first_line = next(reader)
-            if not first_line.startswith((AFFINE_INDENTIFIER, SIMILARITY_INDENTIFIER)):
-                continue
-            for line in reader:
-                if line.startswith(TFORM_PARM_LINE_START):
-                    tform_params = line.strip().strip(')').split()[1:]
-                    return [float(x) for x in tform_params]
+    tform_file = os.path.join(path, TFORM_FILE_NAME)
+    if not os.path.isfile(tform_file):
+        return None
+
+    tform = read_transform_parameters(tform_file)
+    if tform.transform not in (AFFINE_TRANSFORM, SIMILARITY_TRANSFORM):
+        return None
+    return [float(x) for x in tform.parameters]
 
 
 
@@ -4,6 +4,9 @@ The code to run linear models in R.
 The current interface to R is to write binary files that R can read (numpy_to_dat). The reason r2py wasn't used is that
 it used to be a pain to install. I imagine it's better now and using docker should improve things so adding
 rp2y interface is on the todo list
+
+lm_numpy is an in-process alternative to lm_r. It fits the same models as lmFast.R and returns the results in the same
+layout, but factors each design matrix only once and solves for all voxels in a chunk with a single matrix operation.
 """
 
 
@@ -12,24 +15,34 @@ import os
 import struct
 from pathlib import Path
 import tempfile
-from typing import Tuple
+from typing import Tuple, List
 import shutil
+import threading
+import time
+from functools import lru_cache
 
 from logzero import logger as logging
 
 import numpy as np
 import pandas as pd
+from scipy import linalg, stats
 import statsmodels.formula.api as smf
 
 from lama import common
+from lama.stats import r_worker
 
 LM_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'lmFast.R')
 
 # If debugging, don't delete the temp files used for communication with R so they can be used for R debugging.
 DEBUGGING = True
 
+# How the data is passed to R. See lm_r
+R_TRANSPORTS = ('file', 'shm', 'fifo')
+SHM_DIR = Path('/dev/shm')
+
 
-def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=False, use_staging: bool=True, two_way: bool=False) -> Tuple[np.ndarray, np.ndarray]:
+def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=False, use_staging: bool=True, two_way: bool=False,
+         transport: str = 'file') -> Tuple[np.ndarray, np.ndarray]:
     """
     Fit multiple linear models and get the resulting p-values
 
@@ -49,6 +62,11 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
         whether to apply boxcox transformation to the dependent variable
     use_staging
         if true, uae staging as a fixed effect in the linear model
+    transport
+        How the data is sent to R
+            'file': via a temporary file
+            'shm': the temporary files are put in shared memory (/dev/shm) so they never hit the disk
+            'fifo': the data is streamed to R through a named pipe
 
     Returns:
     -------
@@ -56,11 +74,15 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
     t-statistics for each label or voxel
 
     """
+    if transport not in R_TRANSPORTS:
+        raise ValueError(f'transport should be one of {R_TRANSPORTS}, not {transport}')
 
-    input_binary_file = tempfile.NamedTemporaryFile().name
-    line_level_pval_out_file = tempfile.NamedTemporaryFile().name
-    line_level_tstat_out_file = tempfile.NamedTemporaryFile().name
-    groups_file = tempfile.NamedTemporaryFile().name
+    tmp_dir = str(SHM_DIR) if transport == 'shm' and SHM_DIR.is_dir() else None
+
+    input_binary_file = tempfile.NamedTemporaryFile(dir=tmp_dir).name
+    line_level_pval_out_file = tempfile.NamedTemporaryFile(dir=tmp_dir).name
+    line_level_tstat_out_file = tempfile.NamedTemporaryFile(dir=tmp_dir).name
+    groups_file = tempfile.NamedTemporaryFile(dir=tmp_dir).name
 
     # create groups file
     if use_staging and two_way:
@@ -78,26 +100,30 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
     groups.index.name = 'volume_id'
     groups.to_csv(groups_file)
 
-    _numpy_to_dat(data, input_binary_file)
+    if transport == 'fifo':
+        fifo_writer = _numpy_to_fifo(data, input_binary_file)
+    else:
+        _numpy_to_dat(data, input_binary_file)
 
-    cmd = ['Rscript',
-           LM_SCRIPT,
-           input_binary_file,
-           groups_file,
-           line_level_pval_out_file,
-           line_level_tstat_out_file,
-           formula,
-           str(boxcox).upper(),  # bool to string for R
-           ''  # No plots needed for permutation testing
-           ]
+    r_args = [input_binary_file,
+              groups_file,
+              line_level_pval_out_file,
+              line_level_tstat_out_file,
+              formula,
+              str(boxcox).upper(),  # bool to string for R
+              ''  # No plots needed for permutation testing
+              ]
 
     try:
-        sub.check_output(cmd)
+        r_worker.run_rscript(LM_SCRIPT, r_args)
         logging.info('R linear model suceeded')
     except sub.CalledProcessError as e:
         msg = "R linear model failed: {}".format(e)
         logging.exception(msg)
         raise RuntimeError(msg)
+    finally:
+        if transport == 'fifo':
+            _close_fifo(fifo_writer, input_binary_file)
 
     # Read in the pvalue and t-statistic results.
     # The start of the binary file will contain values from the line level call
@@ -123,8 +149,10 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
         print(f'Linear model file from R not found {e}')
         raise FileNotFoundError('Cannot find LM output'.format(e))
 
-    if not DEBUGGING:
-        os.remove(input_binary_file)
+    # Files in shared memory are always removed as they are taking up RAM
+    if not DEBUGGING or transport == 'shm':
+        if transport != 'fifo':
+            os.remove(input_binary_file)
         os.remove(groups_file)
 
         if two_way:
@@ -144,26 +172,337 @@ def _numpy_to_dat(mat: np.ndarray, outfile: str):
     """
     Convert a numpy array to a binary file for reading in by R
 
+    The file has a header of two unsigned ints (rows, columns) followed by the data as float64 in column-major order,
+    which is how R lays out a matrix. The data are written with a single write from the array's buffer rather than
+    column by column.
+
     Parameters
     ----------
     mat
         the data to be send to r
     outfile
-        the tem file name to store the binary file
+        the tem file name to store the binary file. Can be a named pipe
 
 
     """
-    # mat = mat.as_matrix()
-    # create a binary file
+    # The transpose of a Fortran-ordered array is C-contiguous with the same buffer, so no copy is made if mat is
+    # already float64 in Fortran order
+    data = np.asfortranarray(mat, dtype=np.float64).T
+
     with open(outfile, 'wb') as binfile:
-    # and write out two integers with the row and column dimension
+        binfile.write(struct.pack('2I', mat.shape[0], mat.shape[1]))
+        binfile.write(memoryview(data).cast('B'))
+
+
+def _numpy_to_fifo(mat: np.ndarray, fifo_path: str) -> threading.Thread:
+    """
+    Create a named pipe and start writing the data to it in the same format as _numpy_to_dat.
+    Opening a pipe blocks until the reader (R) opens the other end, so the writing is done in a background thread.
+
+    Returns
+    -------
+    The writer thread. Pass to _close_fifo once R has finished
+    """
+    os.mkfifo(fifo_path)
+
+    def write():
+        try:
+            _numpy_to_dat(mat, fifo_path)
+        except BrokenPipeError:
+            logging.warning(f'R closed the data pipe {fifo_path} before all the data was written')
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+
+    return writer
+
+
+def _close_fifo(writer: threading.Thread, fifo_path: str):
+    """
+    Wait for the writer thread from _numpy_to_fifo to finish and remove the named pipe.
+    If R exited without reading all the data, the writer is still blocked. Drain the pipe to release it.
+    """
+    if writer.is_alive():
+        fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while writer.is_alive():
+                try:
+                    if not os.read(fd, 1 << 20):
+                        time.sleep(0.01)
+                except BlockingIOError:
+                    time.sleep(0.01)
+        finally:
+            os.close(fd)
+
+    writer.join()
+    os.remove(fifo_path)
+
+
+def lm_numpy(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bool = False,
+             use_staging: bool = True, two_way: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit the same linear models as lmFast.R, but in-process with NumPy/SciPy.
+
+    The line-level design matrix is QR-factorised once per line (the factorisation is cached across chunks) and all
+    voxels/labels in the chunk are solved as a single matrix right-hand side. The specimen-level models, which differ
+    from the baseline-only model by one row, are got from the baseline fit with rank-one updates rather than being
+    refitted, so the cost of a line is roughly one extra fit however many mutants it has.
+
+    Parameters
+    ----------
+    See lm_r. plot_dir and boxcox are accepted for compatibility but are not used (lmFast.R ignores them as well)
+
+    Returns
+    -------
+    Same layout as lm_r
+        one-way
+            1D arrays. The line-level results followed by the results for each mutant specimen
+        two_way
+            2D arrays. Rows: genotype, treatment and interaction effects. Columns as for one-way but the specimen-level
+            results are for the interaction (mutant-treatment) specimens only
+
+    Notes
+    -----
+    As in lmFast.R, the absolute values of the data are modelled and the t-statistics are sign-flipped so they
+    refer to the mutant (and treated) group
+    """
+    y = np.abs(np.asarray(data, dtype=np.float64))
+
+    x, terms = _design_matrix(info, use_staging, two_way)
+
+    if two_way:
+        spec_rows = np.flatnonzero(((info.genotype == 'mutant') & (info.treatment == 'treatment')).values)
+    else:
+        spec_rows = np.flatnonzero((info.genotype == 'mutant').values)
+
+    baseline_rows = tuple(np.setdiff1d(np.arange(len(info)), spec_rows))
+    x_bytes = x.tobytes()
+
+    line_fit = _factorise_design(x_bytes, x.shape, tuple(range(len(info))))
+    p, t = _ols(line_fit, y, terms)
+    p_results = [p]
+    t_results = [t]
+
+    # The specimen-level models (baselines plus one specimen) are rank-one updates of the baseline-only model
+    baseline_pinv, updates = _specimen_updates(x_bytes, x.shape, baseline_rows, tuple(spec_rows))
+    baseline_coefs = baseline_pinv @ y[list(baseline_rows)]
+    baseline_residuals = y[list(baseline_rows)] - x[list(baseline_rows)] @ baseline_coefs
+    baseline_rss = np.einsum('ij,ij->j', baseline_residuals, baseline_residuals)
+    del baseline_residuals
+
+    for r, update in zip(spec_rows, updates):
+        if update is None:
+            # The update can't be used if the specimen's design is rank-deficient. Do a full fit instead
+            rows = baseline_rows + (r,)
+            p, t = _ols(_factorise_design(x_bytes, x.shape, rows), y[list(rows)], terms)
+        else:
+            p, t = _ols_add_row(update, baseline_coefs, baseline_rss, x[r], y[r], terms)
+        p_results.append(p)
+        t_results.append(t)
+
+    # columns: line-level followed by each specimen
+    p_all = np.hstack(p_results).astype(np.float32)
+    t_all = np.negative(np.hstack(t_results)).astype(np.float32)
+
+    if not two_way:
+        p_all = p_all[0]
+        t_all = t_all[0]
+
+    return p_all, t_all
+
+
+def _design_matrix(info: pd.DataFrame, use_staging: bool, two_way: bool) -> Tuple[np.ndarray, List[int]]:
+    """
+    Make the design matrix that R's lm() would create from the groups file using its default treatment contrasts.
+    The first level (alphabetically) of each factor is the reference level, so the genotype coefficient is the effect
+    of 'wildtype' and the treatment coefficient the effect of 'vehicle'.
+
+    Returns
+    -------
+    0: The design matrix (specimens x coefficients)
+    1: Column indices of the coefficients reported. genotype or genotype, treatment and interaction for two-way
+    """
+
+    def treatment_contrast(col: pd.Series) -> np.ndarray:
+        levels = sorted(col.unique())
+        if len(levels) > 2:
+            raise ValueError(f'{col.name} should have two levels at most. Found {levels}')
+        # A single level gives a column of zeros, which is dropped in the QR as it would be in R
+        return (col == levels[-1]).values.astype(np.float64) if len(levels) == 2 else np.zeros(len(col))
+
+    columns = [np.ones(len(info)), treatment_contrast(info['genotype'])]
+    terms = [1]
+
+    if two_way:
+        columns.append(treatment_contrast(info['treatment']))
+        terms.append(2)
+
+    if use_staging:
+        columns.append(info['staging'].values.astype(np.float64))
+
+    if two_way:
+        # R puts the interaction after all the main effects
+        columns.append(columns[1] * columns[2])
+        terms.append(len(columns) - 1)
+
+    return np.column_stack(columns), terms
+
+
+@lru_cache(maxsize=64)
+def _factorise_design(x_bytes: bytes, shape: Tuple[int, int], rows: Tuple[int, ...]) -> Tuple:
+    """
+    QR-factorise the design matrix for a set of rows.
+    Takes hashable arguments so that the factorisation is only done once per line and reused for each data chunk.
+
+    Returns
+    -------
+    Q
+    R^-1
+    the coefficient indices that are estimable (R's pivoting)
+    the residual degrees of freedom
+    """
+    x = np.frombuffer(x_bytes, dtype=np.float64).reshape(shape)[list(rows)]
+    q, r, pivot = linalg.qr(x, mode='economic', pivoting=True)
+
+    # Drop aliased coefficients using the same tolerance as lm()
+    diag = np.abs(np.diag(r))
+    rank = int(np.sum(diag > 1e-7 * diag[0])) if diag.size and diag[0] > 0 else 0
+
+    r_inv = linalg.solve_triangular(r[:rank, :rank], np.eye(rank))
+
+    return q[:, :rank], r_inv, pivot[:rank], x.shape[0] - rank
+
+
+@lru_cache(maxsize=8)
+def _specimen_updates(x_bytes: bytes, shape: Tuple[int, int], baseline_rows: Tuple[int, ...],
+                      spec_rows: Tuple[int, ...]) -> Tuple[np.ndarray, List]:
+    """
+    Precompute what is needed to get each specimen-level fit (baselines plus one specimen) as a rank-one update of
+    the baseline-only fit.
+
+    If A = Xb'Xb for the baseline design Xb and x is the specimen's design row, the specimen-level model has
+    G = (A + xx')^-1 and coefficients b + Gx(y - x'b), where b is a least-squares solution of the baseline model.
+    Its residual sum of squares is RSSb + k(y - x'b)^2 with k = (Gx)'A(Gx) + (1 - x'Gx)^2. When the baseline design
+    is full rank this is the Sherman–Morrison update. When the specimen's row is not estimable from the baselines
+    (one mutant and only wildtype baselines for example) the specimen is fitted exactly and k is 0.
+
+    Returns
+    -------
+    0: pseudo-inverse of the baseline design, to get b
+    1: For each specimen either None (rank-deficient, needs a full fit) or a tuple of
+        Gx
+        diagonal of G
+        k
+        residual degrees of freedom
+    """
+    x = np.frombuffer(x_bytes, dtype=np.float64).reshape(shape)
+    xb = x[list(baseline_rows)]
+    a = xb.T @ xb
+
+    updates = []
+
+    for r in spec_rows:
+        xr = x[r]
+        rank = np.linalg.matrix_rank(np.vstack((xb, xr)))
+
+        if rank < shape[1]:
+            updates.append(None)
+            continue
+
+        # Sherman–Morrison if the baseline-only design is of full rank. A direct inverse otherwise as A is singular
+        if np.linalg.matrix_rank(xb) == shape[1]:
+            a_inv = np.linalg.inv(a)
+            a_inv_x = a_inv @ xr
+            g = a_inv - np.outer(a_inv_x, a_inv_x) / (1 + xr @ a_inv_x)
+        else:
+            g = np.linalg.inv(a + np.outer(xr, xr))
 
-        header = struct.pack('2I', mat.shape[0], mat.shape[1])
-        binfile.write(header)
-        # then loop over columns and write each
-        for i in range(mat.shape[1]):
-            data = struct.pack('%id' % mat.shape[0], *mat[:, i])
-            binfile.write(data)
+        gx = g @ xr
+        k = gx @ a @ gx + (1 - xr @ gx) ** 2
+        updates.append((gx, np.diag(g).copy(), k, len(baseline_rows) + 1 - rank))
+
+    return np.linalg.pinv(xb), updates
+
+
+def _ols(fit: Tuple, y: np.ndarray, terms: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solve a factorised linear model for all columns of y at once
+
+    Parameters
+    ----------
+    fit
+        An entry from _factorise_design
+    y
+        The data. rows: specimens, columns: voxels/labels
+    terms
+        The coefficients to return the statistics for
+
+    Returns
+    -------
+    p-values and t-statistics. rows: terms, columns: voxels/labels
+    """
+    q, r_inv, pivot, df = fit
+
+    qty = q.T @ y
+    coefs = r_inv @ qty
+    residuals = y - q @ qty
+
+    # The diagonal of (X'X)^-1 for the estimable coefficients
+    unscaled = np.einsum('ij,ij->i', r_inv, r_inv)
+
+    p = np.full((len(terms), y.shape[1]), np.nan)
+    t = np.full((len(terms), y.shape[1]), np.nan)
+
+    # Columns with no variance (all zeros for example) give NaNs, as they do from R
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resvar = np.einsum('ij,ij->j', residuals, residuals) / df
+
+        for i, term in enumerate(terms):
+            idx = np.flatnonzero(pivot == term)
+            if idx.size == 0:  # Aliased term. R reports NA
+                continue
+            j = idx[0]
+            t[i] = coefs[j] / np.sqrt(unscaled[j] * resvar)
+            p[i] = 2 * stats.t.sf(np.abs(t[i]), df)
+
+    return p, t
+
+
+def _ols_add_row(update: Tuple, baseline_coefs: np.ndarray, baseline_rss: np.ndarray, x: np.ndarray, y: np.ndarray,
+                 terms: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the statistics for the baseline model plus one specimen using an update from _specimen_updates
+
+    Parameters
+    ----------
+    update
+        An entry from _specimen_updates
+    baseline_coefs
+        Least squares coefficients of the baseline-only model. rows: coefficients, columns: voxels/labels
+    baseline_rss
+        Residual sum of squares of the baseline-only model
+    x
+        The design row of the specimen
+    y
+        The data for the specimen
+    terms
+        The coefficients to return the statistics for
+
+    Returns
+    -------
+    p-values and t-statistics. rows: terms, columns: voxels/labels
+    """
+    gx, g_diag, k, df = update
+
+    error = y - x @ baseline_coefs
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resvar = (baseline_rss + k * error ** 2) / df
+        coefs = baseline_coefs[terms] + np.outer(gx[terms], error)
+        t = coefs / np.sqrt(np.outer(g_diag[terms], resvar))
+        p = 2 * stats.t.sf(np.abs(t), df)
+
+    return p, t
 
 
 def lm_sm(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=False, use_staging: bool=True):
@@ -207,4 +546,18 @@ def lm_sm(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=
     p_all = np.array(pvals)
     t_all = np.negative(np.array(tvals))  # The tvaue for genotype[T.mut] is what we want
 
-    return p_all, t_all
\ No newline at end of file
+    return p_all, t_all
+
+
+# The functions that can be used as Stats.stats_runner. Selected with the 'lm_engine' stats config option
+LM_ENGINES = {
+    'numpy': lm_numpy,
+    'R': lm_r
+}
+
+# Peak memory used by each engine when fitting a chunk of data, as a multiple of the chunk's size as float64.
+# Used to size the chunks (LineData.chunk_size)
+LM_MEMORY_OVERHEAD = {
+    'numpy': 6,  # float64 copy of the data, baseline rows, residuals and fitted values
+    'R': 10  # R's copies of the data plus the lm() fit objects for the line and the specimens
+}
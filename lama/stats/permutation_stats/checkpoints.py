@@ -0,0 +1,173 @@
+"""
+Checkpoints for the stages of the permutation stats pipeline (run_permutation_stats.run) so that a run can be resumed
+without redoing the permutations.
+
+Each stage's DataFrames are saved to one .npz file named by the stage and a key, which is a hash of everything the
+stage depends on (the input data, QC file, seed and number of permutations). The frames are stored column by column as
+numpy arrays rather than CSV, so floats are saved exactly and loading is fast. JSON-serialisable DataFrame.attrs are
+kept.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Union, Tuple
+
+import numpy as np
+import pandas as pd
+from logzero import logger as logging
+
+
+def stage_key(*parts) -> str:
+    """
+    Make a key from strings, numbers or None
+    """
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()[:16]
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    h = hashlib.sha1(repr([str(c) for c in df.columns]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def file_hash(path: Union[Path, None]) -> Union[str, None]:
+    if path is None:
+        return None
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()
+
+
+class StageCheckpoints:
+    def __init__(self, root_dir: Path):
+        """
+        Parameters
+        ----------
+        root_dir
+            Where to store the checkpoints. Made if it does not exist
+        """
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, stage: str, key: str) -> Path:
+        return self.root_dir / f'{stage}_{key}.npz'
+
+    def load(self, stage: str, key: str) -> Union[List[pd.DataFrame], None]:
+        """
+        Returns
+        -------
+        The stage's DataFrames or None if there is no checkpoint for this key
+        """
+        path = self._path(stage, key)
+        if not path.is_file():
+            return None
+        try:
+            frames = read_frames(path)
+        except (ValueError, OSError, KeyError) as e:  # Truncated or otherwise corrupt file
+            logging.warning(f'Ignoring unreadable checkpoint {path}: {e}')
+            return None
+        logging.info(f'Loaded {stage} checkpoint {path.name}')
+        return frames
+
+    def save(self, stage: str, key: str, frames: List[pd.DataFrame]):
+        """
+        Write to a temporary file first so a crash can't leave a partial checkpoint
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                write_frames(fh, frames)
+            os.replace(tmp_path, self._path(stage, key))
+        except OSError as e:
+            logging.warning(f'Could not write the {stage} checkpoint: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def latest(self, stage: str, key: str, below: int) -> Union[Tuple[int, List[pd.DataFrame]], None]:
+        """
+        Find the checkpoint for key_<n> with the largest n under 'below'. For extending the null distributions, where
+        n is the number of permutations
+
+        Returns
+        -------
+        (n, the stage's DataFrames) or None if there is no such checkpoint
+        """
+        found = []
+        for path in self.root_dir.glob(f'{stage}_{key}_*.npz'):
+            n = path.stem.rsplit('_', 1)[1]
+            if n.isdigit() and int(n) < below:
+                found.append(int(n))
+
+        for n in sorted(found, reverse=True):
+            frames = self.load(stage, f'{key}_{n}')
+            if frames is not None:
+                return n, frames
+        return None
+
+
+def write_frames(fh, frames: List[pd.DataFrame]):
+    """
+    Save DataFrames to an .npz file, column by column
+    """
+    arrays = {'num_frames': np.array(len(frames))}
+
+    for i, df in enumerate(frames):
+        prefix = f'{i}/'
+        _encode(arrays, f'{prefix}index', df.index.to_numpy())
+        _encode(arrays, f'{prefix}columns', df.columns.to_numpy())
+        arrays[f'{prefix}index_name'] = np.array(json.dumps(df.index.name))
+
+        for j, col in enumerate(df.columns):
+            _encode(arrays, f'{prefix}col{j}', df.iloc[:, j].to_numpy())
+
+        attrs = {}
+        for name, value in df.attrs.items():
+            try:
+                attrs[name] = json.loads(json.dumps(value))
+            except TypeError:
+                pass  # Not serialisable, such as profiling info
+        arrays[f'{prefix}attrs'] = np.array(json.dumps(attrs))
+
+    np.savez(fh, **arrays)
+
+
+def read_frames(path: Path) -> List[pd.DataFrame]:
+    with np.load(path, allow_pickle=False) as arrays:
+        frames = []
+        for i in range(int(arrays['num_frames'])):
+            prefix = f'{i}/'
+            index = pd.Index(_decode(arrays, f'{prefix}index'), name=json.loads(str(arrays[f'{prefix}index_name'])))
+            columns = _decode(arrays, f'{prefix}columns')
+
+            df = pd.DataFrame({j: _decode(arrays, f'{prefix}col{j}') for j in range(len(columns))}, index=index)
+            df.columns = columns
+            df.attrs = json.loads(str(arrays[f'{prefix}attrs']))
+            frames.append(df)
+    return frames
+
+
+def _encode(arrays: dict, name: str, values: np.ndarray):
+    """
+    Add a column to arrays. Numeric columns are saved as they are. Object columns (strings, or mixed such as the
+    'NA' entries of the thresholds) are saved as strings with a code for the type of each entry
+    """
+    if values.dtype.kind in 'biufc':
+        arrays[name] = values
+    else:
+        codes = np.array(['n' if v is None or (isinstance(v, float) and np.isnan(v)) else
+                          'i' if isinstance(v, (int, np.integer)) and not isinstance(v, bool) else
+                          'f' if isinstance(v, (float, np.floating)) else
+                          's' for v in values])
+        arrays[name] = np.array(['' if c == 'n' else str(v) for v, c in zip(values, codes)], dtype=str)
+        arrays[f'{name}.codes'] = codes
+
+
+def _decode(arrays, name: str) -> np.ndarray:
+    values = arrays[name]
+    if f'{name}.codes' not in arrays:
+        return values
+
+    types = {'n': lambda v: np.nan, 'i': int, 'f': float, 's': str}
+    codes = arrays[f'{name}.codes']
+    return np.array([types[c](v) for v, c in zip(values, codes)], dtype=object)
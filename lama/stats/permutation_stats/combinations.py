@@ -0,0 +1,189 @@
+"""
+Random combinations of baselines to relabel as synthetic mutants for the permutation stats null distributions.
+
+RandomCombinations holds, for a set of baselines, a number of distinct combinations of each size k. They are sampled
+uniformly from all the possible k-subsets and are reproducible from a seed. Rather than a list of id tuples, the
+combinations are generated on demand as blocks of int32 rows of indices into the baseline ids.
+
+Random subsets are drawn in a fixed stream for each seed and size, and repeats are dropped. Where the number of
+possible k-subsets fits in an int64 the subsets are drawn as ranks and unranked with the combinatorial number system.
+Otherwise they are drawn directly and repeats are found from their packed bitsets. As the stream does not depend on the
+number of combinations, asking for more combinations gives the same first ones, so a null distribution can be extended
+(see the skip argument).
+"""
+
+import math
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+
+BLOCK_SIZE = 4096  # Combinations generated at a time
+MAX_RANK = 2 ** 62  # Above this number of possible combinations, sample by rejection
+
+
+class RandomCombinations:
+    def __init__(self, ids: pd.Index, counts: Dict[int, int], seed: int = 999, skip: Dict[int, int] = None):
+        """
+        Parameters
+        ----------
+        ids
+            The baseline ids to choose from
+        counts
+            {combination size: number of combinations}
+        seed
+            The same ids, counts and seed give the same combinations
+        skip
+            {combination size: number of combinations}. Leave out this many of the first combinations of each size, for
+            when they have already been used
+        """
+        self.ids = pd.Index(ids)
+        self.counts = {int(k): int(n) for k, n in sorted(counts.items())}
+        self.seed = seed
+        self.skip = {int(k): int(n) for k, n in (skip or {}).items() if n}
+
+        for k, n in self.skip.items():
+            if n > self.counts.get(k, 0):
+                raise ValueError(f'Cannot skip {n} of {self.counts.get(k, 0)} combinations of {k}')
+
+        for k, n in self.counts.items():
+            if n > math.comb(len(self.ids), k):
+                raise ValueError(f'Cannot make {n} combinations of {k} from {len(self.ids)} baselines')
+
+    def __len__(self) -> int:
+        return sum(self.counts.values()) - sum(self.skip.values())
+
+    def sizes(self) -> Dict[int, int]:
+        """
+        {combination size: number of combinations generated}, in the order they are generated
+        """
+        return {k: n - self.skip.get(k, 0) for k, n in self.counts.items()}
+
+    def __iter__(self) -> Iterator[Tuple]:
+        """
+        The combinations as tuples of baseline ids
+        """
+        for block in self.blocks():
+            for row in block:
+                yield tuple(self.ids[row[row >= 0]])
+
+    @property
+    def max_size(self) -> int:
+        return max(self.counts, default=0)
+
+    def blocks(self, block_size: int = BLOCK_SIZE) -> Iterator[np.ndarray]:
+        """
+        Generate the combinations, smallest first (leaving out the skipped ones)
+
+        Yields
+        ------
+        (up to block_size, max_size) int32 arrays of indices into self.ids. Rows of smaller combinations are padded
+        with -1
+        """
+        block = []
+        num_rows = 0
+        for k in self.counts:
+            to_skip = self.skip.get(k, 0)
+            for rows in self._sample(k):
+                if to_skip:
+                    skipped = rows[:to_skip]
+                    rows = rows[len(skipped):]
+                    to_skip -= len(skipped)
+                while len(rows):
+                    take = rows[:block_size - num_rows]
+                    rows = rows[len(take):]
+                    block.append(take)
+                    num_rows += len(take)
+
+                    if num_rows == block_size:
+                        yield self._pad(block)
+                        block = []
+                        num_rows = 0
+        if block:
+            yield self._pad(block)
+
+    def table(self) -> np.ndarray:
+        """
+        All the combinations in one (len(self), max_size) int32 array. See blocks()
+        """
+        if not len(self):
+            return np.empty((0, self.max_size), dtype=np.int32)
+        return np.concatenate(list(self.blocks()))
+
+    def _pad(self, block) -> np.ndarray:
+        out = np.full((sum(len(b) for b in block), self.max_size), -1, dtype=np.int32)
+        start = 0
+        for b in block:
+            out[start: start + len(b), :b.shape[1]] = b
+            start += len(b)
+        return out
+
+    def _sample(self, k: int) -> Iterator[np.ndarray]:
+        """
+        Yield blocks of the self.counts[k] distinct k-subsets, each row sorted
+        """
+        n = len(self.ids)
+        count = self.counts[k]
+        rng = np.random.default_rng([self.seed, k])
+        num_possible = math.comb(n, k)
+
+        if count == 0:
+            return
+
+        if num_possible <= MAX_RANK:
+            binomials = _binomial_table(n, k)
+            seen = np.empty(0, dtype=np.int64)
+            while len(seen) < count:
+                ranks = rng.integers(0, num_possible, BLOCK_SIZE)
+                # Keep the first draw of each rank not drawn before
+                _, first = np.unique(ranks, return_index=True)
+                ranks = ranks[np.sort(first)]
+                ranks = ranks[~np.isin(ranks, seen)][:count - len(seen)]
+                seen = np.concatenate([seen, ranks])
+                yield _unrank(ranks, binomials)
+        else:
+            # Repeats are very unlikely with this many possible combinations
+            seen = set()
+            done = 0
+            while done < count:
+                rows = np.sort(np.argpartition(rng.random((BLOCK_SIZE, n)), k - 1, axis=1)[:, :k], axis=1)
+                members = np.zeros((len(rows), n), dtype=bool)
+                members[np.arange(len(rows))[:, None], rows] = True
+                keep = []
+                for i, bits in enumerate(np.packbits(members, axis=1)):
+                    key = bits.tobytes()
+                    if key not in seen:
+                        seen.add(key)
+                        keep.append(i)
+                rows = rows[keep][:count - done].astype(np.int32)
+                done += len(rows)
+                yield rows
+
+
+def _binomial_table(n: int, k: int) -> np.ndarray:
+    """
+    (k + 1, n) table of C(v, i) for v in 0..n-1, clipped to int64
+    """
+    limit = np.iinfo(np.int64).max
+    return np.array([[min(math.comb(v, i), limit) for v in range(n)] for i in range(k + 1)], dtype=np.int64)
+
+
+def _unrank(ranks: np.ndarray, binomials: np.ndarray) -> np.ndarray:
+    """
+    Get the k-subsets with the given ranks in the combinatorial number system: rank = sum over i of C(c_i, i)
+    with c_k > ... > c_1
+
+    Returns
+    -------
+    (len(ranks), k) int32 array, each row ascending
+    """
+    k = binomials.shape[0] - 1
+    ranks = np.array(ranks, dtype=np.int64)
+    out = np.empty((len(ranks), k), dtype=np.int32)
+
+    for i in range(k, 0, -1):
+        # The largest v with C(v, i) <= rank. Each column of the table is non-decreasing
+        v = np.searchsorted(binomials[i], ranks, side='right') - 1
+        out[:, i - 1] = v
+        ranks -= binomials[i][v]
+    return out
@@ -28,17 +28,20 @@ p-values, tvalues could be obtained from the same call the lm() as in the standa
 """
 
 from os.path import expanduser
-from typing import Union, Tuple, List
+from typing import Union, Tuple, List, Dict
 import random
 from pathlib import Path
 import math
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import os
+import time
 
 import pandas as pd
 import numpy as np
 from scipy.special import comb
-import statsmodels.formula.api as smf
-from joblib import Parallel, delayed
+from scipy import stats
 import datetime
 from logzero import logger
 from tqdm import tqdm
@@ -46,80 +49,92 @@ import random
 import itertools
 
 from lama.stats.linear_model import lm_r, lm_sm
+from lama.stats.permutation_stats.combinations import RandomCombinations
 
 home = expanduser('~')
 
 
-def generate_random_combinations(data: pd.DataFrame, num_perms):
+def generate_random_combinations(data: pd.DataFrame, num_perms, seed: int = 999,
+                                 done: Dict[str, Dict[int, int]] = None) -> Dict[str, RandomCombinations]:
+    """
+    Get the combinations of baselines to relabel as synthetic mutants for each label's line-level null distribution.
+
+    The number of permutations is split between the mutant line sample sizes (for each label, not counting QC'd out
+    specimens) in proportion to how many lines have each sample size. Where there are fewer possible combinations of a
+    size than requested, the remainder is spread over the other sizes.
+
+    Parameters
+    ----------
+    data
+        index: specimen_id
+        columns: label columns, 'line' (baselines are 'baseline'), and optionally 'staging'
+    num_perms
+        number of permutations
+    seed
+        For reproducible combinations
+    done
+        {label: {sample size: number of combinations}} already used for a previous null distribution with the same
+        data and seed. If a label's new counts are all at least these, the combinations already used are skipped.
+        Otherwise all the label's combinations are made
+
+    Returns
+    -------
+    {label: RandomCombinations of the label's non-NaN baselines}. Labels with the same baselines and sample size
+    counts share the same RandomCombinations object
+
+    Raises
+    ------
+    ValueError
+        If there are fewer than num_perms possible combinations
+    """
     logger.info('generating permutations')
     data = data.drop(columns='staging', errors='ignore')
     line_specimen_counts = get_line_specimen_counts(data)
 
+    baselines = data[data.line == 'baseline']
+
     result = {}
+    shared = {}  # Labels with the same baselines and counts get the same combinations
+
     # now for each label calcualte number of combinations we need for each
     for label in line_specimen_counts:
-        label_indices_result = []
         counts = line_specimen_counts[label].value_counts()
+        counts = counts[counts.index != 0]  # Drop the lines with zero labels (have been qc'd out)
 
-        number_of_lines = counts[counts.index != 0].sum() # Drop the lines with zero labels (have been qc'd out)
-        ratios = counts[counts.index != 0] / number_of_lines
-        num_combs = num_perms * ratios
+        ratios = counts / counts.sum()
+        num_combs = np.ceil(num_perms * ratios).astype(int).sort_index()
 
         # get wt data for label
-        label_data = data[[label, 'line']]
-        label_data = label_data[label_data.line == 'baseline']
-        label_data = label_data[~label_data[label].isna()]
+        baseline_ids = baselines.index[baselines[label].notna()]
 
-        # Soret out the numnbers
-
-        # Sort out the numbers
-        records = []
-
-        for n, n_combs_to_try in num_combs.items():
-            n_combs_to_try = math.ceil(n_combs_to_try)
-            max_combs = int(comb(len(label_data), n))
-            # logger.info(f'max_combinations for n={n} and wt_n={len(label_data)} = {max_combs}')
-            records.append([n, n_combs_to_try, max_combs])
-        df = pd.DataFrame.from_records(records, columns=['n', 'num_combs', 'max_combs'], index='n').sort_index(ascending=True)
+        max_combs = pd.Series([math.comb(len(baseline_ids), n) for n in num_combs.index], index=num_combs.index)
 
         # test whether it's possible to have this number of permutations with data structure
-        print(f'Max combinations for label {label} is {df.max_combs.sum()}')
-        if num_perms > df.max_combs.sum():
-            raise ValueError(f'Max number of combinations is {df.max_combs.sum()}, you requested {num_perms}')
+        if num_perms > max_combs.sum():
+            raise ValueError(f'Max number of combinations for {label} is {max_combs.sum()}, you requested {num_perms}')
 
         # Now spread the overflow from any ns to other groups
         while True:
-            df['overflow'] = df.num_combs - df.max_combs  # Get the 'overflow' num permutations over maximumum unique
-            groups_full = df[df.overflow >= 0].index
-
-            df['overflow'][df['overflow'] < 0] = 0
-            extra = df[df.overflow > 0].overflow.sum()
-
-            df.num_combs -= df.overflow
+            overflow = (num_combs - max_combs).clip(lower=0)
+            extra = overflow.sum()
+            num_combs -= overflow
 
-            if extra < 1: # All combimation amounts have been distributed
+            not_full = num_combs < max_combs
+            if extra < 1 or not not_full.any():  # All combimation amounts have been distributed
                 break
+            num_combs[not_full] += math.ceil(extra / not_full.sum())
 
-            num_non_full_groups = len(df[df.overflow >= 0])
+        skip = (done or {}).get(label)
+        if skip and any(n > num_combs.get(k, 0) for k, n in skip.items()):
+            logger.info(f'Cannot extend the previous permutations for {label}. Redoing them')
+            skip = None
 
-            top_up_per_group = math.ceil(extra / num_non_full_groups)
-            for n, row in df.iterrows():
-                if n in groups_full:
-                    continue
-                # Add the topup amount
-                row.num_combs += top_up_per_group
+        key = (tuple(baseline_ids), tuple(num_combs.items()), tuple(sorted((skip or {}).items())))
+        if key not in shared:
+            shared[key] = RandomCombinations(baseline_ids, num_combs.to_dict(), seed, skip)
+        result[label] = shared[key]
 
-        # now generate the indices
-        indx = label_data.index
-        for n, row in df.iterrows():
-
-            combs_gen = itertools.combinations(indx, n)
-            for i, combresult in enumerate(combs_gen):
-                if i == row.num_combs:
-                    break
-                label_indices_result.append(combresult)
-
-        result[label] = label_indices_result
+    logger.info(f'{len(shared)} sets of combinations for {len(result)} labels')
     return result
 
 
@@ -176,7 +191,9 @@ def get_line_specimen_counts(input_data: pd.DataFrame) -> pd.DataFrame:
 
 
 def null(input_data: pd.DataFrame,
-         num_perm: int,) -> Tuple[pd.DataFrame, pd.DataFrame, List]:
+         num_perm: int,
+         seed: int = 999,
+         previous: Tuple[pd.DataFrame, pd.DataFrame] = None) -> Tuple[pd.DataFrame, pd.DataFrame, List]:
     """
     Generate null distributions for line and specimen-level data
 
@@ -191,10 +208,16 @@ def null(input_data: pd.DataFrame,
 
     num_perm
         number of permutations
+    seed
+        Seed for the combinations of synthetic mutants
+    previous
+        The line and specimen-level null distributions from a run with fewer permutations on the same data and seed.
+        The permutations already done are reused and only the extra ones are calculated
 
     Returns
     -------
-    line-level null distribution
+    line-level null distribution. attrs['combination_sizes'] has the number of permutations of each synthetic
+        mutant sample size for each label, which is needed to extend it
     specimen-level null distribution
 
 
@@ -202,7 +225,7 @@ def null(input_data: pd.DataFrame,
     -----
     Labels must not start with a digit as R will throw a wobbly
     """
-    random.seed(999)
+    random.seed(seed)
 
     # Use the generic staging label from now on
     input_data.rename(columns={'crl': 'staging', 'volume': 'staging'}, inplace=True)
@@ -218,15 +241,21 @@ def null(input_data: pd.DataFrame,
     # Get the line specimen n numbers. Keep the first column
     # line_specimen_counts = get_line_specimen_counts(input_data)
     # Pregenerate all the combinations
-    wt_indx_combinations = generate_random_combinations(input_data, num_perm)
+    done = None
+    if previous is not None:
+        prev_sizes = previous[0].attrs['combination_sizes']
+        done = {label: {int(k): int(n) for k, n in prev_sizes[label.strip('x')].items()}
+                for label in label_names if label.strip('x') in prev_sizes}
+
+    wt_indx_combinations = generate_random_combinations(input_data, num_perm, seed, done)
 
     # Split data into a numpy array of raw data and dataframe for staging and genotype fpr the LM code
     data = baselines.drop(columns=['staging', 'line']).values
     info = baselines[['staging', 'line']]
 
     # Get the specimen-level null distribution. i.e. the distributuion of p-values obtained from relabelling each
-    # baseline once. Loop over each specimen and set to 'synth_hom'
-    for index, _ in info.iterrows():
+    # baseline once. Loop over each specimen and set to 'synth_hom'. This does not depend on the number of permutations
+    for index, _ in ([] if previous is not None else info.iterrows()):
         info.loc[:, 'genotype'] = 'wt'               # Set all genotypes to WT
         info.loc[[index], 'genotype'] = 'synth_hom'  # Set the ith baseline to synth hom
         row = data[info.index.get_loc(index), :]
@@ -251,31 +280,100 @@ def null(input_data: pd.DataFrame,
 
         spec_p.append(p)
 
-    spec_df = pd.DataFrame.from_records(spec_p, columns=label_names)
+    if previous is not None:
+        spec_df = previous[1][[label.strip('x') for label in label_names]].copy()
+        spec_df.columns = label_names
+    else:
+        spec_df = pd.DataFrame.from_records(spec_p, columns=label_names)
 
     line_df = null_line(wt_indx_combinations, baselines, num_perm)
 
+    if previous is not None:
+        line_df = _merge_null_line(line_df, previous[0], wt_indx_combinations)
+
+    line_df.attrs['combination_sizes'] = {label.strip('x'): combs.counts
+                                          for label, combs in wt_indx_combinations.items()}
+
     return strip_x([line_df, spec_df])
 
 
+def _merge_null_line(new: pd.DataFrame, previous: pd.DataFrame, combinations: Dict[str, RandomCombinations]) \
+        -> pd.DataFrame:
+    """
+    Combine the line-level null p-values from the new permutations with those from a previous run.
+
+    The null of each label has the permutations for each synthetic mutant sample size in turn. The previous
+    permutations are the first ones of each size (RandomCombinations.skip)
+
+    Parameters
+    ----------
+    new
+        The null from the new permutations
+    previous
+        The previous null (with labels stripped of their 'x' prefix)
+    combinations
+        The RandomCombinations used for the new permutations
+    """
+    merged = {}
+    for label in new:
+        combs = combinations[label]
+        old_p = previous[label.strip('x')].to_numpy() if combs.skip else np.empty(0)
+        new_p = new[label].to_numpy()
+
+        parts = []
+        old_start = new_start = 0
+        for k, count in combs.counts.items():
+            num_old = combs.skip.get(k, 0)
+            parts.append(old_p[old_start: old_start + num_old])
+            parts.append(new_p[new_start: new_start + count - num_old])
+            old_start += num_old
+            new_start += count - num_old
+        merged[label] = pd.Series(np.concatenate(parts))
+
+    merged = pd.DataFrame(merged, columns=new.columns)
+    merged.attrs = new.attrs
+    return merged
+
+
+# Tile size for null_line. Each worker task is the permutations of a block of labels with the same specimens
+TILE_PERMUTATIONS = 2000
+TILE_LABELS = 16
+
+# The shared arrays and label groups for the null_line tiles. Set in each worker by _attach_null_line_data
+_null_line_data = {}
+
+
 def null_line(wt_indx_combinations: dict,
               data: pd.DataFrame,
-              num_perms=1000) -> pd.DataFrame:
+              num_perms=1000,
+              num_workers: int = None) -> pd.DataFrame:
     """
     Generate pvalue null distributions for all labels in 'data'
-    NaN values are excluded potentailly resultnig in different sets of specimens for each label. This makes it tricky to
-    use Rs vectorised lm() function, so we use statsmodels here and just loop over the data, with each label in its own
-    process using joblib.
+
+    Each permutation relabels a combination of baselines as synthetic mutants and fits
+    label ~ genotype + staging. Rather than fitting each permutation with statsmodels, the genotype of every permutation
+    is a row of an indicator matrix and all the permutations for a block of labels are solved with a few matrix
+    products (see _null_line_pvalues).
+
+    NaN values are excluded potentailly resultnig in different sets of specimens for each label. Labels are grouped
+    by their set of non-NaN specimens (and their combinations of synthetic mutants) so each group has the same design.
+
+    The work is split into tiles of up to TILE_LABELS labels from one group by TILE_PERMUTATIONS permutations, which
+    are run on a pool of processes. The label data, the combinations (as integer rows into the data) and the results
+    are in shared memory so only the tile bounds are sent to the workers. The per-tile timings are in the returned
+    DataFrame's attrs['tile_timings'].
 
     Parameters
     ----------
-    line_specimen_counts
-        The number of specimens in each mutant line. Used to specify the number of synthetic mutants so the null
-        matches our data in terms of sample number
+    wt_indx_combinations
+        {label: combinations of baseline ids to relabel as synthetic mutants}. RandomCombinations from
+        generate_random_combinations, or sequences of tuples of ids
     data
-        Label data in each column except last 2 which are 'staging' and 'genotype'
+        Label data in each column except last 2 which are 'staging' and 'line'
     num_perms
         Usually about 10000
+    num_workers
+        Number of processes to run the tiles on. Defaults to the number of CPUs. If 1, run in this process
 
     Returns
     -------
@@ -285,66 +383,247 @@ def null_line(wt_indx_combinations: dict,
     -----
     If QC has been applied to the data, we may have some NANs
     """
-
-    def prepare(label):
-        return data[[label, 'staging', 'genotype']]
-
     data = data.rename(columns={'line': 'genotype'})
 
     starttime = datetime.datetime.now()
 
     cols = list(data.drop(['staging', 'genotype'], axis='columns').columns)
 
-    # Run each label on a thread
-    pdists = Parallel(n_jobs=-1)(delayed(_null_line_thread)
-                                 (prepare(i), num_perms, wt_indx_combinations, i) for i in tqdm(cols))
-
-    line_pdsist_df = pd.DataFrame(pdists).T
-    line_pdsist_df.columns = cols
+    values = data[cols].to_numpy(dtype=float)
+    staging = data['staging'].to_numpy(dtype=float)
+
+    # Group the labels that have the same specimens and synthetic mutant combinations
+    groups = {}
+    for i, label in enumerate(cols):
+        valid = ~np.isnan(values[:, i]) & ~np.isnan(staging)
+        combs = wt_indx_combinations[label]
+        key = (valid.tobytes(), combs if isinstance(combs, RandomCombinations) else tuple(combs))
+        groups.setdefault(key, []).append(i)
+
+    # Encode each group's combinations as rows of specimen indices into the data, padded with -1, in one table
+    group_info = []
+    comb_tables = []
+    offset = 0
+    for (valid, combs), label_idx in groups.items():
+        comb_tables.append(_encode_combinations(combs, data.index))
+        group_info.append((np.frombuffer(valid, dtype=bool), np.array(label_idx), offset, len(combs)))
+        offset += len(combs)
+
+    max_comb_size = max([t.shape[1] for t in comb_tables], default=0)
+    comb_table = np.full((offset, max_comb_size), -1, dtype=np.int32)
+    for (_, _, start, num), table in zip(group_info, comb_tables):
+        comb_table[start: start + num, :table.shape[1]] = table
+
+    max_perms = max([num for *_, num in group_info], default=0)
+    result = np.full((max_perms, len(cols)), np.nan)
+
+    tiles = []
+    for g, (valid, label_idx, _, num) in enumerate(group_info):
+        for l_start in range(0, len(label_idx), TILE_LABELS):
+            for p_start in range(0, num, TILE_PERMUTATIONS):
+                tiles.append((g, l_start, min(l_start + TILE_LABELS, len(label_idx)),
+                              p_start, min(p_start + TILE_PERMUTATIONS, num)))
+    # Biggest first so the small tiles fill in at the end
+    tiles.sort(key=lambda t: -(t[2] - t[1]) * (t[4] - t[3]) * np.count_nonzero(group_info[t[0]][0]))
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(tiles)))
+
+    logger.info(f'Null distributions for {len(cols)} labels in {len(groups)} groups of labels with the same specimens: '
+                f'{len(tiles)} tiles on {num_workers} workers')
+
+    arrays = {'values': values, 'staging': staging, 'combinations': comb_table, 'result': result}
+
+    if num_workers == 1:
+        _null_line_data.update(arrays, groups=group_info)
+        try:
+            timings = [_null_line_tile(tile) for tile in tqdm(tiles)]
+        finally:
+            _null_line_data.clear()
+    else:
+        shared = {}
+        try:
+            for name, array in arrays.items():
+                shared[name] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, array.dtype, buffer=shared[name].buf)[:] = array
+            specs = {name: (shared[name].name, array.shape, array.dtype) for name, array in arrays.items()}
+
+            with ProcessPoolExecutor(num_workers, initializer=_attach_null_line_data,
+                                     initargs=(specs, group_info)) as pool:
+                futures = [pool.submit(_null_line_tile, tile) for tile in tiles]
+                timings = [f.result() for f in tqdm(as_completed(futures), total=len(futures))]
+
+            result[:] = np.ndarray(result.shape, result.dtype, buffer=shared['result'].buf)
+        finally:
+            for shm in shared.values():
+                shm.close()
+                shm.unlink()
+
+    # Labels with fewer permutations are padded with NaN
+    line_pdsist_df = pd.DataFrame(result, columns=cols)
+
+    tile_timings = pd.DataFrame.from_records(timings, columns=['group', 'num_specimens', 'num_labels',
+                                                               'num_perms', 'seconds', 'pid'])
+    line_pdsist_df.attrs['tile_timings'] = tile_timings
 
     endtime = datetime.datetime.now()
     elapsed = endtime - starttime
+    logger.info(f'Null tiles took {tile_timings.seconds.sum():.1f}s of compute. '
+                f'Slowest tile {tile_timings.seconds.max():.2f}s, mean {tile_timings.seconds.mean():.2f}s')
     print(f'Time taken for null distribution calculation: {elapsed}')
     return line_pdsist_df
 
 
-def _null_line_thread(*args) -> List[float]:
+def _encode_combinations(combs: Union[RandomCombinations, Tuple[Tuple]], specimen_ids: pd.Index) -> np.ndarray:
     """
-    Create a null distribution for a single label.  This can put put onto a thread or process
+    Get the combinations of baseline ids as a (num combinations, largest combination) array of row indices into
+    specimen_ids, padded with -1
+
+    Parameters
+    ----------
+    combs
+        RandomCombinations or a sequence of tuples of baseline ids
+    specimen_ids
+    """
+    if isinstance(combs, RandomCombinations):
+        rows = specimen_ids.get_indexer(combs.ids)
+        table = combs.table()
+        return np.where(table >= 0, rows[table], -1).astype(np.int32)
+
+    lengths = np.array([len(c) for c in combs], dtype=int)
+    table = np.full((len(combs), lengths.max(initial=0)), -1, dtype=np.int32)
+
+    rows = np.repeat(np.arange(len(combs)), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    table[rows, cols] = specimen_ids.get_indexer(list(itertools.chain.from_iterable(combs)))
+    return table
+
+
+def _synthetic_mutant_matrix(comb_table: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    Make the genotype indicator matrix for a list of permutations
+
+    Parameters
+    ----------
+    comb_table
+        For each permutation, the rows of the baselines relabelled as synthetic mutants. See _encode_combinations
+    valid
+        Mask of the specimens in the model. Rows in comb_table that are not valid are ignored
 
     Returns
     -------
-    pvalue distribution
+    (num permutations, num valid specimens) array. 1 where a specimen is a synthetic mutant
     """
-    data, num_perms, wt_indx_combinations, label = args
-    print('Generating null for', label)
+    valid_row = np.where(valid, np.cumsum(valid) - 1, -1)  # Data row to row in the valid specimens
 
-    label = data.columns[0]
+    rows = np.repeat(np.arange(len(comb_table)), comb_table.shape[1])
+    comb = comb_table.ravel()  # May be a view of the shared table, so is not changed
+    cols = np.where(comb >= 0, valid_row[np.maximum(comb, 0)], -1)
+    keep = cols >= 0
 
-    data = data.astype({label: np.float,
-                        'staging': np.float})
+    mutants = np.zeros((len(comb_table), np.count_nonzero(valid)))
+    mutants[rows[keep], cols[keep]] = 1
+    return mutants
 
-    synthetics_sets_done = []
 
-    line_p = []
+def _attach_null_line_data(specs: dict, groups: List):
+    """
+    null_line worker initialiser. Attach to the shared arrays
 
-    perms_done = 0
+    Parameters
+    ----------
+    specs
+        {array name: (shared memory name, shape, dtype)}
+    groups
+        The label groups: (valid specimen mask, label indices, offset into the combinations, number of combinations)
+    """
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _null_line_data[f'{name}_shm'] = shm  # Keep the mapping open
+        _null_line_data[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+    _null_line_data['groups'] = groups
+
+
+def _null_line_tile(tile: Tuple[int, int, int, int, int]) -> Tuple:
+    """
+    Get the null p-values for a tile of labels and permutations and write them into the shared result array
+
+    Parameters
+    ----------
+    tile
+        (group index, first and last+1 label within the group, first and last+1 permutation)
+
+    Returns
+    -------
+    The tile timing: group index, number of specimens, labels and permutations, seconds, process id
+    """
+    start = time.perf_counter()
+
+    g, l_start, l_stop, p_start, p_stop = tile
+    valid, label_idx, offset, _ = _null_line_data['groups'][g]
+    label_idx = label_idx[l_start: l_stop]
+
+    combs = _null_line_data['combinations'][offset + p_start: offset + p_stop]
+    mutants = _synthetic_mutant_matrix(combs, valid)
+    y = _null_line_data['values'][valid][:, label_idx]
+
+    p = _null_line_pvalues(y, _null_line_data['staging'][valid], mutants)
+    _null_line_data['result'][p_start: p_stop, label_idx] = p
+
+    return g, len(y), len(label_idx), p_stop - p_start, time.perf_counter() - start, os.getpid()
+
+
+def _null_line_pvalues(y: np.ndarray, staging: np.ndarray, mutants: np.ndarray) -> np.ndarray:
+    """
+    Get the genotype p-values of y ~ genotype + staging for every permutation (synthetic mutant labelling) and label.
+
+    By Frisch-Waugh-Lovell, the genotype coefficient is that of the regression of the labels on the genotype indicator
+    after both are residualised on the intercept and staging. With M the residualising projection and g a permutation's
+    indicator:
+        beta = g'My / g'Mg
+        RSS = y'My - beta * g'My
+    and as M is the same for all permutations, these need only g'(My) and the projection of g onto [1, staging].
+
+    Parameters
+    ----------
+    y
+        (num specimens, num labels). No NaNs
+    staging
+        (num specimens,)
+    mutants
+        (num permutations, num specimens) genotype indicators. See _synthetic_mutant_matrix
+
+    Returns
+    -------
+    (num permutations, num labels) p-values. The same as statsmodels' for the genotype term
+    """
+    n = len(staging)
+
+    # Orthonormal basis of the intercept and staging columns. Rank 1 if the staging is constant
+    z = np.column_stack([np.ones(n), staging])
+    u, s, _ = np.linalg.svd(z, full_matrices=False)
+    q = u[:, s > s[0] * 1e-10]
+
+    ry = y - q @ (q.T @ y)  # Label residuals after intercept and staging
+    ryy = (ry ** 2).sum(axis=0)
+
+    gy = mutants @ ry
+    gg = mutants.sum(axis=1) - ((mutants @ q) ** 2).sum(axis=1)
 
-    # Get combinations of WT indices for current label
-    indxs = wt_indx_combinations[label]
-    for comb in indxs:
-        data.loc[:, 'genotype'] = 'wt'
-        data.loc[data.index.isin(comb), 'genotype'] = 'synth_hom'
-        # _label_synthetic_mutants(data, n, synthetics_sets_done)
+    df = n - q.shape[1] - 1
 
-        perms_done += 1
+    # The genotype is collinear with the intercept and staging if all or no specimens are mutant
+    gg[gg <= 1e-10 * n] = np.nan
+    if df < 1:
+        return np.full(gy.shape, np.nan)
 
-        model = smf.ols(formula=f'{label} ~ C(genotype) + staging', data=data, missing='drop')
-        fit = model.fit()
-        p = fit.pvalues['C(genotype)[T.wt]']
+    beta = gy / gg[:, None]
+    rss = np.clip(ryy - gy * beta, 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = beta / np.sqrt(rss / df / gg[:, None])
 
-        line_p.append(p)
-    return line_p
+    return 2 * stats.t.sf(np.abs(t), df)
 
 
 def _label_synthetic_mutants(info: pd.DataFrame, n: int, sets_done: List) -> bool:
@@ -409,6 +688,12 @@ def alternative(input_data: pd.DataFrame,
     """
     Generate alterntive (mutant) distributions for line and pecimen-level data
 
+    Each line, and each mutant specimen, is fitted with the baselines as label ~ genotype + staging. With a genotype
+    term the model has an intercept for the baselines and one for the mutants and a shared staging slope, so the
+    genotype effect and its standard error only need the count, means and centred sums of squares and products of each
+    group (see _genotype_effect). The baseline statistics are calculated once and those of all the lines and
+    specimens together, for all labels.
+
     Parameters
     ----------
     input_data
@@ -423,92 +708,120 @@ def alternative(input_data: pd.DataFrame,
         2: line-level t-values
         3: specimen-level t-values
     """
-
-    # Group by line and sequntaily run
-    info_columns = ['staging', 'line', 'genotype']  # Columns of non-organ volumes in input_data
-
-    line_groupby = input_data.groupby('line')
-
     label_names = list(input_data.drop(['staging', 'line'], axis='columns').columns)
 
-    baseline = input_data[input_data['line'] == 'baseline']
-    baseline.loc[:, 'genotype'] = 'wt'
+    y = input_data[label_names].to_numpy(dtype=float)
+    staging = input_data['staging'].to_numpy(dtype=float)
+    is_baseline = (input_data['line'] == 'baseline').to_numpy()
 
-    alt_line_pvalues = []
-    alt_spec_pvalues = []
-    alt_line_t = []
-    alt_spec_t = []
+    baseline_stats = _group_stats(y[is_baseline], staging[is_baseline], np.zeros(is_baseline.sum(), dtype=int), 1)
 
-    # Get line-level alternative distributions
-    for line_id, line_df in line_groupby:
+    mutants = input_data[~is_baseline]
+    mut_y = y[~is_baseline]
+    mut_staging = staging[~is_baseline]
 
-        if line_id == 'baseline':
-            continue
+    # Labels where all a line's (or a specimen's) values are null or zero (i.e. QC-flagged) get NaN p and t-values
+    has_value = (mut_y != 0) & ~np.isnan(mut_y)
 
-        line_df.loc[:, 'genotype'] = 'hom'
-        line_df.drop(['line'], axis=1)
+    # Get line-level alternative distributions
+    line_ids, line_idx = np.unique(mutants['line'].to_numpy(dtype=str), return_inverse=True)
+    line_stats = _group_stats(mut_y, mut_staging, line_idx, len(line_ids))
+    line_p, line_t = _genotype_effect(baseline_stats, line_stats)
 
-        df_wt_mut = pd.concat([baseline, line_df])
+    line_has_value = np.zeros((len(line_ids), len(label_names)), dtype=bool)
+    np.logical_or.at(line_has_value, line_idx, has_value)
+    line_p[~line_has_value] = np.nan
+    line_t[~line_has_value] = np.nan
 
-        # Lm code needs daatpoints in numpy array and genotype+staging in dataframe
-        data_df = df_wt_mut.drop(columns=info_columns)
+    ### Get specimen-level alternative distributions ###
+    spec_stats = _group_stats(mut_y, mut_staging, np.arange(len(mutants)), len(mutants))
+    spec_p, spec_t = _genotype_effect(baseline_stats, spec_stats)
+    spec_p[~has_value] = np.nan
+    spec_t[~has_value] = np.nan
 
-        # Get columns (labels) where all speciemns have null values (i.e. all the line is QC-flagged at these labels)
-        labels_to_skip = [col for col, isany in line_df.any().iteritems() if not isany]
-        if labels_to_skip:
-            # Set the whole label column to zero. R:lm() will return NaN for this column
-            data_df[labels_to_skip] = 0.0
+    # result dataframes have either line or specimen in index then labels
+    line_index = pd.Index(line_ids, name='line')
+    spec_index = pd.Index(mutants.index, name='specimen')
 
-        # Get a numpy array of the organ volumes
-        data = data_df.values
+    alt_line_df = pd.DataFrame(line_p, index=line_index, columns=label_names)
+    alt_spec_df = pd.DataFrame(spec_p, index=spec_index, columns=label_names)
+    alt_spec_df.insert(0, 'line', mutants['line'].to_numpy())
 
-        info = df_wt_mut[['staging', 'line', 'genotype']]
+    alt_line_t_df = pd.DataFrame(line_t, index=line_index, columns=label_names)
+    alt_spec_t_df = pd.DataFrame(spec_t, index=spec_index, columns=label_names)
 
-        p: np.array
-        t: np.array
+    return strip_x([alt_line_df, alt_spec_df, alt_line_t_df, alt_spec_t_df])
 
-        p, t = lm_sm(data, info)  # returns p_values for all organs, 1 iteration
 
-        res_p = [line_id] + list(p)  # line_name, label_1, label_2 ......
-        alt_line_pvalues.append(res_p)
+def _group_stats(y: np.ndarray, staging: np.ndarray, group: np.ndarray, num_groups: int) -> dict:
+    """
+    Get the statistics of each group of specimens needed for the genotype effect. NaN values are excluded, for each
+    label, as with statsmodels' missing='drop'
 
-        res_t = [line_id] + list(t)
-        alt_line_t.append(res_t)
+    Parameters
+    ----------
+    y
+        (num specimens, num labels)
+    staging
+        (num specimens,)
+    group
+        The group index of each specimen
+    num_groups
 
-    ### Get specimen-level alternative distributions ###
-    mutants = input_data[input_data['line'] != 'baseline']
-    # baselines = input_data[input_data['line'] == 'baseline']
-    for specimen_id, row in mutants.iterrows():
-        row['genotype'] = 'hom'
-        line_id = row['line']
-        df_wt_mut = baseline.append(row)
-        data_df = df_wt_mut.drop(columns=['line', 'genotype', 'staging'])
+    Returns
+    -------
+    (num groups, num labels) arrays of
+        n: number of specimens
+        mean_x, mean_y: mean staging and label value
+        sxx, sxy, syy: centred sums of squares and products
+    """
+    valid = ~np.isnan(y) & ~np.isnan(staging)[:, None]
 
-        # Get columns (labels) where the mutant specimen (as it's line level)
-        # has a null value (i.e. This specimen is QC-flagged at these labels)
-        labels_to_skip = [col for col, isany in pd.DataFrame(row).T.any().iteritems() if not isany]
-        if labels_to_skip:
-            # Set the whole label column to zero. R:lm() will return NaN for this column
-            data_df[labels_to_skip] = 0.0
+    members = np.zeros((num_groups, len(staging)))
+    members[group, np.arange(len(staging))] = 1
 
-        data = data_df.values
+    n = members @ valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = (members @ np.where(valid, staging[:, None], 0)) / n
+        mean_y = (members @ np.where(valid, y, 0)) / n
 
-        info = df_wt_mut[['genotype', 'staging']]
+    dx = np.where(valid, staging[:, None] - mean_x[group], 0)
+    dy = np.where(valid, y - mean_y[group], 0)
 
-        p, t = lm_sm(data, info)  # returns p_values for all organs, 1 iteration
-        res_p = [line_id, specimen_id] + list(p)
-        alt_spec_pvalues.append(res_p)
+    return {'n': n, 'mean_x': mean_x, 'mean_y': mean_y,
+            'sxx': members @ (dx * dx), 'sxy': members @ (dx * dy), 'syy': members @ (dy * dy)}
 
-        res_t = [specimen_id] + list(t)
-        alt_spec_t.append(res_t)
 
-    # result dataframes have either line or specimen in index then labels
-    alt_line_df = pd.DataFrame.from_records(alt_line_pvalues, columns=['line'] + label_names, index='line')
-    alt_spec_df = pd.DataFrame.from_records(alt_spec_pvalues, columns=['line', 'specimen'] + label_names,
-                                            index='specimen')
+def _genotype_effect(wt: dict, mut: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the p and t-values of the genotype term of label ~ genotype + staging for baselines and mutants.
+    This is an analysis of covariance: the staging slope is from the pooled within-group sums and the genotype effect
+    is the difference in the intercepts.
 
-    alt_line_t_df = pd.DataFrame.from_records(alt_line_t, columns=['line'] + label_names, index='line')
-    alt_spec_t_df = pd.DataFrame.from_records(alt_spec_t, columns=['specimen'] + label_names,
-                                            index='specimen')
+    Parameters
+    ----------
+    wt
+        _group_stats of the baselines (1, num labels)
+    mut
+        _group_stats of the mutant groups (num groups, num labels)
 
-    return strip_x([alt_line_df, alt_spec_df, alt_line_t_df, alt_spec_t_df])
+    Returns
+    -------
+    p-values and t-values (num groups, num labels). The t-values are for mutant - baseline, as from lm_sm
+    """
+    sxx = wt['sxx'] + mut['sxx']
+    sxy = wt['sxy'] + mut['sxy']
+    syy = wt['syy'] + mut['syy']
+    df = wt['n'] + mut['n'] - 3
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx
+        effect = (mut['mean_y'] - slope * mut['mean_x']) - (wt['mean_y'] - slope * wt['mean_x'])
+
+        rss = np.clip(syy - slope * sxy, 0, None)
+        var = rss / df * (1 / wt['n'] + 1 / mut['n'] + (wt['mean_x'] - mut['mean_x']) ** 2 / sxx)
+        t = effect / np.sqrt(var)
+        t[df < 1] = np.nan
+
+    p = 2 * stats.t.sf(np.abs(t), df)
+    return p, t
@@ -19,6 +19,9 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
     Given a wild type null distribution of p-values and a alternative (mutant)  distribution
     find the largest p-value threshold that would give a FDR < 0.05
 
+    Each label's null and alternative p-values are sorted once and the FDR at every candidate threshold (all the
+    p-values <= 0.05) is found from the counts under the threshold with np.searchsorted, for all labels together.
+
     Parameters
     ----------
     null_dist
@@ -41,75 +44,84 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
             num_null, num_null_<=_thresh, num_alt, num_alt_<=_thresh]
 
     """
-    results = []
-
-    # Prevent overwriting originals
-    null_dist = null_dist.copy()
-    alt_dist = alt_dist.copy()
-
-    for label in null_dist:
-
-        wt_pvals = null_dist[label].values
-        mut_pvals = alt_dist[label].values
-
-        # Debugging
-        wt_pvals.sort()
-        mut_pvals.sort()
-
-        # Merge the p-values together get a list of available thresholds to use
-        all_p = list(wt_pvals) + list(mut_pvals)
-
-        all_p.sort()
-
-        pthresh_fdrs = []
-
-        # For every available p-value from the null + alternative distributions, That is lower than 0.05
-        # get the associated FDR for that threshold
-
-        all_p = [x for x in all_p if x <= 0.05]
-        for p_to_test in all_p:
-
-            fdr_at_thresh = fdr_calc(wt_pvals, mut_pvals, p_to_test)
-
-            if fdr_at_thresh is not None:
-                pthresh_fdrs.append((p_to_test, fdr_at_thresh))
-
-        # Create a DataFrame of p-value thresholds and associated FDRs
-        p_fdr_df = pd.DataFrame.from_records(pthresh_fdrs, columns=['p', 'fdr'])
-
-        if len(p_fdr_df) > 0:
-
-            p_under_target_fdr = p_fdr_df[p_fdr_df.fdr <= target_threshold]
-
-            if len(p_under_target_fdr) < 1:
-                # No acceptable p-value threshold for this label. Choose minimum fdr.
-                lowest_fdr_row = p_fdr_df.loc[p_fdr_df['fdr'].idxmin()]
-                p_thresh = lowest_fdr_row['p']
-                best_fdr = lowest_fdr_row['fdr']
-            else:
-                row = p_fdr_df.loc[p_under_target_fdr.p.idxmax()]
-                p_thresh = row['p']
-                best_fdr = row['fdr']
-
-            # Total number of paramerters across all lines that are below our p-value threshold
-            num_hits = len(mut_pvals[mut_pvals <= p_thresh])
-
-            num_null = len(wt_pvals)
-            num_alt = len(mut_pvals)
-
-            num_null_lt_thresh = len(wt_pvals[wt_pvals <= p_thresh])
-            # num_alt_lt_thresh = len(mut_pvals[mut_pvals <= p_thresh])
+    labels = list(null_dist.columns)
+    null = null_dist.to_numpy(dtype=float)
+    alt = alt_dist[labels].to_numpy(dtype=float)
+    num_null, num_alt = len(null), len(alt)
+
+    # Replace the p-values with their rank among all the p-values so that each label's values can be offset into
+    # their own range and all the labels sorted and searched together, exactly. NaNs get the highest rank
+    uniq, ranks = np.unique(np.concatenate([null.ravel(), alt.ravel()]), return_inverse=True)
+    null_ranks = ranks[:null.size].reshape(null.shape)
+    alt_ranks = ranks[null.size:].reshape(alt.shape)
+
+    offsets = np.arange(len(labels)) * (len(uniq) + 1)
+    null_keys = np.sort((null_ranks + offsets).T.ravel())
+    alt_keys = np.sort((alt_ranks + offsets).T.ravel())
+
+    def count(keys, num_per_label, label_idx, rank, side):
+        """Number of a label's values < uniq[rank] (side='left') or <= uniq[rank] (side='right')"""
+        return np.searchsorted(keys, rank + offsets[label_idx], side=side) - label_idx * num_per_label
+
+    def fdr_at(label_idx, rank):
+        """fdr_calc for each label and p-value threshold. NaN where there are no mutants under the threshold"""
+        ratio_wt_under_thresh = count(null_keys, num_null, label_idx, rank, 'left') / num_null
+        ratio_mut_under_threshold = count(alt_keys, num_alt, label_idx, rank, 'left') / num_alt
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fdr = np.clip(ratio_wt_under_thresh / ratio_mut_under_threshold, 0, 1)
+        fdr[ratio_mut_under_threshold == 0] = np.nan
+        return fdr
+
+    # For every available p-value from the null + alternative distributions, That is lower than 0.05
+    # get the associated FDR for that threshold
+    cand_label, cand_rank = [], []
+    for dist, dist_ranks in ((null, null_ranks), (alt, alt_ranks)):
+        rows, cols = np.nonzero(dist <= 0.05)
+        cand_label.append(cols)
+        cand_rank.append(dist_ranks[rows, cols])
+    cand_label = np.concatenate(cand_label)
+    cand_rank = np.concatenate(cand_rank)
+
+    cand_fdr = fdr_at(cand_label, cand_rank)
+    has_fdr = ~np.isnan(cand_fdr)
+    cand_label, cand_rank, cand_fdr = cand_label[has_fdr], cand_rank[has_fdr], cand_fdr[has_fdr]
+    cand_p = uniq[cand_rank]
+
+    # The largest p-value threshold with an FDR under the target
+    under_target = cand_fdr <= target_threshold
+    max_p_under_target = np.full(len(labels), -np.inf)
+    np.maximum.at(max_p_under_target, cand_label[under_target], cand_p[under_target])
+
+    # No acceptable p-value threshold for this label. Choose minimum fdr (the lowest p-value if there are ties)
+    min_fdr = np.full(len(labels), np.inf)
+    np.minimum.at(min_fdr, cand_label, cand_fdr)
+    at_min_fdr = cand_fdr == min_fdr[cand_label]
+    p_at_min_fdr = np.full(len(labels), np.inf)
+    np.minimum.at(p_at_min_fdr, cand_label[at_min_fdr], cand_p[at_min_fdr])
+
+    has_candidates = np.bincount(cand_label, minlength=len(labels)) > 0
+    label_idx = np.flatnonzero(has_candidates)
+    p_thresh = np.where(np.isfinite(max_p_under_target), max_p_under_target, p_at_min_fdr)[label_idx]
+    p_thresh_rank = np.searchsorted(uniq, p_thresh)
+
+    best_fdr = np.full(len(labels), np.nan)
+    num_hits = np.zeros(len(labels), dtype=int)
+    num_null_lt_thresh = np.zeros(len(labels), dtype=int)
+    best_fdr[label_idx] = fdr_at(label_idx, p_thresh_rank)
+    # Total number of paramerters across all lines that are below our p-value threshold
+    num_hits[label_idx] = count(alt_keys, num_alt, label_idx, p_thresh_rank, 'right')
+    num_null_lt_thresh[label_idx] = count(null_keys, num_null, label_idx, p_thresh_rank, 'right')
+    p_thresh_all = np.full(len(labels), np.nan)
+    p_thresh_all[label_idx] = p_thresh
 
+    results = []
+    for i, label in enumerate(labels):
+        if has_candidates[i]:
+            results.append([int(label), p_thresh_all[i], best_fdr[i],
+                            num_null, num_null_lt_thresh[i], num_alt, num_hits[i]])
         else:
-            best_fdr = 1
-            p_thresh = np.NAN
-            num_hits = 0
-            num_null, num_null_lt_thresh, num_alt = ['NA'] * 3
-
-
-        # TODO: what about if the labels are not numbers
-        results.append([int(label), p_thresh, best_fdr,
-                        num_null, num_null_lt_thresh, num_alt, num_hits])
+            # TODO: what about if the labels are not numbers
+            results.append([int(label), np.nan, 1, 'NA', 'NA', 'NA', 0])
 
     header = ['label', 'p_thresh', 'fdr',
               'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
@@ -41,6 +41,8 @@ annotate
 
 from pathlib import Path
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
 
 import pandas as pd
 import numpy as np
@@ -51,15 +53,16 @@ import yaml
 from lama import common
 from lama.stats.permutation_stats import distributions
 from lama.stats.permutation_stats import p_thresholds
+from lama.stats.permutation_stats.checkpoints import StageCheckpoints, stage_key, frame_hash, file_hash
 from lama.paths import specimen_iterator, get_specimen_dirs, LamaSpecimenData
 from lama.qc.organ_vol_plots import make_plots, pvalue_dist_plots
 from lama.common import write_array, read_array, init_logging, LamaDataException
-from lama.stats.common import cohens_d
 from lama.stats.penetrence_expressivity_plots import heatmaps_for_permutation_stats
 
 GENOTYPE_P_COL_NAME = 'genotype_effect_p_value'
 PERM_SIGNIFICANT_COL_NAME = 'significant_cal_p'
 PERM_T_COL_NAME = 't'
+SEED = 999
 
 
 def write_specimen_info(wt_wev, mut_wev, outfile):
@@ -171,7 +174,8 @@ def annotate(thresholds: pd.DataFrame,
              write_thresholded_inv_labels=False,
              fdr_threshold: float=0.05,
              t_values: pd.DataFrame=None,
-             organ_volumes: pd.DataFrame=None) -> pd.DataFrame:
+             organ_volumes: pd.DataFrame=None,
+             num_workers: int = None) -> pd.DataFrame:
     """
     Using the p_value thresholds and the linear model p-value results,
     create the following CSV files
@@ -197,6 +201,8 @@ def annotate(thresholds: pd.DataFrame,
          same format as lm_results but with t-statistics
     organ_volumes
         All the organ volumes for baselines and mutants (as it was used in lm(), so probably normalised to whole embryo
+    num_workers
+        Number of threads for writing the thresholded label maps. Defaults to ThreadPoolExecutor's default
 
     Returns
     -------
@@ -209,116 +215,192 @@ def annotate(thresholds: pd.DataFrame,
     """
     hit_dataframes = []
 
+    label_voxels = None
     if label_map:
         label_map = read_array(label_map)
+        label_voxels = label_voxel_lookup(label_map) if write_thresholded_inv_labels else None
 
-    # Iterate over each line or specimen (for line or specimen-level analysis)
-    for id_, row in lm_results.iterrows():
+    vol_ratios = effect_sizes = None
+    if organ_volumes is not None:
+        vol_ratios, effect_sizes = line_volume_effects(organ_volumes)
 
-        # Create a dataframe containing a p-value column. each row an organ
-        df = row.to_frame()
+    label_map_writes = []
+    # Leaving the with block waits for the label map writes, including when an error is raised in the loop
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        # Iterate over each line or specimen (for line or specimen-level analysis)
+        for id_, row in lm_results.iterrows():
 
-        if not is_line_level:
-            # specimen-level has an extra line column we need to remove
-            df = df.T.drop(columns=['line']).T
+            # Create a dataframe containing a p-value column. each row an organ
+            df = row.to_frame()
 
-        # Rename the line_specimen column to be more informative
-        df.rename(columns={id_: GENOTYPE_P_COL_NAME}, inplace=True)
+            if not is_line_level:
+                # specimen-level has an extra line column we need to remove
+                df = df.T.drop(columns=['line']).T
 
-        if is_line_level:
-            line = id_
-        else:
-            line = row['line']
-            spec_id = id_
+            # Rename the line_specimen column to be more informative
+            df.rename(columns={id_: GENOTYPE_P_COL_NAME}, inplace=True)
 
-        # Merge the permutation results (p-thresh, fdr, number of hit lines for this label) with the mutant results
-        df.index = df.index.astype(np.int64)  # Index needs to be cast from object to enable merge
-        df = df.merge(thresholds, left_index=True, right_index=True, validate='1:1')
-        df.index.name = 'label'
+            if is_line_level:
+                line = id_
+            else:
+                line = row['line']
+                spec_id = id_
 
-        # Merge the t-statistics
-        if t_values is not None:
-            t_df = pd.DataFrame(t_values.loc[id_])
+            # Merge the permutation results (p-thresh, fdr, number of hit lines for this label) with the mutant results
+            df.index = df.index.astype(np.int64)  # Index needs to be cast from object to enable merge
+            df = df.merge(thresholds, left_index=True, right_index=True, validate='1:1')
+            df.index.name = 'label'
 
-            if t_df.shape[1] != 1:  # We get multiple columns f there are duplicate specimen/line ids
-                raise ValueError("Duplicate specimen names not allowed")
+            # Merge the t-statistics
+            if t_values is not None:
+                t_df = pd.DataFrame(t_values.loc[id_])
 
-            t_df.columns = ['t']
-            t_df.drop(columns=['line'], errors='ignore', inplace=True)  # this is for speciem-level results
+                if t_df.shape[1] != 1:  # We get multiple columns f there are duplicate specimen/line ids
+                    raise ValueError("Duplicate specimen names not allowed")
 
-            t_df.index = t_df.index.astype(np.int64)
+                t_df.columns = ['t']
+                t_df.drop(columns=['line'], errors='ignore', inplace=True)  # this is for speciem-level results
 
-            df = df.merge(t_df, left_index=True, right_index=True, validate='1:1')
-            if len(df) < 1:
-                logging.info(f'skipping {id_} no hits')  # Should we continue at this point?
+                t_df.index = t_df.index.astype(np.int64)
 
-        # Add mean organ vol difference and cohens d
-        df['mean_vol_ratio'] = None
-        if is_line_level:
-            df['cohens_d'] = None
+                df = df.merge(t_df, left_index=True, right_index=True, validate='1:1')
+                if len(df) < 1:
+                    logging.info(f'skipping {id_} no hits')  # Should we continue at this point?
 
-        for label, row in df.iterrows():
-            # Organ vols are prefixed with x so it can work with statsmodels
-            label_col = f'x{label}'
-            label_organ_vol = organ_volumes[[label_col, 'line']]
-            wt_ovs = label_organ_vol[label_organ_vol.line == 'baseline'][f'x{label}']
-            mut_ovs = label_organ_vol[label_organ_vol.line == line][f'x{label}']
+            # Add mean organ vol difference and cohens d
+            if vol_ratios is not None:
+                label_cols = [f'x{label}' for label in df.index]  # Organ vols are prefixed with x so it can work with statsmodels
+                df['mean_vol_ratio'] = vol_ratios.loc[line, label_cols].to_numpy()
+                if is_line_level:
+                    df['cohens_d'] = effect_sizes.loc[line, label_cols].to_numpy()
 
-            df.loc[label, 'mean_vol_ratio'] =  mut_ovs.mean() / wt_ovs.mean()
-            if is_line_level:
-                cd = cohens_d(mut_ovs,wt_ovs)
-                df.loc[label, 'cohens_d'] = cd
+            output_name = f'{id_}_organ_volumes_{str(date.today())}.csv'
 
-        output_name = f'{id_}_organ_volumes_{str(date.today())}.csv'
+            line_output_dir = lines_root_dir / line
+            line_output_dir.mkdir(exist_ok=True)
 
-        line_output_dir = lines_root_dir / line
-        line_output_dir.mkdir(exist_ok=True)
+            if not is_line_level:
+                # If dealing with specimen-level stats, make subfolder to put results in
+                line_output_dir = line_output_dir / 'specimen_level' / id_
+                line_output_dir.mkdir(parents=True, exist_ok=True)
 
-        if not is_line_level:
-            # If dealing with specimen-level stats, make subfolder to put results in
-            line_output_dir = line_output_dir / 'specimen_level' / id_
-            line_output_dir.mkdir(parents=True, exist_ok=True)
+            output_path = line_output_dir / output_name
 
-        output_path = line_output_dir / output_name
+            add_significance(df, fdr_threshold)
 
-        add_significance(df, fdr_threshold)
+            if label_info:
+                df = add_label_names(df, label_info)
 
-        if label_info:
-            df = add_label_names(df, label_info)
+            df.to_csv(output_path)
 
-        df.to_csv(output_path)
+            hit_df = df[df['significant_cal_p'] == True]
+            hit_df['line'] = line
 
-        hit_df = df[df['significant_cal_p'] == True]
-        hit_df['line'] = line
+            if not is_line_level:
+                hit_df['specimen'] = spec_id
 
-        if not is_line_level:
-            hit_df['specimen'] = spec_id
+            hit_dataframes.append(hit_df)
 
-        hit_dataframes.append(hit_df)
+            hit_labels_out = line_output_dir / f'{line}__hit_labels.nrrd'
 
-        hit_labels_out = line_output_dir / f'{line}__hit_labels.nrrd'
+            hits = hit_df.index
 
-        hits = hit_df.index
+            if write_thresholded_inv_labels and label_map is not None and len(hits) > 0:
+                label_map_writes.append(pool.submit(_write_thresholded_label_map, label_map, hits, hit_labels_out,
+                                                    label_voxels))
 
-        if write_thresholded_inv_labels:
-            _write_thresholded_label_map(label_map, hits, hit_labels_out)
+        # Raise any error from the workers
+        for write in label_map_writes:
+            write.result()
 
     collated_df = pd.concat(hit_dataframes)
     return collated_df
 
 
-def _write_thresholded_label_map(label_map: np.ndarray, hits, out: Path):
+def line_volume_effects(organ_volumes: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compare the organ volumes of each line with the baselines, for all lines and labels at once
+
+    Parameters
+    ----------
+    organ_volumes
+        As passed to annotate. Organ volume columns are prefixed with x. The 'line' column has 'baseline' for the
+        baselines
+
+    Returns
+    -------
+    mean volume ratio (mutant mean / baseline mean) and cohens d (see lama.stats.common.cohens_d). Each is indexed by
+    line (including 'baseline') with a column for each x-prefixed label
+    """
+    label_cols = [c for c in organ_volumes.columns if c.startswith('x')]
+    groups = organ_volumes.groupby('line')[label_cols]
+
+    # As with cohens_d, means and stds skip missing values but the group sizes include them
+    means = groups.mean()
+    variances = groups.var(ddof=1)
+    sizes = groups.size()
+
+    wt_mean = means.loc['baseline']
+    wt_var = variances.loc['baseline']
+    wt_size = sizes.loc['baseline']
+
+    vol_ratios = means / wt_mean
+
+    dof = sizes + wt_size - 2
+    pooled_var = variances.mul(sizes - 1, axis=0).add((wt_size - 1) * wt_var, axis=1).div(dof, axis=0)
+    effect_sizes = (means - wt_mean) / np.sqrt(pooled_var)
+
+    return vol_ratios, effect_sizes
+
+
+def label_voxel_lookup(label_map: np.ndarray) -> Dict[int, np.ndarray]:
+    """
+    Find the voxels of each label once so that label maps of a few labels can be made without scanning the whole atlas
+
+    Returns
+    -------
+    {label: indices into label_map.ravel()}, for the non-zero labels
+    """
+    flat = label_map.ravel()
+    voxels = np.flatnonzero(flat)
+    if flat.size <= np.iinfo(np.int32).max:
+        voxels = voxels.astype(np.int32)
+
+    order = np.argsort(flat[voxels], kind='stable')
+    voxels = voxels[order]
+    labels, starts = np.unique(flat[voxels], return_index=True)
+    ends = np.append(starts[1:], len(voxels))
+
+    return {int(label): voxels[start: end] for label, start, end in zip(labels, starts, ends)}
+
+
+def _write_thresholded_label_map(label_map: np.ndarray, hits, out: Path,
+                                 label_voxels: Dict[int, np.ndarray] = None):
     """
     Write a label map with only the 'hit' organs in it
+
+    Parameters
+    ----------
+    label_voxels
+        From label_voxel_lookup(label_map). If given, only the voxels of the hits are set rather than searching the
+        whole label map
     """
     if label_map is None:
         return
 
     if len(hits) > 0:
-        # Make a copy as it may be being used elsewhere
-        l = np.copy(label_map)
-        # Clear any non-hits
-        l[~np.isin(l, hits)] = 0
+        if label_voxels is None:
+            # Make a copy as it may be being used elsewhere
+            l = np.copy(label_map)
+            # Clear any non-hits
+            l[~np.isin(l, hits)] = 0
+        else:
+            l = np.zeros_like(label_map)
+            flat = l.reshape(-1)
+            for hit in hits:
+                voxels = label_voxels.get(int(hit))
+                if voxels is not None:
+                    flat[voxels] = hit
 
         write_array(l, out)
 
@@ -437,10 +519,14 @@ def run(wt_dir: Path,
         specimen_fdr: float = 0.2,
         normalise_to_whole_embryo: bool = True,
         qc_file: Path = None,
-        voxel_size: float = 1.0):
+        voxel_size: float = 1.0,
+        resume: bool = False):
     """
     Run the permutation-based stats pipeline
 
+    The null and alternative distributions and the thresholds are checkpointed in out_dir/distributions/checkpoints,
+    keyed by the input data, QC file, seed and number of permutations.
+
     Parameters
     ----------
     wt_dir
@@ -473,10 +559,13 @@ def run(wt_dir: Path,
         - label_name (optional)
     voxel_size
         For calcualting organ volumes
+    resume
+        Use the checkpoints from a previous run on the same data and skip the stages already done. If there is a null
+        distribution with fewer permutations, extend it rather than starting again
     """
     # Collate all the staging and organ volume data into csvs
     logging.info(common.git_log())
-    np.random.seed(999)
+    np.random.seed(SEED)
     init_logging(out_dir / 'stats.log')
     logging.info(f'Running {__name__} with following commands\n{common.command_line_agrs()}')
 
@@ -511,9 +600,22 @@ def run(wt_dir: Path,
     dists_out = out_dir / 'distributions'
     dists_out.mkdir(exist_ok=True)
 
+    checkpoints = StageCheckpoints(dists_out / 'checkpoints')
+    input_key = stage_key(frame_hash(data), file_hash(qc_file))
+    null_key = stage_key(input_key, SEED)
+
     # Get the null distributions
-    logging.info('Generating null distribution')
-    line_null, specimen_null = distributions.null(data, num_perms)
+    null_dists = checkpoints.load('null', f'{null_key}_{num_perms}') if resume else None
+    if null_dists:
+        line_null, specimen_null = null_dists
+    else:
+        previous = checkpoints.latest('null', null_key, num_perms) if resume else None
+        if previous:
+            logging.info(f'Extending the null distribution from {previous[0]} permutations')
+            previous = previous[1]
+        logging.info('Generating null distribution')
+        line_null, specimen_null = distributions.null(data, num_perms, SEED, previous)
+        checkpoints.save('null', f'{null_key}_{num_perms}', [line_null, specimen_null])
 
     # with open(dists_out / 'null_ids.yaml', 'w') as fh:
     #     yaml.dump(null_ids, fh)
@@ -526,8 +628,13 @@ def run(wt_dir: Path,
     specimen_null.to_csv(null_specimen_pvals_file)
 
     # Get the alternative p-value distribution (and t-values now (2 and 3)
-    logging.info('Generating alternative distribution')
-    line_alt, spec_alt, line_alt_t, spec_alt_t = distributions.alternative(data)
+    alt_dists = checkpoints.load('alternative', input_key) if resume else None
+    if alt_dists:
+        line_alt, spec_alt, line_alt_t, spec_alt_t = alt_dists
+    else:
+        logging.info('Generating alternative distribution')
+        line_alt, spec_alt, line_alt_t, spec_alt_t = distributions.alternative(data)
+        checkpoints.save('alternative', input_key, [line_alt, spec_alt, line_alt_t, spec_alt_t])
 
     line_alt_pvals_file = dists_out / 'alt_line_dist_pvalues.csv'
     spec_alt_pvals_file = dists_out / 'alt_specimen_dist_pvalues.csv'
@@ -536,8 +643,14 @@ def run(wt_dir: Path,
     line_alt.to_csv(line_alt_pvals_file)
     spec_alt.to_csv(spec_alt_pvals_file)
 
-    line_organ_thresholds = p_thresholds.get_thresholds(line_null, line_alt)
-    specimen_organ_thresholds = p_thresholds.get_thresholds(specimen_null, spec_alt)
+    thresholds_key = stage_key(null_key, num_perms, input_key)
+    thresholds = checkpoints.load('thresholds', thresholds_key) if resume else None
+    if thresholds:
+        line_organ_thresholds, specimen_organ_thresholds = thresholds
+    else:
+        line_organ_thresholds = p_thresholds.get_thresholds(line_null, line_alt)
+        specimen_organ_thresholds = p_thresholds.get_thresholds(specimen_null, spec_alt)
+        checkpoints.save('thresholds', thresholds_key, [line_organ_thresholds, specimen_organ_thresholds])
 
     line_thresholds_path = dists_out / 'line_organ_p_thresholds.csv'
     spec_thresholds_path = dists_out / 'specimen_organ_p_thresholds.csv'
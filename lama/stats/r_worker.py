@@ -0,0 +1,195 @@
+"""
+A pool of long-lived R processes that run the LAMA R scripts (lmFast.R).
+
+Starting Rscript and loading the libraries it needs can take seconds, and this was paid for every chunk sent to
+linear_model.lm_r. The workers (rscripts/r_worker.R) are started once, on first use,
+and each job (a script and its command line arguments) is sent to a free worker through its stdin.
+A worker that has died is restarted and the job tried again.
+
+lm_r calls run_rscript in place of running Rscript themselves. If the number of workers is set to 0, run_rscript
+falls back to starting a new Rscript process for each job.
+"""
+
+import atexit
+import queue
+import subprocess as sub
+import threading
+from typing import List, Union
+from pathlib import Path
+
+from logzero import logger as logging
+
+from lama import common
+
+WORKER_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'r_worker.R')
+
+# Number of R workers in the pool. 0 to start a new Rscript process for each job
+NUM_WORKERS = 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RWorkerCrash(Exception):
+    """
+    Raised when an R worker process exits or stops responding to jobs
+    """
+    pass
+
+
+class RWorker:
+    """
+    A single R process running r_worker.R
+    """
+    def __init__(self):
+        self.proc = None
+        self.start()
+
+    def start(self):
+        self.stop()
+        self.proc = sub.Popen(['Rscript', WORKER_SCRIPT], stdin=sub.PIPE, stdout=sub.PIPE, text=True, bufsize=1)
+
+        # Wait until the libraries have been loaded
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise RWorkerCrash('R worker failed to start')
+            if line.strip() == 'READY':
+                break
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def run(self, script: str, args: List[str]) -> str:
+        """
+        Send a job to the worker and wait for it to finish
+
+        Returns
+        -------
+        The reply from the worker: OK or ERROR <message>
+
+        Raises
+        ------
+        RWorkerCrash if the R process has died
+        """
+        job = '\t'.join([script] + args)
+
+        try:
+            self.proc.stdin.write(job + '\n')
+            self.proc.stdin.flush()
+            reply = self.proc.stdout.readline()
+        except OSError as e:  # BrokenPipeError if the worker has gone
+            raise RWorkerCrash(str(e))
+
+        if not reply:
+            raise RWorkerCrash(f'R worker exited with code {self.proc.poll()}')
+
+        return reply.strip()
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, sub.TimeoutExpired):
+            self.proc.kill()
+        self.proc = None
+
+
+class RWorkerPool:
+    """
+    Runs jobs on the first free R worker. Can be shared between threads
+    """
+    def __init__(self, num_workers: int = 1):
+        self.num_workers = num_workers
+        self._idle = queue.Queue()
+
+        logging.info(f'Starting {num_workers} R worker(s)')
+        for _ in range(num_workers):
+            self._idle.put(RWorker())
+
+    def run(self, script: str, args: List[str]):
+        """
+        Run a script on a worker.
+
+        Raises
+        ------
+        subprocess.CalledProcessError, as would be raised by a failing Rscript call, if the script raises an error or
+        the worker dies twice running the job
+        """
+        cmd = ['Rscript', script] + args
+        worker = self._idle.get()
+
+        try:
+            for attempt in range(2):
+                try:
+                    if not worker.is_alive():
+                        logging.warning('R worker is not running. Restarting it')
+                        worker.start()
+                    reply = worker.run(script, args)
+                    break
+                except RWorkerCrash as e:
+                    logging.warning(f'R worker crashed: {e}')
+                    worker.stop()
+                    if attempt:
+                        raise sub.CalledProcessError(1, cmd, output=str(e))
+        finally:
+            self._idle.put(worker)
+
+        if reply != 'OK':
+            raise sub.CalledProcessError(1, cmd, output=reply)
+
+    def shutdown(self):
+        for _ in range(self.num_workers):
+            self._idle.get().stop()
+
+
+def set_num_workers(num_workers: int):
+    """
+    Set the size of the R worker pool. Any running pool of a different size is shut down and a new one is started
+    when next needed
+    """
+    global NUM_WORKERS
+
+    with _pool_lock:
+        if num_workers != NUM_WORKERS:
+            _shutdown()
+        NUM_WORKERS = num_workers
+
+
+def get_pool() -> RWorkerPool:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = RWorkerPool(NUM_WORKERS)
+        return _pool
+
+
+def run_rscript(script: Union[str, Path], args: List):
+    """
+    Run an R script with command line arguments, on the worker pool if it's enabled
+
+    Raises
+    ------
+    subprocess.CalledProcessError if the script fails
+    """
+    script = str(script)
+    args = [str(x) for x in args]
+
+    if NUM_WORKERS < 1:
+        sub.check_output(['Rscript', script] + args)
+    else:
+        get_pool().run(script, args)
+
+
+def _shutdown():
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+atexit.register(_shutdown)
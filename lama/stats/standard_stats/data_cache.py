@@ -0,0 +1,95 @@
+"""
+An on-disk cache of the preprocessed (blurred and masked) voxel data used by the stats pipeline.
+
+Reading, blurring and masking each baseline volume is most of the time spent loading the data, and the baselines,
+mask, blur and voxel size rarely change between stats runs. Each specimen's masked float32 vector is saved as a .npy
+file named by a hash of everything that the preprocessing depends on:
+    - the data file path, its modification time and size
+    - the mask
+    - blur FWHM, voxel size and blur method
+    - the data type (intensity, jacobians)
+so a change to any of these is a cache miss rather than stale data. Cached vectors are memory mapped when read.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from logzero import logger as logging
+
+
+class VoxelDataCache:
+    def __init__(self, cache_dir: Path):
+        """
+        Parameters
+        ----------
+        cache_dir
+            Where to store the cached data. Made if it does not exist
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # The data loaders use the cache from multiple threads
+
+    @staticmethod
+    def mask_hash(mask: np.ndarray) -> str:
+        h = hashlib.sha1(str(mask.shape).encode())
+        h.update(np.ascontiguousarray(mask != False).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def key(data_path: Path, mask_hash: str, blur_fwhm: float, voxel_size: float, datatype: str,
+            blur_method: str = 'full') -> str:
+        """
+        Get the cache key for a specimen's preprocessed data
+        """
+        data_path = Path(data_path).resolve()
+        stat = data_path.stat()
+        ident = f'{data_path}|{stat.st_mtime_ns}|{stat.st_size}|{mask_hash}|{blur_fwhm}|{voxel_size}|{datatype}|{blur_method}'
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.npy'
+
+    def load(self, key: str) -> Union[np.ndarray, None]:
+        """
+        Returns
+        -------
+        The memory-mapped cached data or None if not cached
+        """
+        path = self._path(key)
+
+        data = None
+
+        if path.is_file():
+            try:
+                data = np.load(path, mmap_mode='r')
+            except (ValueError, OSError) as e:  # Truncated or otherwise corrupt file
+                logging.warning(f'Ignoring unreadable cache file {path}: {e}')
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return data
+
+    def save(self, key: str, data: np.ndarray):
+        """
+        Write the data to the cache. Written to a temporary file first so a crash can't leave a partial cache file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.save(fh, np.asarray(data, dtype=np.float32))
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f'Could not write to the data cache: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -23,6 +23,7 @@ from pathlib import Path
 from typing import Union, List, Iterator, Tuple, Iterable, Callable
 import math
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from addict import Dict
@@ -31,13 +32,12 @@ import pandas as pd
 import toml
 
 from lama import common
-from lama.img_processing.misc import blur
+from lama.img_processing.misc import blur_masked, mask_bounding_box, fwhm_to_sigma, GAUSSIAN_TRUNCATE
 from lama.paths import specimen_iterator
 
 import os
 import gc
 import sys
-import psutil
 
 GLCM_FILE_SUFFIX = '.npz'
 DEFAULT_FWHM = 100  # um
@@ -64,9 +64,9 @@ class LineData:
         Parameters
         ----------
         data
-            debug: It's a list of 1D arrays. Trying to save memory. The Vstack to create data was duplicating a lot
             2D np.ndarray
-                voxel_data
+                voxel_data. float32. Usually a view on the loader's store (see DataLoader._allocate), which may be
+                memory mapped and is shared by all lines
                     row: specimens
                     columns: data points
             pd.DataFrame
@@ -115,80 +115,84 @@ class LineData:
     def genotypes(self):
         return self.info.genotype
 
-    def get_num_chunks(self, log: bool=False):
+    @property
+    def num_points(self) -> int:
         """
-        Using the size of the data set and the available memory, get the number of chunks needed to analyse the data
-        without maxing out the memory.
+        The number of data points (voxels or labels) per specimen
+        """
+        return self.data.shape[1]
 
-        The overhead is quite large
-            First the data is written to a binary file for R to read in
-            Then there is the data (pvalues and t-statistics) output by R into another binary file
-            Plus any overhead R encounters when fitting the linear models
+    def chunk_size(self, memory_budget: float = None, overhead: float = 1.0, log: bool = False) -> int:
+        """
+        Get the number of data points per chunk so that fitting the linear models on a chunk stays within a memory
+        budget.
 
-        Currently The overhead factor is set to 100X the size of the data being analysed
+        The memory needed is estimated from the size of a chunk as float64 (specimens x data points x 8 bytes) multiplied
+        by the overhead of the linear model engine (linear_model.LM_MEMORY_OVERHEAD).
 
         Parameters
         ----------
+        memory_budget
+            Bytes available for analysing a chunk. If None, half of the currently available memory is used
+        overhead
+            Peak memory used by the linear model engine as a multiple of the chunk size
         log: Whether to log data size information
 
         Returns
         -------
-
+        number of data points per chunk
         """
+        if memory_budget is None:
+            memory_budget = common.available_memory() / 2
 
-        overhead_factor = 100
-        # debug
-        bytes_free = common.available_memory()
-        procMemRSS_bytes = psutil.Process(os.getpid()).memory_info().rss
-
-        num_chunks = math.ceil((procMemRSS_bytes * overhead_factor) / bytes_free)
+        bytes_per_point = len(self.info) * np.dtype(np.float64).itemsize * overhead
+        chunk_size = int(min(self.num_points, max(1, memory_budget // bytes_per_point)))
 
         if log:
-            logging.info(f'\nAvailable memory: {common.bytesToGb(bytes_free)} GB\nProcess memory: {common.bytesToGb(procMemRSS_bytes)} GB')
+            logging.info(f'\nMemory budget: {common.bytesToGb(memory_budget)} GB\n'
+                         f'Data: {len(self.info)} specimens x {self.num_points} data points\n'
+                         f'Chunk size: {chunk_size} data points ({math.ceil(self.num_points / chunk_size)} chunks)')
 
+        return chunk_size
 
+    def get_num_chunks(self, log: bool = False, memory_budget: float = None, overhead: float = 1.0) -> int:
+        """
+        Get the number of chunks needed to analyse the data within the memory budget. See chunk_size
 
-        if num_chunks > 1:
-            return num_chunks
-        else:
-
-            return 1
+        Returns
+        -------
+        number of chunks
+        """
+        return math.ceil(self.num_points / self.chunk_size(memory_budget, overhead, log))
 
-    def chunks(self) -> Iterator[np.ndarray]:
+    def chunks(self, chunk_size: int = None) -> Iterator[np.ndarray]:
         """
         Return chunks of the data.
 
+        Parameters
+        ----------
+        chunk_size
+            Number of data points per chunk. If None, use chunk_size() with the default memory budget
+
         Yields
         -------
         Chunks split column-wise (axis=1)
 
         Notes
         -----
-        np.array_split returns a view on the data not a copy
+        The chunks are views on the data. No copies are made
 
-        # TODO: Allow chunk size to be set via config
-        # TODO: Organ vol self.data is a Dataframe voxeld ata is list of arrays. Should standardise this
         """
-        num_chunks = self.get_num_chunks()
+        if chunk_size is None:
+            chunk_size = self.chunk_size()
 
-        try:
-            self.data.shape
-        except AttributeError:
-            specimen_size = len(self.data[0])
+        if isinstance(self.data, pd.DataFrame):
+            data = self.data.to_numpy()  # A view if all the columns have the same dtype
         else:
-            specimen_size = self.data.shape[1]
+            data = self.data
 
-        chunk_size = math.ceil(specimen_size/ num_chunks)
-
-        for i in range(0, specimen_size, chunk_size):
-            try:
-                self.data.shape
-            except AttributeError:
-                chunk = np.array([x[i: i + chunk_size] for x in self.data])
-            else:
-                chunk = np.array([x[i: i + chunk_size] for _, x in self.data.iterrows()])
-
-            yield chunk
+        for i in range(0, self.num_points, chunk_size):
+            yield data[:, i: i + chunk_size]
 
     @property  # delete
     def mask_size(self) -> int:
@@ -229,10 +233,6 @@ class LineData:
 class DataLoader:
     """
     Base class for loading in data
-
-    Notes
-    -----
-    TODO: add support for memory mapping data
     """
     def __init__(self,
                  wt_dir: Path,
@@ -291,10 +291,21 @@ class DataLoader:
 
         self.normaliser = None
 
-        self.blur_fwhm = config.get('blur', DEFAULT_FWHM)
+        # Optional VoxelDataCache for the preprocessed baseline data
+        self.cache = None
+
+        # 'blur' was the old name for blur_fwhm
+        self.blur_fwhm = config.get('blur_fwhm', config.get('blur', DEFAULT_FWHM))
         self.voxel_size = config.get('voxel_size', DEFAULT_VOXEL_SIZE)
+        # See misc.blur_masked. 'full' blurs the whole volume, 'cropped' and 'fft' only the mask bounding box
+        self.blur_method = config.get('blur_method', 'full')
         self.memmap = memmap
 
+        # Parallel reading of the voxel data. loader_memory is in GB. If not set, half the available memory is used
+        self.loader_threads = config.get('loader_threads', os.cpu_count() or 1)
+        loader_memory = config.get('loader_memory')
+        self.loader_memory = loader_memory * 1024 ** 3 if loader_memory else None
+
     @staticmethod
     def factory(type_: str):
         """
@@ -327,7 +338,7 @@ class DataLoader:
                     ids.append(line.strip())
             return ids
 
-    def _read(self, paths: List[Path]) -> np.ndarray:
+    def _read(self, paths: List[Path], out: np.ndarray, use_cache: bool = False) -> np.ndarray:
         """
         Read in the data an a return a common 2D array independent on input data type
 
@@ -335,6 +346,10 @@ class DataLoader:
         ----------
         paths
             The paths to the data
+        out
+            The rows of the store (see _allocate) to read the data into
+        use_cache
+            Get the data from/add the data to self.cache if it's set
 
         Returns
         -------
@@ -344,6 +359,32 @@ class DataLoader:
 
         raise NotImplementedError
 
+    def _allocate(self, num_specimens: int) -> np.ndarray:
+        """
+        Make the 2D float32 store that the voxel data is read into. rows: specimens, columns: voxels within the mask.
+
+        It's C-ordered as the specimens are written in a row at a time and the chunks taken for the linear models are
+        wide column blocks, so each row of a chunk is a long contiguous run (also on disk if memory mapped).
+
+        Parameters
+        ----------
+        num_specimens
+            Number of rows to reserve
+
+        Returns
+        -------
+        The store. Memory mapped to a temporary file if self.memmap
+        """
+        shape = (num_specimens, int(np.count_nonzero(self.mask)))
+
+        logging.info(f'Allocating data store: {shape[0]} specimens x {shape[1]} voxels '
+                     f'({common.bytesToGb(shape[0] * shape[1] * 4)} GB)')
+
+        if self.memmap:
+            return np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=shape)
+        else:
+            return np.empty(shape, dtype=np.float32)
+
     def cluster_data(self):
         raise NotImplementedError
 
@@ -391,19 +432,17 @@ class DataLoader:
                 [self.treatment_dir, ['wildtype','treatment']],
                 [self.interaction_dir, ['mutant','treatment']]]
 
+        # Get all the paths first so the data for all four groups can be put in one store
+        condition_paths = [list(self._get_metadata(_dir)['data_path']) for _dir, _ in condition_list]
+        store = self._allocate(sum(len(paths) for paths in condition_paths))
+        row = 0
 
-        data = []
-         
         full_staging = pd.DataFrame()
 
         paths_list = []
  
         # unpack list
-        for _dir, condition in condition_list: 
-                    
-            metadata = self._get_metadata(_dir)
-            
-            paths = list(metadata['data_path'])
+        for (_dir, condition), paths in zip(condition_list, condition_paths):
             
             paths_list.extend(paths)
 
@@ -419,7 +458,9 @@ class DataLoader:
             
             # should be no baseline ids, so no need to filter specimens
 
-            vols = self._read(paths)
+            # Only the wildtype-vehicle group are baselines
+            vols = self._read(paths, store[row: row + len(paths)], use_cache=_dir == self.wt_dir)
+            row += len(paths)
             
             if self.normaliser:
                 self.normaliser.add_reference(vols)
@@ -429,23 +470,15 @@ class DataLoader:
                 # <-bodge
                 self.normaliser.normalise(vols)
 
-            masked_data = [x.ravel() for x in vols]
-
             full_staging = pd.concat((full_staging, staging))
             # Id there is a value column, change to staging. TODO: make lama spitout staging header instead of value
             if 'value' in full_staging:
                 staging.rename(columns={'value': 'staging'}, inplace=True)
 
-            # data = np.vstack((masked_wt_data, masked_mut_data)) # This almost doubled memory usage.
-            # Stick all arrays in a list instead
-            
-            data.extend(masked_data)
-
-
             # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
 
             if _dir == self.interaction_dir: 
-                input_ = LineData(data, full_staging, line, self.shape, paths_list, self.mask)
+                input_ = LineData(store[:row], full_staging, line, self.shape, paths_list, self.mask)
                 yield input_
 
 
@@ -455,7 +488,9 @@ class DataLoader:
         per line that can be used to go into the statistics pipeline.
 
         The wild type data is the same for each mutant line so we don't have to do multiple reads of the potentially
-        large dataset
+        large dataset. All the data is kept in a single 2D store (see _allocate). The baselines are read into the
+        first rows once and each line's mutants are read into the rows after them, so the LineData for each line is a
+        view on the store. The mutant rows are overwritten by the next line.
 
         Returns:
         -------
@@ -472,8 +507,15 @@ class DataLoader:
         if self.baseline_ids:
             wt_paths, wt_staging = self.filter_specimens(self.baseline_ids, wt_paths, wt_staging)
 
+        mut_metadata = self._get_metadata(self.mut_dir, self.lines_to_process)
+
+        # Reserve enough rows after the baselines for the line with the most mutants
+        num_wt = len(wt_paths)
+        max_mutants = int(mut_metadata.groupby('line').size().max()) if len(mut_metadata) else 0
+        store = self._allocate(num_wt + max_mutants)
+
         logging.info('loading baseline data')
-        wt_vols = self._read(wt_paths)
+        wt_vols = self._read(wt_paths, store[:num_wt], use_cache=True)
 
         if self.normaliser:
             self.normaliser.add_reference(wt_vols)
@@ -483,12 +525,6 @@ class DataLoader:
             # <-bodge
             self.normaliser.normalise(wt_vols)
 
-        # Make a 2D array of the WT data
-        masked_wt_data = [x.ravel() for x in wt_vols]
-
-        mut_metadata = self._get_metadata(self.mut_dir, self.lines_to_process)
-
-                         
         # Iterate over the lines
         logging.info('loading mutant data')
 
@@ -508,26 +544,20 @@ class DataLoader:
                 if ids:
                     mut_paths, mut_staging = self.filter_specimens(self.mutant_ids[line], mut_paths, mut_staging)
 
-            mut_vols = self._read(mut_paths)
+            mut_vols = self._read(mut_paths, store[num_wt: num_wt + len(mut_paths)])
 
             if self.normaliser:
                 self.normaliser.normalise(mut_vols)
-            masked_mut_data = [x.ravel() for x in mut_vols]
 
             staging = pd.concat((wt_staging, mut_staging))
             # Id there is a value column, change to staging. TODO: make lama spitout staging header instead of value
             if 'value' in staging:
                 staging.rename(columns={'value': 'staging'}, inplace=True)
 
-            # data = np.vstack((masked_wt_data, masked_mut_data)) # This almost doubled memory usage.
-            # Stick all arrays in a list instead
-            data = masked_wt_data[:]
-            data.extend(masked_mut_data)
-
-
             # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
 
-            input_ = LineData(data, staging, line, self.shape, (wt_paths, mut_paths), self.mask)
+            input_ = LineData(store[:num_wt + len(mut_paths)], staging, line, self.shape, (wt_paths, mut_paths),
+                              self.mask)
             yield input_
 
         
@@ -546,45 +576,112 @@ class VoxelDataLoader(DataLoader):
         pass
         #self.labe
 
-    def _read(self, paths: Iterable) -> List[np.ndarray]:
+    def _read(self, paths: Iterable, out: np.ndarray, use_cache: bool = False) -> np.ndarray:
         """
         - Read in the voxel-based data into 3D arrays
         - Apply guassian blur to the 3D image
         - mask
         - Unravel
 
+        If use_cache and self.cache is set, specimens already in the cache are copied from there instead and the
+        others are added to it.
+
+        The specimens are read in parallel threads (reading with SimpleITK and the blurring release the GIL). The first
+        specimen is read on its own to estimate the memory needed per specimen, and the number of threads is limited
+        so that the specimens being processed at once fit within self.loader_memory. Each specimen is written to its
+        own row of out, so the order of the paths is kept.
 
         Parameters
         ----------
         paths
             Path to load
+        out
+            The rows of the data store to write into. One row per path
+        use_cache
+            Whether to use self.cache
 
         Returns
         -------
-        List of numpy arrays of blurred, masked, and raveled data
+        out, containing the blurred, masked, and raveled data
         """
+        paths = list(paths)
+        cache = self.cache if use_cache else None
+        mask_hash = cache.mask_hash(self.mask) if cache else None
+
+        bbox = None
+        if self.blur_method != 'full':
+            radius = int(GAUSSIAN_TRUNCATE * fwhm_to_sigma(self.blur_fwhm, self.voxel_size) + 0.5)
+            bbox = mask_bounding_box(self.mask, radius)
+
+        def read_one(row: int, data_path: Path) -> Union[int, None]:
+            """
+            Read a specimen into out[row]. Returns the approximate peak memory used in bytes, or None if it was cached
+            """
+            if cache:
+                key = cache.key(data_path, mask_hash, self.blur_fwhm, self.voxel_size, self.datatype,
+                                self.blur_method)
+                cached = cache.load(key)
+                if cached is not None:
+                    logging.info(f'loading cached data: {data_path.name}')
+                    out[row] = cached
+                    if not self.shape:
+                        self.shape = self.mask.shape  # Volumes are the same shape as the mask
+                    return None
 
-        images = []
-
-        for data_path in paths:
             logging.info(f'loading data: {data_path.name}')
-            loader = common.LoadImage(data_path)
+            array = common.LoadImage(data_path).array
 
             if not self.shape:
-                self.shape = loader.array.shape
+                self.shape = array.shape
+
+            out[row] = blur_masked(array, self.blur_fwhm, self.voxel_size, self.mask, self.blur_method, bbox)
 
-            blurred_array = blur(loader.array, self.blur_fwhm, self.voxel_size)
-            masked = blurred_array[self.mask != False]
+            if cache:
+                cache.save(key, out[row])
 
-            if self.memmap:
-                t = tempfile.TemporaryFile()
-                m = np.memmap(t, dtype=masked.dtype, mode='w+', shape=masked.shape)
-                m[:] = masked
-                masked = m
+            return peak_bytes(array.size, array.itemsize)
 
-            images.append(masked)
+        def peak_bytes(num_voxels: int, itemsize: int) -> int:
+            """
+            The approximate peak memory of reading a specimen: the SimpleITK image, the array, the blurred array
+            (float32 and only the mask bounding box unless blur_method is 'full') and the masked data
+            """
+            if bbox is None:
+                blurred_bytes = num_voxels * max(itemsize, 4)
+            else:
+                blurred_bytes = int(np.prod([b.stop - b.start for b in bbox])) * 4
+                if self.blur_method == 'fft':
+                    blurred_bytes *= 4  # Padded copy, complex spectrum and float64 inverse transform
+            return 3 * num_voxels * itemsize + blurred_bytes
+
+        if paths:
+            bytes_per_specimen = read_one(0, paths[0])
+            if bytes_per_specimen is None:
+                # Cached. Estimate from the image header as if it had been read, for the specimens that are not cached
+                size, dtype, components = common.image_header(paths[0])
+                bytes_per_specimen = peak_bytes(int(np.prod(size)) * components, dtype.itemsize)
+            num_threads = self._num_read_threads(bytes_per_specimen, len(paths) - 1)
+
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                futures = [pool.submit(read_one, row, path) for row, path in enumerate(paths[1:], start=1)]
+                for future in futures:
+                    future.result()  # Raise any exceptions from the threads
+
+        if cache:
+            logging.info(f'Data cache: {cache.hits} hits, {cache.misses} misses')
+
+        return out
+
+    def _num_read_threads(self, bytes_per_specimen: int, num_specimens: int) -> int:
+        """
+        Get the number of threads to read specimens with so that they fit in self.loader_memory
+        """
+        memory_cap = self.loader_memory if self.loader_memory else common.available_memory() / 2
+        num_threads = int(max(1, min(self.loader_threads, num_specimens, memory_cap // max(bytes_per_specimen, 1))))
 
-        return images
+        logging.info(f'Reading {num_specimens} more specimens with {num_threads} threads '
+                     f'({common.bytesToGb(bytes_per_specimen)} GB per specimen)')
+        return num_threads
 
     def _get_data_file_path(self):
         """
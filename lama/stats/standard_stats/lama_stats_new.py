@@ -12,6 +12,7 @@ To do 060819
 
 from pathlib import Path
 from typing import Union, List
+from functools import partial
 
 from logzero import logger as logging
 import logzero
@@ -20,10 +21,11 @@ import gc
 
 from lama.common import cfg_load
 from lama.stats.standard_stats.stats_objects import Stats, OrganVolume
-from lama.stats.standard_stats.data_loaders import DataLoader, load_mask, LineData, JacobianDataLoader
+from lama.stats.standard_stats.data_loaders import DataLoader, load_mask, LineData, JacobianDataLoader, VoxelDataLoader
+from lama.stats.standard_stats.data_cache import VoxelDataCache
 from lama.stats.standard_stats.results_writer import ResultsWriter
 from lama import common
-from lama.stats import linear_model
+from lama.stats import linear_model, r_worker
 from lama.elastix import PROPAGATE_CONFIG
 from lama.elastix.propagate_volumes import PropagateHeatmap
 from lama.img_processing.normalise import Normaliser
@@ -37,7 +39,8 @@ def run(config_path: Path,
         target_dir: Path,
         treatment_dir: Path = None,
         interaction_dir: Path = None,
-        lines_to_process: Union[List, None] = None
+        lines_to_process: Union[List, None] = None,
+        memory_budget: float = None
         ):
     """
     The entry point to the stats pipeline.
@@ -64,6 +67,10 @@ def run(config_path: Path,
     lines_to_process
         list: optional mutant line ids to process only.
         None: process all lines
+
+    memory_budget
+        GB of memory to use when fitting the linear models. Overrides the 'memory_budget' config option.
+        If neither is set, half the available memory is used
     """
     
     if not (wt_dir / 'output').is_dir():
@@ -99,6 +106,30 @@ def run(config_path: Path,
     if mutant_file:
         mutant_file = config_path.parent / mutant_file
 
+    cache_dir = stats_config.get('baseline_cache_dir')
+    if cache_dir:
+        cache_dir = config_path.parent / cache_dir
+        logging.info(f'Caching preprocessed baseline data in {cache_dir}')
+
+    lm_engine = stats_config.get('lm_engine', 'numpy')
+    if lm_engine not in linear_model.LM_ENGINES:
+        raise ValueError(f"lm_engine should be one of {list(linear_model.LM_ENGINES)}, not '{lm_engine}'")
+    logging.info(f'Using the {lm_engine} linear model engine')
+    stats_runner = linear_model.LM_ENGINES[lm_engine]
+
+    r_transport = stats_config.get('r_transport')
+    if lm_engine == 'R' and r_transport:
+        stats_runner = partial(stats_runner, transport=r_transport)
+
+    if memory_budget is None:
+        memory_budget = stats_config.get('memory_budget')
+    if memory_budget is not None:
+        logging.info(f'Memory budget for the linear models: {memory_budget} GB')
+        memory_budget = memory_budget * 1024 ** 3
+
+    # Long-lived R processes used for the R linear models. 0 to start a new Rscript process for each call
+    r_worker.set_num_workers(stats_config.get('r_workers', r_worker.NUM_WORKERS))
+
     # Run each data class through the pipeline.
     for stats_type in stats_config['stats_types']:
 
@@ -120,6 +151,9 @@ def run(config_path: Path,
         if loader_class == JacobianDataLoader:
             if stats_config.get('use_log_jacobians') is False:
                 loader.data_folder_name = 'jacobians'
+        if cache_dir and isinstance(loader, VoxelDataLoader):
+            loader.cache = VoxelDataCache(cache_dir)
+
         # Currently only the intensity stats get normalised
         loader.normaliser = Normaliser.factory(stats_config.get('normalise'), stats_type)  # move this into subclass
 
@@ -154,7 +188,9 @@ def run(config_path: Path,
                 stats_class = Stats.factory(stats_type)
                 stats_obj = stats_class(line_input_data, stats_type, stats_config.get('use_staging', True), stats_config.get('two_way', False))
       
-                stats_obj.stats_runner = linear_model.lm_r
+                stats_obj.stats_runner = stats_runner
+                stats_obj.memory_budget = memory_budget
+                stats_obj.memory_overhead = linear_model.LM_MEMORY_OVERHEAD[lm_engine]
                 stats_obj.run_stats()
       
                 logging.info('Statistical analysis finished.')
@@ -50,6 +50,13 @@ def validate(config: Dict):
         if wrong:
             raise ValueError(f'{key} should be a number with min {min} and max {max}')
 
+    def int_(n, min=None):
+        # Counts of threads and workers. bool is an int subclass, so is excluded
+        if not isinstance(n, numbers.Integral) or isinstance(n, bool):
+            raise ValueError(f'{key} must be a whole number')
+        if min is not None and n < min:
+            raise ValueError(f'{key} should be a whole number of at least {min}')
+
     def bool_(b):
         return isinstance(b, bool)
 
@@ -66,6 +73,10 @@ def validate(config: Dict):
             'required': False,
             'validate': (num, 0)
         },
+        'blur_method': {
+            'required': False,
+            'validate': [options, ['full', 'cropped', 'fft']]
+        },
         'voxel_size':{
             'required': False,
             'validate': (num, 0)
@@ -112,6 +123,34 @@ def validate(config: Dict):
         'normalise_organ_vol_to_mask': {
             'required': False,
             'validate' : [bool_]
+        },
+        'lm_engine': {
+            'required': False,
+            'validate': [options, ['numpy', 'R']]
+        },
+        'r_transport': {
+            'required': False,
+            'validate': [options, ['file', 'shm', 'fifo']]
+        },
+        'r_workers': {
+            'required': False,
+            'validate': (int_, 0)
+        },
+        'memory_budget': {
+            'required': False,
+            'validate': (num, 0)
+        },
+        'baseline_cache_dir': {
+            'required': False,
+            'validate': [lambda x: isinstance(x, str)]
+        },
+        'loader_threads': {
+            'required': False,
+            'validate': (int_, 1)
+        },
+        'loader_memory': {
+            'required': False,
+            'validate': (num, 0)
         }
 
 
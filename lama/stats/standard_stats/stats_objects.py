@@ -8,8 +8,8 @@ I thought that each data type might need it's own subclass, however the differen
 """
 
 from collections import defaultdict
-import subprocess as sub
 import tempfile
+import math
 import os
 from pathlib import Path
 
@@ -22,8 +22,6 @@ import pandas as pd
 from lama import common
 from lama.stats.standard_stats.data_loaders import LineData
 
-RSCRIPT_FDR = common.lama_root_dir / 'stats' / 'rscripts' / 'r_padjust.R'
-
 
 class Stats:
     specimen_results: addict.Dict
@@ -51,6 +49,10 @@ class Stats:
         self.use_staging = use_staging
         self.two_way = two_way
 
+        # Used to size the data chunks sent to stats_runner. See LineData.chunk_size
+        self.memory_budget = None  # bytes. None for half the available memory
+        self.memory_overhead = 1.0  # Peak memory used by stats_runner as a multiple of the chunk size
+
         # The final results will be stored in these attributes
         self.line_qvals = None
         self.line_pvalues = None
@@ -85,9 +87,10 @@ class Stats:
 
         info = self.input_.info
 
-        num_chunks = self.input_.get_num_chunks(log=True)
+        chunk_size = self.input_.chunk_size(self.memory_budget, self.memory_overhead, log=True)
+        num_chunks = math.ceil(self.input_.num_points / chunk_size)
 
-        for i, data_chunk in enumerate(self.input_.chunks()):
+        for i, data_chunk in enumerate(self.input_.chunks(chunk_size)):
             # Chunk the data and send sequentially to R to not use all the memory
 
             logging.info(f'Chunk {i + 1}/{num_chunks}')
@@ -123,6 +126,10 @@ class Stats:
                         specimen_pvals[id_].append(pval[start:end])
 
             else:
+                # The line-level results are at the start of the results chunk
+                line_level_pvals.append(p_all[:current_chunk_size])
+                line_level_tvals.append(t_all[:current_chunk_size])
+
                 # Get the specimen-level statistics
                 mut_ids = self.input_.mutant_ids()
 
@@ -210,43 +217,121 @@ class OrganVolume(Stats):
         super().__init__(*args)
 
 
-def fdr(pvals: np.ndarray) -> np.ndarray:
+def fdr(pvals: np.ndarray, in_place: bool = False, block_size: int = None) -> np.ndarray:
     """
-    Use R for FDR correction
+    Benjamini–Hochberg FDR correction. Gives the same results as R's p.adjust(method='BH')
 
+    Parameters
     ----------
-    pvals: The p-values to be corrected
+    pvals
+        The p-values to be corrected. NaNs are left as NaN and not counted in the number of tests, as in R
+    in_place
+        Write the q-values over the p-values. pvals must be a C-contiguous float array (float32 from the linear
+        models)
+    block_size
+        If given and there are more p-values than this, do the correction out of core (see _fdr_blocked) in sorted
+        blocks of at most this many p-values. For memory-mapped p-values that won't fit in memory
 
     Returns
     -------
-    The corrected q-values
+    The corrected q-values. float32 unless done in place.
+    If done out of core and not in place, the q-values are memory-mapped to a temporary file
+
+    Raises
+    ------
+    ValueError
+        If in_place and pvals is not C-contiguous
     """
+    if in_place and not (isinstance(pvals, np.ndarray) and pvals.flags.c_contiguous):
+        # ravel() would copy, and the q-values would not be written to pvals
+        raise ValueError('fdr in_place needs a C-contiguous numpy array')
+
+    pvals = pvals.ravel() if in_place else np.asarray(pvals).ravel()
 
-    qval_outfile = tempfile.NamedTemporaryFile().name
-    pval_file = tempfile.NamedTemporaryFile().name
+    if in_place:
+        out = pvals
+    elif block_size and pvals.size > block_size:
+        out = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=pvals.shape)
+    else:
+        out = np.empty(pvals.shape, dtype=np.float32)
 
-    try:
-        pvals.tofile(pval_file)
-    except IOError:
-        logging.error(f'Cannot save p-value file {pval_file}')
+    if block_size and pvals.size > block_size:
+        _fdr_blocked(pvals, out, block_size)
+        return out
 
+    p = pvals.astype(np.float64)
+    valid = np.flatnonzero(~np.isnan(p))
 
-    cmdFDR = ['Rscript',
-              str(RSCRIPT_FDR),
-              pval_file,
-              str(pvals.shape[0]),
-              qval_outfile
-              ]
+    # Sort once and take the cumulative minimum of n/i * p(i) from the largest p-value down
+    order = valid[np.argsort(p[valid], kind='stable')]
+    ranked = p[order] * (len(order) / np.arange(1, len(order) + 1))
+    q = np.minimum.accumulate(ranked[::-1])[::-1]
+    np.minimum(q, 1, out=q)
 
-    try:
-        sub.check_output(cmdFDR)
-    except sub.CalledProcessError as e:
-        logging.warn(f"R FDR calculation failed: {e}")
-        raise
+    out[np.isnan(p)] = np.nan
+    out[order] = q
 
-    result = np.fromfile(qval_outfile, dtype=np.float64).astype(np.float32)
+    return out
 
-    os.remove(qval_outfile)
-    os.remove(pval_file)
 
-    return result
+def _fdr_blocked(pvals: np.ndarray, out: np.ndarray, block_size: int):
+    """
+    Out of core Benjamini–Hochberg correction. Only a few blocks of p-values are held in memory at once.
+
+    The q-value of a p-value p is the minimum of n * p' / rank(p') over all p' >= p. So
+        1: Each block is sorted and spilled to disk as a sorted run along with its original indices
+        2: The global rank of each p-value is the sum of its searchsorted positions in all the runs. From these each run
+           gets the suffix minimum of n * p / rank
+        3: The q-value of each p-value is the smallest of the suffix minima of all the runs at the p-value's position.
+
+    This is O(k * n log n) for k blocks, and each run is read from disk k times
+
+    Parameters
+    ----------
+    pvals
+        The p-values. Can be a memory-mapped array
+    out
+        The q-values are written here. Can be the same array as pvals
+    block_size
+        Maximum number of p-values in a block
+    """
+    runs = []  # (sorted p-values, original indices, suffix minima) for each block. All memory mapped
+
+    def spill(array: np.ndarray) -> np.memmap:
+        m = np.memmap(tempfile.TemporaryFile(), dtype=array.dtype, mode='w+', shape=array.shape)
+        m[:] = array
+        return m
+
+    num_tests = 0
+
+    for start in range(0, pvals.size, block_size):
+        block = np.asarray(pvals[start: start + block_size], dtype=np.float64)
+        nans = np.isnan(block)
+        out[start: start + block_size][nans] = np.nan
+
+        valid = np.flatnonzero(~nans)
+        order = valid[np.argsort(block[valid], kind='stable')]
+        num_tests += len(order)
+        runs.append([spill(block[order]), spill(order + start), None])
+
+    for run in runs:
+        sorted_p = np.asarray(run[0])
+        rank = np.zeros(len(sorted_p), dtype=np.int64)
+        for other in runs:
+            rank += np.searchsorted(other[0], sorted_p, side='right')
+
+        ranked = sorted_p * num_tests / rank
+        run[2] = spill(np.minimum.accumulate(ranked[::-1])[::-1])
+
+    for run in runs:
+        sorted_p = np.asarray(run[0])
+        q = np.ones(len(sorted_p))
+
+        for other in runs:
+            if not len(other[0]):
+                continue
+            pos = np.searchsorted(other[0], sorted_p, side='left')
+            in_range = pos < len(other[0])
+            q[in_range] = np.minimum(q[in_range], other[2][pos[in_range]])
+
+        out[np.asarray(run[1])] = q
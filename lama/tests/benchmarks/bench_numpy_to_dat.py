@@ -0,0 +1,69 @@
+"""
+Benchmark the serialisation of voxel data for the R linear model (linear_model._numpy_to_dat) against the previous
+implementation, which packed the data column by column with struct.pack.
+
+The default matrix is roughly one chunk of a line: 100 specimens by 2 million masked voxels.
+
+Usage:  python bench_numpy_to_dat.py [-s num_specimens] [-v num_voxels]
+"""
+
+import argparse
+import struct
+import tempfile
+import time
+import os
+import filecmp
+
+import numpy as np
+
+from lama.stats.linear_model import _numpy_to_dat
+
+
+def numpy_to_dat_struct(mat: np.ndarray, outfile: str):
+    """
+    The previous implementation of _numpy_to_dat
+    """
+    with open(outfile, 'wb') as binfile:
+        header = struct.pack('2I', mat.shape[0], mat.shape[1])
+        binfile.write(header)
+        for i in range(mat.shape[1]):
+            data = struct.pack('%id' % mat.shape[0], *mat[:, i])
+            binfile.write(data)
+
+
+def bench(func, mat, outfile) -> float:
+    start = time.perf_counter()
+    func(mat, outfile)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark writing voxel data for R')
+    parser.add_argument('-s', dest='num_specimens', type=int, default=100)
+    parser.add_argument('-v', dest='num_voxels', type=int, default=2_000_000)
+    args = parser.parse_args()
+
+    # Blurred voxel data are float32
+    mat = np.random.default_rng(0).normal(size=(args.num_specimens, args.num_voxels)).astype(np.float32)
+    print(f'Data: {mat.shape[0]} specimens x {mat.shape[1]} voxels ({mat.nbytes / 1024 ** 2:.0f} MB as float32)')
+
+    old_file = tempfile.NamedTemporaryFile().name
+    new_file = tempfile.NamedTemporaryFile().name
+
+    try:
+        t_old = bench(numpy_to_dat_struct, mat, old_file)
+        t_new = bench(_numpy_to_dat, mat, new_file)
+
+        if not filecmp.cmp(old_file, new_file, shallow=False):
+            raise ValueError('The new serialisation does not match the old one')
+
+        print(f'struct.pack per column: {t_old:.2f}s')
+        print(f'single buffer write:    {t_new:.2f}s ({t_old / t_new:.0f}x)')
+    finally:
+        for f in (old_file, new_file):
+            if os.path.isfile(f):
+                os.remove(f)
+
+
+if __name__ == '__main__':
+    main()
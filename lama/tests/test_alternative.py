@@ -0,0 +1,47 @@
+"""
+Check distributions.alternative, which fits every line and specimen at once, against a statsmodels OLS fit of each
+one. Small random organ volume tables are made in the tests, some with QC'd (NaN) labels.
+"""
+
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from lama.stats.permutation_stats.distributions import alternative
+
+
+def fit(baselines: pd.DataFrame, mutants: pd.DataFrame, label: str):
+    df = pd.concat([baselines.assign(genotype='wt'), mutants.assign(genotype='hom')])
+    if not mutants[label].any():
+        return np.nan, np.nan
+    fit = smf.ols(f'{label} ~ genotype + staging', data=df, missing='drop').fit()
+    return fit.pvalues['genotype[T.wt]'], -fit.tvalues['genotype[T.wt]']
+
+
+def test_alternative():
+    rng = np.random.default_rng(0)
+    labels = ['x1', 'x2', 'x3']
+
+    data = pd.DataFrame(rng.normal(10, 2, (36, 3)), columns=labels, index=[f's{i}' for i in range(36)])
+    data['staging'] = rng.normal(100, 10, 36)
+    data['line'] = ['baseline'] * 25 + ['a'] * 4 + ['b'] * 7
+
+    data.iloc[2, 0] = np.nan  # QC'd baseline
+    data.iloc[26, 1] = np.nan  # QC'd mutant
+    data.loc[data.line == 'a', 'x3'] = np.nan  # QC'd line
+
+    line_p, spec_p, line_t, spec_t = alternative(data.copy())
+
+    assert list(spec_p.columns) == ['line', '1', '2', '3']
+    assert list(line_p.index) == ['a', 'b']
+
+    baselines = data[data.line == 'baseline']
+    for label in labels:
+        for line, mutants in data[data.line != 'baseline'].groupby('line'):
+            p, t = fit(baselines, mutants, label)
+            assert np.allclose([line_p.loc[line, label[1:]], line_t.loc[line, label[1:]]], [p, t], equal_nan=True)
+
+        for specimen in data.index[25:]:
+            p, t = fit(baselines, data.loc[[specimen]], label)
+            assert np.allclose([spec_p.loc[specimen, label[1:]], spec_t.loc[specimen, label[1:]]], [p, t],
+                               equal_nan=True)
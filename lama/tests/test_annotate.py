@@ -0,0 +1,50 @@
+"""
+Tests for the annotation step of the permutation stats: the per-line volume ratios and Cohen's d from
+line_volume_effects, and the thresholded hit label maps written from the label voxel lookup.
+"""
+
+import numpy as np
+import pandas as pd
+
+from lama.stats.common import cohens_d
+from lama.stats.permutation_stats import run_permutation_stats
+from lama.stats.permutation_stats.run_permutation_stats import line_volume_effects, label_voxel_lookup
+
+
+def test_line_volume_effects():
+    rng = np.random.default_rng(0)
+    lines = ['baseline'] * 12 + ['line_a'] * 4 + ['line_b'] * 3
+    organ_volumes = pd.DataFrame(rng.random((len(lines), 3)) + 1, columns=['x1', 'x2', 'x3'])
+    organ_volumes.loc[2, 'x2'] = np.nan
+    organ_volumes.loc[14, 'x3'] = np.nan
+    organ_volumes['line'] = lines
+    organ_volumes['staging'] = rng.random(len(lines))
+
+    vol_ratios, effect_sizes = line_volume_effects(organ_volumes)
+
+    for line in ['line_a', 'line_b']:
+        for label_col in ['x1', 'x2', 'x3']:
+            wt_ovs = organ_volumes.loc[organ_volumes.line == 'baseline', label_col]
+            mut_ovs = organ_volumes.loc[organ_volumes.line == line, label_col]
+
+            assert np.isclose(vol_ratios.loc[line, label_col], mut_ovs.mean() / wt_ovs.mean(), rtol=1e-12)
+            assert np.isclose(effect_sizes.loc[line, label_col], cohens_d(mut_ovs, wt_ovs), rtol=1e-12)
+
+
+def test_thresholded_label_map(tmp_path, monkeypatch):
+    written = {}
+    monkeypatch.setattr(run_permutation_stats, 'write_array', lambda array, path: written.update({path: array}))
+
+    label_map = np.random.default_rng(0).integers(0, 6, (8, 9, 10)).astype(np.uint8)
+    label_voxels = label_voxel_lookup(label_map)
+    assert sorted(label_voxels) == [1, 2, 3, 4, 5]
+
+    hits = pd.Index([2, 5, 7])  # 7 is not in the label map
+    run_permutation_stats._write_thresholded_label_map(label_map, hits, tmp_path / 'isin.nrrd')
+    run_permutation_stats._write_thresholded_label_map(label_map, hits, tmp_path / 'lookup.nrrd', label_voxels)
+
+    expected = np.where(np.isin(label_map, hits), label_map, 0)
+    for name in ['isin.nrrd', 'lookup.nrrd']:
+        result = written[tmp_path / name]
+        assert result.dtype == label_map.dtype
+        np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,83 @@
+"""
+The streaming population average (common.average) should give the same result as stacking the volumes in numpy,
+whatever the memory budget and file format. nrrd files, which SimpleITK cannot read in part, should be read only
+once when a single slab fits.
+"""
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.stats import trim_mean
+import pytest
+
+from lama import common
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = [rng.integers(150, 256, (7, 5, 6)).astype(np.uint8) for _ in range(11)]  # Sums overflow uint8
+    paths = []
+    for i, array in enumerate(arrays):
+        path = tmp_path / f'vol{i}.nrrd'
+        sitk.WriteImage(sitk.GetImageFromArray(array), str(path), i % 2 == 0)  # Mix of compressed and not
+        paths.append(path)
+    return paths, np.stack(arrays)
+
+
+@pytest.mark.parametrize('memory_budget', [None, 2000])  # 2000 bytes gives slabs of one slice
+def test_mean(volumes, memory_budget):
+    paths, stack = volumes
+
+    avg, var = common.average(paths, with_variance=True, memory_budget=memory_budget, threads=3)
+    avg = sitk.GetArrayFromImage(avg)
+
+    assert avg.dtype == np.uint8
+    np.testing.assert_array_equal(avg, np.rint(stack.mean(axis=0)))
+    np.testing.assert_allclose(sitk.GetArrayFromImage(var), stack.var(axis=0), rtol=1e-6)
+
+
+def test_median_and_trimmed_mean(volumes):
+    paths, stack = volumes
+
+    median = sitk.GetArrayFromImage(common.average(paths, method='median', memory_budget=5000))
+    np.testing.assert_array_equal(median, np.rint(np.median(stack, axis=0)))
+
+    trimmed = sitk.GetArrayFromImage(common.average(paths, method='trimmed_mean', trim_fraction=0.2))
+    np.testing.assert_array_equal(trimmed, np.rint(trim_mean(stack, 0.2, axis=0)))
+
+
+def test_wrong_size_left_out(volumes, tmp_path):
+    paths, stack = volumes
+    other = tmp_path / 'other.nrrd'
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((3, 3, 3), dtype=np.uint8)), str(other))
+
+    avg = sitk.GetArrayFromImage(common.average(paths + [other]))
+    np.testing.assert_array_equal(avg, np.rint(stack.mean(axis=0)))
+
+
+def test_nrrd_read_once_when_one_slab_fits(volumes, monkeypatch):
+    # nrrd files are decoded in full for any slab read, so with memory for the whole volume each is read once
+    paths, stack = volumes
+    reads = []
+    read_slab = common.read_slab
+    monkeypatch.setattr(common, 'read_slab', lambda *args: reads.append(args) or read_slab(*args))
+
+    avg = sitk.GetArrayFromImage(common.average(paths, memory_budget=1e6, threads=2))
+    np.testing.assert_array_equal(avg, np.rint(stack.mean(axis=0)))
+    assert len(reads) == len(paths)
+
+
+@pytest.mark.parametrize('method', common.AVERAGE_METHODS)
+def test_slab_plan_within_budget(method):
+    size, dtype, num_imgs, threads = (400, 400, 400), np.dtype(np.uint8), 20, 8
+    volume_bytes = 400 ** 3
+
+    for budget in (4 * volume_bytes, 40 * volume_bytes):
+        for full_reads in (False, True):
+            depth, ahead = common._average_slab_plan(size, dtype, num_imgs, method, False, threads, budget, full_reads)
+
+            slab_bytes = depth * 400 * 400 * (8 + (ahead if method == 'mean' else 2 * num_imgs + 16))
+            in_flight = min(threads, ahead) * volume_bytes if full_reads else 0
+            assert slab_bytes + in_flight <= budget
+            if full_reads:
+                assert in_flight <= budget / 2
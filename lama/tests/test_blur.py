@@ -0,0 +1,37 @@
+"""
+misc.blur_masked blurs only the bounding box of the mask (or uses an FFT). Inside the mask it should match blurring
+the whole volume.
+"""
+
+import numpy as np
+import pytest
+
+from lama.img_processing.misc import blur, blur_masked
+
+
+@pytest.fixture
+def volume():
+    rng = np.random.default_rng(0)
+    img = (rng.random((60, 70, 50)) * 100).astype(np.float32)
+
+    mask = np.zeros(img.shape, dtype=np.uint8)
+    mask[20:45, 30:60, 10:40] = 1
+    mask[0:5, 0:4, 45:50] = 1  # Touches the edge of the volume, where the crop is clipped
+    return img, mask
+
+
+@pytest.mark.parametrize('method, tolerance', [('full', 1e-4), ('cropped', 1e-4), ('fft', 1e-2)])
+def test_blur_masked(volume, method, tolerance):
+    img, mask = volume
+    expected = blur(img.astype(np.float64), 100, 14)[mask != False]
+
+    result = blur_masked(img, 100, 14, mask, method)
+
+    assert result.dtype == np.float32
+    assert np.allclose(result, expected, rtol=0, atol=tolerance)
+
+
+def test_blur_masked_bad_method(volume):
+    img, mask = volume
+    with pytest.raises(ValueError):
+        blur_masked(img, 100, 14, mask, 'deriche')
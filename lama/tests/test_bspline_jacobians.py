@@ -0,0 +1,145 @@
+"""
+The analytic B-spline jacobians are compared with finite differences of a SimpleITK BSplineTransform, and with
+transformix -jac when transformix is on the PATH (that test is skipped otherwise).
+"""
+
+import shutil
+import subprocess
+
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+from lama.elastix.bspline_jacobians import jacobian_determinant, BSplineGrid, UnsupportedTransform
+
+SIZE = (23, 17, 19)
+SPACING = (1.5, 1.0, 2.0)
+ORIGIN = (3.0, -2.0, 1.0)
+GRID_SIZE = (10, 8, 10)  # The last x column is outside the valid region
+GRID_SPACING = (5.0, 4.0, 6.0)
+GRID_ORIGIN = (-5.0, -6.5, -9.0)
+
+
+def _write_tform(path, coefs, transform='BSplineTransform'):
+    params = ' '.join(f'{x:.6f}' for x in coefs.ravel(order='F'))
+    path.write_text(f'''(Transform "{transform}")
+(NumberOfParameters {coefs.size})
+(TransformParameters {params})
+(InitialTransformParametersFileName "NoInitialTransform")
+(HowToCombineTransforms "Compose")
+(FixedImageDimension 3)
+(MovingImageDimension 3)
+(Size {' '.join(map(str, SIZE))})
+(Index 0 0 0)
+(Spacing {' '.join(map(str, SPACING))})
+(Origin {' '.join(map(str, ORIGIN))})
+(Direction 1 0 0 0 1 0 0 0 1)
+(UseDirectionCosines "true")
+(GridSize {' '.join(map(str, GRID_SIZE))})
+(GridIndex 0 0 0)
+(GridSpacing {' '.join(map(str, GRID_SPACING))})
+(GridOrigin {' '.join(map(str, GRID_ORIGIN))})
+(GridDirection 1 0 0 0 1 0 0 0 1)
+(BSplineTransformSplineOrder 3)
+(UseCyclicTransform "false")
+(ResultImagePixelType "float")
+(ResultImageFormat "nrrd")
+''')
+
+
+@pytest.fixture
+def tform(tmp_path):
+    # (control points, xyz) with some large coefficients so that there is folding
+    coefs = np.random.default_rng(0).normal(0, 4, (int(np.prod(GRID_SIZE)), 3)).round(6)
+    path = tmp_path / 'TransformParameters.0.txt'
+    _write_tform(path, coefs)
+    return path, coefs
+
+
+def _itk_jacobians(coefs, points, h=1e-4):
+    t = sitk.BSplineTransform(3, 3)
+    t.SetFixedParameters(list(GRID_SIZE) + list(GRID_ORIGIN) + list(GRID_SPACING) + list(np.eye(3).ravel()))
+    t.SetParameters(list(coefs.ravel(order='F')))
+
+    dets = []
+    for p in points:
+        jac = np.empty((3, 3))
+        for j in range(3):
+            step = np.zeros(3)
+            step[j] = h
+            jac[:, j] = (np.array(t.TransformPoint(tuple(p + step))) - np.array(t.TransformPoint(tuple(p - step)))) / (2 * h)
+        dets.append(np.linalg.det(jac))
+    return np.array(dets)
+
+
+@pytest.mark.parametrize('dtype, tol', [(np.float64, 1e-5), (np.float32, 1e-3)])
+def test_against_itk(tform, dtype, tol):
+    path, coefs = tform
+    img = jacobian_determinant(path, dtype)
+    jac = sitk.GetArrayFromImage(img)
+
+    assert jac.shape == SIZE[::-1]
+    assert img.GetSpacing() == SPACING and img.GetOrigin() == ORIGIN
+    assert jac.min() < 0 < jac.max()
+
+    rng = np.random.default_rng(1)
+    idx = np.stack([rng.integers(0, s, 300) for s in SIZE], axis=1)
+    points = np.array(ORIGIN) + idx * np.array(SPACING)
+
+    expected = _itk_jacobians(coefs, points)
+    np.testing.assert_allclose(jac[idx[:, 2], idx[:, 1], idx[:, 0]], expected, atol=tol, rtol=tol)
+
+
+def test_slabs(tform):
+    path, _ = tform
+    grid = BSplineGrid(path)
+    whole = np.concatenate([slab for _, _, slab in grid.jacobian_slabs()])
+    in_slabs = list(grid.jacobian_slabs(slab_bytes=1))
+    assert len(in_slabs) == SIZE[2]
+    np.testing.assert_array_equal(np.concatenate([slab for _, _, slab in in_slabs]), whole)
+
+
+def test_unsupported(tmp_path):
+    path = tmp_path / 'TransformParameters.0.txt'
+    _write_tform(path, np.zeros((4, 3)), transform='AffineTransform')
+    with pytest.raises(UnsupportedTransform):
+        BSplineGrid(path)
+
+
+@pytest.mark.skipif(shutil.which('transformix') is None, reason='transformix is not installed')
+def test_against_transformix(tform, tmp_path):
+    path, _ = tform
+    subprocess.check_output(['transformix', '-out', str(tmp_path), '-tp', str(path), '-jac', 'all'])
+    expected = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / 'spatialJacobian.nrrd')))
+
+    np.testing.assert_allclose(sitk.GetArrayFromImage(jacobian_determinant(path)), expected, atol=1e-4, rtol=1e-4)
+
+
+def test_deformations_backend(tform, tmp_path, monkeypatch):
+    from lama.elastix import deformations
+
+    path, _ = tform
+    reg_dir = tmp_path / 'deformable'
+    (reg_dir / 'spec').mkdir(parents=True)
+    shutil.copy(path, reg_dir / 'spec' / deformations.ELX_TFORM_NAME)
+
+    def no_transformix(cmd):
+        raise AssertionError('transformix should not be run')
+    monkeypatch.setattr(deformations.subprocess, 'check_output', no_transformix)
+
+    dirs = [tmp_path / x for x in ('deformations', 'jacobians', 'log_jacobians')]
+    for d in dirs:
+        d.mkdir()
+
+    summary = deformations._generate_deformation_fields([reg_dir], [], *dirs, write_vectors=False,
+                                                        write_raw_jacobians=False, write_log_jacobians=True,
+                                                        threads=1, backend='bspline')
+
+    expected = sitk.GetArrayFromImage(jacobian_determinant(path))
+    assert summary.loc['spec', 'num_neg_voxels'] == (expected < 0).sum()
+
+    # There is folding, so the raw jacobians are kept along with the folding map
+    raw = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / 'jacobians' / 'spec.nrrd')))
+    np.testing.assert_array_equal(raw, expected)
+    folding = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / 'log_jacobians' / 'ERROR_NEGATIVE_JACOBIANS_spec.nrrd')))
+    np.testing.assert_array_equal(folding, np.minimum(expected, 0))
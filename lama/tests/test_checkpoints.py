@@ -0,0 +1,48 @@
+"""
+StageCheckpoints should load back what it saved, including 'NA' thresholds and DataFrame attrs. A null distribution
+extended from a smaller one should equal one made in a single run.
+"""
+
+import numpy as np
+import pandas as pd
+
+from lama.stats.permutation_stats import distributions
+from lama.stats.permutation_stats.checkpoints import StageCheckpoints
+
+
+def test_checkpoint_round_trip(tmp_path):
+    # Like the thresholds, with 'NA' in numeric columns
+    thresholds = pd.DataFrame({'p_thresh': [0.01, np.nan], 'num_null': [1000, 'NA']},
+                              index=pd.Index([1, 2], name='label'))
+    null = pd.DataFrame(np.random.default_rng(0).random((10, 2)), columns=['1', '2'])
+    null.attrs['combination_sizes'] = {'1': {'3': 10}}
+
+    checkpoints = StageCheckpoints(tmp_path)
+    checkpoints.save('null', 'key_10', [thresholds, null])
+
+    loaded = checkpoints.load('null', 'key_10')
+    pd.testing.assert_frame_equal(loaded[0], thresholds)
+    pd.testing.assert_frame_equal(loaded[1], null)
+    assert loaded[1].attrs == null.attrs
+
+    assert checkpoints.load('null', 'other') is None
+    assert checkpoints.latest('null', 'key', 20)[0] == 10
+    assert checkpoints.latest('null', 'key', 10) is None
+
+
+def test_extend_null():
+    rng = np.random.default_rng(0)
+    labels = ['x1', 'x2', 'x3']
+
+    data = pd.DataFrame(rng.normal(10, 2, (34, 3)), columns=labels, index=[f's{i}' for i in range(34)])
+    data['staging'] = rng.normal(100, 10, 34)
+    data['line'] = ['baseline'] * 25 + ['a'] * 3 + ['b'] * 6
+    data.iloc[2, 1] = np.nan
+
+    line_null, spec_null = distributions.null(data.copy(), 1000)
+    small_line_null, small_spec_null = distributions.null(data.copy(), 400)
+    extended_line_null, extended_spec_null = distributions.null(data.copy(), 1000,
+                                                                previous=(small_line_null, small_spec_null))
+
+    pd.testing.assert_frame_equal(extended_line_null, line_null)
+    pd.testing.assert_frame_equal(extended_spec_null, spec_null)
@@ -0,0 +1,69 @@
+"""
+RandomCombinations draws the baseline sets relabelled as synthetic mutants. With both rank and rejection sampling, the
+sets should be distinct, reproducible from the seed and uniformly drawn.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lama.stats.permutation_stats import combinations
+from lama.stats.permutation_stats.combinations import RandomCombinations
+from lama.stats.permutation_stats.distributions import generate_random_combinations
+
+
+def check_combinations(combs: RandomCombinations):
+    table = combs.table()
+    assert table.shape == (len(combs), combs.max_size)
+
+    start = 0
+    for k, n in combs.counts.items():
+        rows = table[start: start + n]
+        start += n
+        assert np.all(rows[:, k:] == -1)
+        assert np.all(np.diff(rows[:, :k], axis=1) > 0)  # Distinct members, sorted
+        assert len({tuple(r) for r in rows}) == n  # Distinct combinations
+
+
+@pytest.mark.parametrize('max_rank', [combinations.MAX_RANK, 0])  # Rank sampling and rejection sampling
+def test_random_combinations(monkeypatch, max_rank):
+    monkeypatch.setattr(combinations, 'MAX_RANK', max_rank)
+
+    ids = pd.Index([f'wt{i}' for i in range(30)])
+    combs = RandomCombinations(ids, {3: 4060, 5: 3000})  # All of the 3-subsets
+    check_combinations(combs)
+
+    # Reproducible from the seed, and the blocks are the same as the table
+    assert np.array_equal(combs.table(), RandomCombinations(ids, combs.counts).table())
+    assert np.array_equal(np.concatenate(list(combs.blocks(1000))), combs.table())
+    assert not np.array_equal(combs.table(), RandomCombinations(ids, combs.counts, seed=1).table())
+
+
+def test_random_combinations_uniform():
+    counts = np.zeros(math.comb(6, 2))
+    for seed in range(1000):
+        table = RandomCombinations(pd.Index(range(6)), {2: 3}, seed=seed).table()
+        # Colex rank
+        counts[[math.comb(int(b), 2) + int(a) for a, b in table]] += 1
+
+    assert counts.min() > 150 and counts.max() < 250  # Expected 200
+
+
+def test_generate_random_combinations():
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.normal(size=(30, 3)), columns=['x1', 'x2', 'x3'])
+    data['line'] = ['baseline'] * 20 + ['a'] * 4 + ['b'] * 6
+    data.iloc[0, 2] = np.nan  # QC'd baseline
+
+    result = generate_random_combinations(data, 1000)
+
+    assert result['x1'] is result['x2']  # Same baselines and mutant sample sizes
+    assert 0 not in result['x3'].ids
+    for combs in result.values():
+        assert combs.counts == {4: 500, 6: 500}
+        check_combinations(combs)
+
+    with pytest.raises(ValueError):
+        generate_random_combinations(data, 10 ** 6)
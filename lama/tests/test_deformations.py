@@ -0,0 +1,92 @@
+"""
+Jacobian folding summaries and log jacobians from deformations.py. transformix is replaced with a function that
+writes known jacobian images.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+from lama import common
+from lama.elastix import deformations
+
+
+def _jacobian(seed, fold=False):
+    jac = np.random.default_rng(seed).uniform(0.5, 2, (9, 6, 7)).astype(np.float32)
+    if fold:
+        jac[6, 2, 3] = -0.5
+        jac[7, 1, 1] = 0
+    return jac
+
+
+def test_jacobian_summary(tmp_path):
+    for fold in (False, True):
+        jac = _jacobian(0, fold)
+        path = tmp_path / 'jac.nrrd'
+        sitk.WriteImage(sitk.GetImageFromArray(jac), str(path))
+
+        # Slabs of two slices
+        summary, out = deformations.jacobian_summary(path, slab_bytes=6 * 7 * 8 * 2)
+
+        assert summary == {'jac_min': float(jac.min()), 'jac_max': float(jac.max()),
+                           'num_neg_voxels': int((jac < 0).sum()), 'num_voxels': jac.size}
+        if fold:
+            np.testing.assert_array_equal(out, np.where(jac > 0, 0, jac))
+        else:
+            np.testing.assert_array_equal(out, np.log(jac))
+
+    assert deformations.jacobian_summary(path, log_jacobians=False)[1] is not None  # Folding map is still made
+
+
+@pytest.mark.parametrize('ext, num_reads', [('nrrd', 1), ('mha', 5)])
+def test_jacobian_summary_reads(tmp_path, monkeypatch, ext, num_reads):
+    # nrrd files cannot be read in part, so are read once rather than once for each slab
+    jac = _jacobian(1)
+    path = tmp_path / f'jac.{ext}'
+    sitk.WriteImage(sitk.GetImageFromArray(jac), str(path))
+
+    reads = []
+    read_image, read_slab = sitk.ReadImage, common.read_slab
+    monkeypatch.setattr(common.sitk, 'ReadImage', lambda *args: reads.append(args) or read_image(*args))
+    monkeypatch.setattr(common, 'read_slab', lambda *args: reads.append(args) or read_slab(*args))
+
+    summary, out = deformations.jacobian_summary(path, slab_bytes=6 * 7 * 5 * 2)  # Slabs of two slices
+    assert len(reads) == num_reads
+    np.testing.assert_array_equal(out, np.log(jac))
+
+
+def test_generate_deformation_fields(tmp_path, monkeypatch):
+    reg_dir = tmp_path / 'deformable'
+    specimens = ['spec_a', 'spec_b', 'spec_c']
+    for spec in specimens:
+        (reg_dir / spec).mkdir(parents=True)
+        (reg_dir / spec / deformations.ELX_TFORM_NAME).write_text('(Transform "BSplineTransform")\n(Size 7 6 9)\n')
+
+    def transformix(cmd):
+        out_dir = Path(cmd[cmd.index('-out') + 1])
+        jac = _jacobian(specimens.index(out_dir.name), fold=out_dir.name == 'spec_b')
+        sitk.WriteImage(sitk.GetImageFromArray(jac), str(out_dir / 'spatialJacobian.nrrd'))
+
+    monkeypatch.setattr(deformations.subprocess, 'check_output', transformix)
+    monkeypatch.setattr(common, 'available_memory', lambda: 1e12)
+
+    dirs = [tmp_path / x for x in ('deformations', 'jacobians', 'log_jacobians')]
+    for d in dirs:
+        d.mkdir()
+
+    summary = deformations._generate_deformation_fields([reg_dir], [], *dirs, write_vectors=False,
+                                                        write_raw_jacobians=False, write_log_jacobians=True, threads=4)
+
+    assert list(summary.index) == specimens
+    assert list(summary.num_neg_voxels) == [0, 1, 0]
+
+    deformation_dir, jacobian_dir, log_jacobians_dir = dirs
+    assert sorted(p.name for p in log_jacobians_dir.iterdir()) == \
+        ['ERROR_NEGATIVE_JACOBIANS_spec_b.nrrd', 'log_jac_spec_a.nrrd', 'log_jac_spec_c.nrrd']
+    # Raw jacobians are removed when not wanted, but kept if there is folding
+    assert sorted(p.name for p in jacobian_dir.iterdir()) == ['spec_b.nrrd']
+
+    log_jac = sitk.GetArrayFromImage(sitk.ReadImage(str(log_jacobians_dir / 'log_jac_spec_c.nrrd')))
+    np.testing.assert_allclose(log_jac, np.log(_jacobian(2)))
@@ -0,0 +1,81 @@
+"""
+stats_objects.fdr is checked against a line-by-line translation of R's p.adjust(method='BH') and against statsmodels,
+including NaNs, ties, in-place use and the blocked out-of-core correction.
+"""
+
+import numpy as np
+import pytest
+from statsmodels.stats.multitest import multipletests
+
+from lama.stats.standard_stats.stats_objects import fdr
+
+
+def r_p_adjust_bh(p: np.ndarray) -> np.ndarray:
+    """
+    A line-by-line translation of the BH method of R's p.adjust
+
+        i <- lp:1L
+        o <- order(p, decreasing = TRUE)
+        ro <- order(o)
+        pmin(1, cummin(n/i * p[o]))[ro]
+    """
+    p = p.astype(np.float64)
+    n = len(p)
+    i = np.arange(n, 0, -1)
+    o = np.argsort(-p, kind='stable')
+    ro = np.argsort(o, kind='stable')
+    return np.minimum(1, np.minimum.accumulate(n / i * p[o]))[ro]
+
+
+@pytest.fixture
+def pvals():
+    rng = np.random.default_rng(0)
+    p = np.concatenate((rng.uniform(size=5000), rng.uniform(0, 0.001, 200), np.full(100, 1.0),
+                        np.full(50, 0.02)))  # Include some ties
+    rng.shuffle(p)
+    return p.astype(np.float32)
+
+
+def test_fdr_matches_r(pvals):
+    q = fdr(pvals)
+    assert q.dtype == np.float32
+    assert np.allclose(q, r_p_adjust_bh(pvals), rtol=1e-6)
+    assert np.allclose(q, multipletests(pvals.astype(np.float64), method='fdr_bh')[1], rtol=1e-6)
+
+    # Simple known example. Each p-value is 0.05 after correction
+    assert np.allclose(fdr(np.array([0.01, 0.02, 0.03, 0.04, 0.05], dtype=np.float32)), 0.05)
+
+
+def test_fdr_nan(pvals):
+    with_nan = pvals.copy()
+    with_nan[::10] = np.nan
+    q = fdr(with_nan)
+    valid = ~np.isnan(with_nan)
+
+    assert np.all(np.isnan(q[~valid]))
+    assert np.allclose(q[valid], r_p_adjust_bh(with_nan[valid]), rtol=1e-6)
+
+
+def test_fdr_in_place(pvals):
+    expected = fdr(pvals)
+    q = fdr(pvals, in_place=True)
+    assert np.shares_memory(q, pvals)
+    assert np.array_equal(pvals, expected)
+
+    # The q-values can't be written over a non-contiguous array
+    with pytest.raises(ValueError):
+        fdr(pvals.reshape(50, -1).T, in_place=True)
+
+
+@pytest.mark.parametrize('block_size', [1000, 1777, 100000])
+def test_fdr_blocked(pvals, tmp_path, block_size):
+    mm = np.memmap(tmp_path / 'p.bin', dtype=np.float32, mode='w+', shape=pvals.shape)
+    mm[:] = pvals
+    mm[::97] = np.nan
+
+    expected = fdr(np.array(mm))
+    q = fdr(mm, block_size=block_size)
+    assert np.allclose(q, expected, rtol=1e-6, equal_nan=True)
+
+    fdr(mm, in_place=True, block_size=block_size)
+    assert np.allclose(mm, expected, rtol=1e-6, equal_nan=True)
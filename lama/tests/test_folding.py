@@ -0,0 +1,76 @@
+"""
+The vectorised unfolding in folding.py should match the old correction of one control point at a time. After the
+iterative mode, the B-spline jacobians should have no folding.
+"""
+
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+from lama.elastix import folding
+from lama.elastix.bspline_jacobians import jacobian_determinant
+from lama.elastix.transform_parameters import TransformParameters
+
+GRID_SIZE = (9, 8, 7)
+GRID_SPACING = np.array([4.0, 5.0, 6.0])
+
+
+@pytest.fixture
+def tform(tmp_path):
+    coefs = np.random.default_rng(0).normal(0, 3, (int(np.prod(GRID_SIZE)), 3)).round(6)
+    params = ' '.join(f'{x:.6f}' for x in coefs.ravel(order='F'))
+    path = tmp_path / 'TransformParameters.0.txt'
+    path.write_text(f'''(Transform "BSplineTransform")
+(NumberOfParameters {coefs.size})
+(TransformParameters {params})
+(InitialTransformParametersFileName "NoInitialTransform")
+(FixedImageDimension 3)
+(Size 20 24 26)
+(Spacing 1 1 1)
+(Origin 0 0 0)
+(Direction 1 0 0 0 1 0 0 0 1)
+(GridSize {' '.join(map(str, GRID_SIZE))})
+(GridSpacing {' '.join(map(str, GRID_SPACING))})
+(GridOrigin -4 -5 -6)
+(GridDirection 1 0 0 0 1 0 0 0 1)
+''')
+    return path, coefs
+
+
+def test_unfold_matches_per_point_correction(tform):
+    path, coefs = tform
+    bs = folding.BSplineParse(path)
+    unfolded = folding.unfold_bsplines(bs)
+
+    scaled = coefs / GRID_SPACING
+    risk = ~(np.all(np.abs(scaled) < 1 / folding.K3, axis=1) | (np.linalg.norm(scaled, axis=1) < 1 / folding.A3))
+    expected = scaled.copy()
+    for i in np.flatnonzero(risk):
+        expected[i] = scaled[i] / np.linalg.norm(scaled[i]) / folding.A3
+
+    assert bs.num_corrected == risk.sum() > 0
+    np.testing.assert_allclose(unfolded, expected * GRID_SPACING)
+
+
+def test_iterative_unfold_removes_folding(tform, tmp_path):
+    path, _ = tform
+    assert sitk.GetArrayFromImage(jacobian_determinant(path)).min() < 0
+
+    out = tmp_path / 'unfolded.txt'
+    folding.unfold_bsplines(path, out, iterative=True)
+
+    written = TransformParameters.read(out).coefficients() / GRID_SPACING
+    assert not folding.fold_risk(written).any()
+    assert sitk.GetArrayFromImage(jacobian_determinant(out)).min() > 0
+
+
+def test_no_folding_unchanged(tform, tmp_path):
+    path, coefs = tform
+    small = tmp_path / 'small.txt'
+    TransformParameters.read(path).with_parameters(coefs / 100).write(small)
+    before = small.read_text()
+
+    bs = folding.BSplineParse(small)
+    folding.unfold_bsplines(bs, small, iterative=True)
+    assert bs.num_corrected == 0
+    assert small.read_text() == before
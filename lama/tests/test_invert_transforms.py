@@ -0,0 +1,126 @@
+"""
+batch_invert_transform_parameters on a small fake registration tree. elastix is replaced with a function that writes
+an inverted TransformParameters file, so this checks the shared stage parameter files, the up-to-date check on the
+input hash, the concurrency and the timings report.
+"""
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+import pytest
+
+from lama import common
+from lama.elastix import invert_transforms, elastix_registration, PROPAGATE_IMAGE_TRANSFORM, PROPAGATE_LABEL_TRANFORM, PROPAGATE_CONFIG
+
+STAGES = ['rigid', 'deformable']
+SPECIMENS = ['spec_a', 'spec_b']
+
+
+class Config(dict):
+    """
+    The parts of LamaConfig used by the inversions
+    """
+    def mkdir(self, name):
+        self[name].mkdir(exist_ok=True)
+        return self[name]
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    root_reg_dir = tmp_path / 'registrations'
+    target = tmp_path / 'target.nrrd'
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((4, 5, 6), dtype=np.uint8)), str(target))
+
+    for stage in STAGES:
+        (root_reg_dir / stage).mkdir(parents=True)
+        (root_reg_dir / stage / f'elastix_params_{stage}.txt').write_text('(Metric "AdvancedMattesMutualInformation")\n'
+                                                                         '(WriteResultImage "true")\n')
+        for spec in SPECIMENS:
+            spec_dir = root_reg_dir / stage / spec
+            spec_dir.mkdir()
+            (spec_dir / f'{spec}.nrrd').write_text('')
+            (spec_dir / 'TransformParameters.0.txt').write_text(f'(Transform "EulerTransform")\n(Stage "{stage}")\n')
+            (spec_dir / common.INDV_REG_METADATA).write_text(f'fixed_vol: {target}\n')
+
+    calls = []
+
+    def elastix(fixed, tform_file, param, outdir, threads):
+        calls.append((tform_file, param))
+        assert f'(Stage "{outdir.parent.name}")' in open(tform_file).read()
+        (outdir / 'TransformParameters.0.txt').write_text('(InitialTransformParametersFileName "forward.txt")\n'
+                                                          '(ResultImagePixelType "float")\n')
+        return True
+
+    monkeypatch.setattr(invert_transforms, 'invert_elastix_transform_parameters', elastix)
+    monkeypatch.setattr(common, 'test_installation', lambda x: True)
+
+    cfg = Config(registration_stage_params=[{'stage_id': s} for s in STAGES], root_reg_dir=root_reg_dir,
+                 inverted_transforms=tmp_path / 'inverted_transforms', threads=2, registration_processes=0,
+                 registration_retries=0)
+    return cfg, calls
+
+
+def test_batch_invert(config):
+    cfg, calls = config
+    invert_transforms.batch_invert_transform_parameters(cfg)
+    inv_dir = cfg['inverted_transforms']
+
+    assert len(calls) == 4
+    # One inversion parameter file per stage
+    assert {param for _, param in calls} == {str(inv_dir / s / invert_transforms.INVERSION_PARAMS_FILE) for s in STAGES}
+    assert '(Metric "DisplacementMagnitudePenalty")' in (inv_dir / 'rigid' / 'inversion_parameters.txt').read_text()
+
+    label_tform = (inv_dir / 'deformable' / 'spec_a' / PROPAGATE_LABEL_TRANFORM).read_text()
+    assert '"NoInitialTransform"' in label_tform and '(ResultImagePixelType "unsigned char")' in label_tform
+    assert (inv_dir / 'deformable' / 'spec_a' / PROPAGATE_IMAGE_TRANSFORM).is_file()
+
+    assert common.cfg_load(inv_dir / PROPAGATE_CONFIG)['label_propagation_order'] == ['deformable', 'rigid']
+
+    timings = pd.read_csv(inv_dir / invert_transforms.INVERSION_TIMINGS_FILE, index_col=0)
+    assert list(timings.index) == sorted(f'{s}/{spec}' for s in STAGES for spec in SPECIMENS)
+    assert (timings.status == 'inverted').all()
+
+
+def test_up_to_date_skipped(config):
+    cfg, calls = config
+    invert_transforms.batch_invert_transform_parameters(cfg)
+
+    # Change one forward transform. Only that inversion is redone
+    calls.clear()
+    changed = cfg['root_reg_dir'] / 'deformable' / 'spec_b' / 'TransformParameters.0.txt'
+    changed.write_text(changed.read_text() + '(Changed "true")\n')
+    invert_transforms.batch_invert_transform_parameters(cfg)
+
+    assert [tform for tform, _ in calls] == [str(changed)]
+    timings = pd.read_csv(cfg['inverted_transforms'] / invert_transforms.INVERSION_TIMINGS_FILE, index_col=0)
+    assert timings.loc['deformable/spec_b', 'status'] == 'inverted'
+    assert (timings.drop('deformable/spec_b').status == 'up to date').all()
+
+    calls.clear()
+    invert_transforms.batch_invert_transform_parameters(cfg, clobber=True)
+    assert len(calls) == 4
+
+
+def test_concurrency(config, monkeypatch):
+    cfg, _ = config
+    monkeypatch.setattr(elastix_registration.os, 'cpu_count', lambda: 16)
+    monkeypatch.setattr(common, 'available_memory', lambda: 1e12)
+
+    sizes = []
+
+    def run_jobs(jobs, processes, retries):
+        sizes.append(processes)
+        return {}
+    monkeypatch.setattr(invert_transforms, 'run_jobs', run_jobs)
+
+    # 16 cores with the default 4 threads for each elastix: all 4 jobs at once
+    cfg['threads'] = 4
+    invert_transforms.batch_invert_transform_parameters(cfg)
+    assert sizes == [4]
+
+
+def test_failure_raises(config, monkeypatch):
+    cfg, _ = config
+    monkeypatch.setattr(invert_transforms, 'invert_elastix_transform_parameters', lambda *args: False)
+    with pytest.raises(RuntimeError, match='rigid/spec_a'):
+        invert_transforms.batch_invert_transform_parameters(cfg)
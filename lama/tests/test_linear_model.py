@@ -0,0 +1,118 @@
+"""
+Test the in-process linear model engine against statsmodels fits of the same models that lmFast.R uses.
+Unlike the other tests, these do not need the test data.
+
+Usage:  pytest test_linear_model.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.formula.api as smf
+
+from lama.stats.linear_model import lm_numpy
+
+
+def make_data(two_way=False, n_voxels=50, seed=0):
+    rng = np.random.default_rng(seed)
+
+    if two_way:
+        genotype = ['wildtype'] * 6 + ['mutant'] * 5 + ['wildtype'] * 5 + ['mutant'] * 4
+        treatment = ['vehicle'] * 11 + ['treatment'] * 9
+    else:
+        genotype = ['wildtype'] * 12 + ['mutant'] * 4
+        treatment = None
+
+    info = pd.DataFrame({'genotype': genotype, 'staging': rng.normal(100, 10, len(genotype))},
+                        index=[f'spec_{i}' for i in range(len(genotype))])
+    if treatment:
+        info['treatment'] = treatment
+
+    data = rng.normal(10, 2, (len(info), n_voxels)) + (info.genotype == 'mutant').values[:, None]
+    data[:, 0] = 0  # A column that cannot be fitted
+
+    return data, info
+
+
+def sm_fit(y, info, formula, terms):
+    df = info.copy()
+    df['y'] = np.abs(y)
+    fit = smf.ols(f'y ~ {formula}', data=df).fit()
+    return [fit.pvalues[x] for x in terms], [-fit.tvalues[x] for x in terms]
+
+
+def test_lm_numpy_one_way():
+    data, info = make_data()
+    p, t = lm_numpy(data, info)
+
+    n_vox = data.shape[1]
+    mutants = np.flatnonzero(info.genotype == 'mutant')
+    assert p.shape == t.shape == (n_vox * (len(mutants) + 1),)
+
+    wt_rows = list(np.flatnonzero(info.genotype == 'wildtype'))
+    row_sets = [list(range(len(info)))] + [wt_rows + [r] for r in mutants]
+
+    for i, rows in enumerate(row_sets):
+        for col in range(1, n_vox):
+            (sm_p,), (sm_t,) = sm_fit(data[rows, col], info.iloc[rows], 'genotype + staging',
+                                      ['genotype[T.wildtype]'])
+            assert p[i * n_vox + col] == pytest.approx(sm_p, rel=1e-4)
+            assert t[i * n_vox + col] == pytest.approx(sm_t, rel=1e-4)
+
+    # The all-zero column cannot be fitted
+    assert np.isnan(p[0])
+
+
+def test_lm_numpy_two_way():
+    data, info = make_data(two_way=True)
+    p, t = lm_numpy(data, info, two_way=True)
+
+    n_vox = data.shape[1]
+    interaction = (info.genotype == 'mutant') & (info.treatment == 'treatment')
+    assert p.shape == t.shape == (3, n_vox * (interaction.sum() + 1))
+
+    terms = ['genotype[T.wildtype]', 'treatment[T.vehicle]', 'genotype[T.wildtype]:treatment[T.vehicle]']
+    other_rows = list(np.flatnonzero(~interaction))
+    row_sets = [list(range(len(info)))] + [other_rows + [r] for r in np.flatnonzero(interaction)]
+
+    for i, rows in enumerate(row_sets):
+        for col in range(1, n_vox):
+            sm_p, sm_t = sm_fit(data[rows, col], info.iloc[rows], 'genotype * treatment + staging', terms)
+            assert p[:, i * n_vox + col] == pytest.approx(sm_p, rel=1e-4)
+            assert t[:, i * n_vox + col] == pytest.approx(sm_t, rel=1e-4)
+
+
+def test_lm_numpy_no_staging():
+    data, info = make_data()
+    p, t = lm_numpy(data, info, use_staging=False)
+
+    (sm_p,), (sm_t,) = sm_fit(data[:, 1], info, 'genotype', ['genotype[T.wildtype]'])
+    assert p[1] == pytest.approx(sm_p, rel=1e-4)
+    assert t[1] == pytest.approx(sm_t, rel=1e-4)
+
+
+def test_specimen_update_matches_refit():
+    """
+    The rank-one update used for the specimen-level models should give the same results as refitting, both when the
+    baseline design is of full rank and when it is not
+    """
+    from lama.stats.linear_model import _factorise_design, _specimen_updates, _ols, _ols_add_row
+
+    rng = np.random.default_rng(1)
+    n = 15
+    x = np.column_stack((np.ones(n), rng.normal(size=n), (np.arange(n) >= n - 2).astype(float)))
+    y = rng.normal(size=(n, 20))
+    terms = [1, 2]
+
+    # Full rank baseline (last 2 rows are the specimens, one of which is in the baseline) and rank-deficient baseline
+    for baseline_rows, spec_row in [(tuple(range(n - 1)), n - 1), (tuple(range(n - 2)), n - 1)]:
+        pinv, (update,) = _specimen_updates(x.tobytes(), x.shape, baseline_rows, (spec_row,))
+        coefs = pinv @ y[list(baseline_rows)]
+        resid = y[list(baseline_rows)] - x[list(baseline_rows)] @ coefs
+        p, t = _ols_add_row(update, coefs, (resid ** 2).sum(axis=0), x[spec_row], y[spec_row], terms)
+
+        rows = baseline_rows + (spec_row,)
+        p_refit, t_refit = _ols(_factorise_design(x.tobytes(), x.shape, rows), y[list(rows)], terms)
+
+        assert np.allclose(t, t_refit)
+        assert np.allclose(p, p_refit)
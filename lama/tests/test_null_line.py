@@ -0,0 +1,79 @@
+"""
+Check distributions.null_line, which fits the permutations in tiles of labels and permutations, against a statsmodels
+OLS fit of each permutation. Both the single-process and the shared-memory worker paths are run.
+"""
+
+import numpy as np
+import pytest
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from lama.stats.permutation_stats.distributions import null_line, TILE_LABELS
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_null_line(num_workers):
+    rng = np.random.default_rng(0)
+    num_wt, num_labels = 40, 6
+
+    data = pd.DataFrame(rng.normal(10, 2, (num_wt, num_labels)),
+                        columns=[f'x{i}' for i in range(num_labels)],
+                        index=[f'wt{i}' for i in range(num_wt)])
+    data['staging'] = rng.normal(100, 10, num_wt)
+    data['line'] = 'baseline'
+
+    # QC'd labels give some labels different specimens
+    data.iloc[[3, 7], 2] = np.nan
+    data.iloc[5, 4] = np.nan
+
+    combinations = {}
+    for label in data.columns[:num_labels]:
+        ids = data.index[data[label].notna()]
+        combinations[label] = [tuple(rng.choice(ids, n, replace=False)) for n in [3, 5] * 10]
+
+    result = null_line(combinations, data, 20, num_workers=num_workers)
+
+    assert list(result.columns) == list(data.columns[:num_labels])
+    timings = result.attrs['tile_timings']
+    assert (timings.num_perms * timings.num_labels).sum() == 20 * num_labels
+
+    for label, combs in combinations.items():
+        label_data = data[[label, 'staging']].copy()
+
+        for i, comb in enumerate(combs):
+            label_data['genotype'] = 'wt'
+            label_data.loc[label_data.index.isin(comb), 'genotype'] = 'synth_hom'
+            fit = smf.ols(f'{label} ~ C(genotype) + staging', data=label_data, missing='drop').fit()
+
+            assert np.isclose(result[label][i], fit.pvalues['C(genotype)[T.wt]'], rtol=1e-8)
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_null_line_label_tiles(num_workers):
+    # More labels than TILE_LABELS with the same QC'd baselines, so one group is split into several label tiles that
+    # share its combinations
+    rng = np.random.default_rng(1)
+    num_wt, num_labels, num_perms = 30, TILE_LABELS + 4, 10
+
+    data = pd.DataFrame(rng.normal(10, 2, (num_wt, num_labels)),
+                        columns=[f'x{i}' for i in range(num_labels)],
+                        index=[f'wt{i}' for i in range(num_wt)])
+    data['staging'] = rng.normal(100, 10, num_wt)
+    data['line'] = 'baseline'
+    data.iloc[[2, 9], :num_labels] = np.nan
+
+    ids = data.index[data['x0'].notna()]
+    combs = [tuple(rng.choice(ids, 4, replace=False)) for _ in range(num_perms)]
+    combinations = {label: combs for label in data.columns[:num_labels]}
+
+    result = null_line(combinations, data, num_perms, num_workers=num_workers)
+
+    for label in data.columns[:num_labels]:
+        label_data = data[[label, 'staging']].copy()
+
+        for i, comb in enumerate(combs):
+            label_data['genotype'] = 'wt'
+            label_data.loc[label_data.index.isin(comb), 'genotype'] = 'synth_hom'
+            fit = smf.ols(f'{label} ~ C(genotype) + staging', data=label_data, missing='drop').fit()
+
+            assert np.isclose(result[label][i], fit.pvalues['C(genotype)[T.wt]'], rtol=1e-8)
@@ -0,0 +1,54 @@
+"""
+The vectorised permutation p-value thresholds should match those found by trying every candidate threshold with
+fdr_calc.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lama.stats.permutation_stats.p_thresholds import get_thresholds, fdr_calc
+
+
+def thresholds_loop(null: pd.DataFrame, alt: pd.DataFrame, target: float = 0.05) -> dict:
+    """
+    {label: (p threshold, fdr)} choosing from all the null and alternative p-values <= 0.05
+    """
+    result = {}
+    for label in null:
+        candidates = np.unique(np.concatenate([null[label], alt[label]]))
+        fdrs = [(p, fdr_calc(null[label].to_numpy(), alt[label].to_numpy(), p)) for p in candidates if p <= 0.05]
+        fdrs = [(p, f) for p, f in fdrs if f is not None]
+
+        if not fdrs:
+            result[int(label)] = (np.nan, 1)
+        elif any(f <= target for _, f in fdrs):
+            result[int(label)] = max((p, f) for p, f in fdrs if f <= target)
+        else:
+            result[int(label)] = min(fdrs, key=lambda x: (x[1], x[0]))
+    return result
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_get_thresholds(seed):
+    rng = np.random.default_rng(seed)
+    labels = [str(i) for i in range(1, 21)]
+
+    # Rounded so there are tied p-values
+    null = pd.DataFrame(np.round(rng.random((500, 20)), 3), columns=labels)
+    alt = pd.DataFrame(np.round(rng.random((30, 20)) ** rng.uniform(1, 10, 20), 3), columns=labels)
+    alt.iloc[:, 0] = 0.5  # No candidate thresholds
+    alt['line'] = 'a'
+
+    result = get_thresholds(null, alt)
+    expected = thresholds_loop(null, alt)
+
+    assert list(result.index) == list(range(1, 21))
+    for label, (p, fdr) in expected.items():
+        row = result.loc[label]
+        assert np.array_equal(row.p_thresh, p, equal_nan=True)
+        assert row.fdr == fdr
+
+        if not np.isnan(p):
+            assert row.num_alt_lt_thresh == np.count_nonzero(alt[str(label)] <= p)
+            assert row.num_null_lt_thresh == np.count_nonzero(null[str(label)] <= p)
@@ -0,0 +1,174 @@
+"""
+How elastix registrations are run: the process and thread sizing, the retries of run_jobs, the pipelining of stages,
+and the retransform after folding correction. elastix and transformix are replaced with functions that write
+images.
+"""
+
+from pathlib import Path
+from types import SimpleNamespace
+import subprocess
+
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+from lama import common
+from lama.elastix import elastix_registration
+from lama.elastix.elastix_registration import TargetBasedRegistration, registration_concurrency, run_jobs
+
+
+def test_registration_concurrency(monkeypatch):
+    monkeypatch.setattr(common, 'available_memory', lambda: 100)
+    monkeypatch.setattr(elastix_registration.os, 'cpu_count', lambda: 64)
+
+    # The cores are shared between processes of up to 'threads' threads, limited by the number of jobs
+    assert registration_concurrency(20) == (8, 8)
+    assert registration_concurrency(20, threads=4) == (16, 4)
+    assert registration_concurrency(2, threads=4) == (2, 4)
+    assert registration_concurrency(20, threads=128) == (1, 64)
+    assert registration_concurrency(20, threads=4, max_processes=3) == (3, 4)
+
+    # Memory for 0.8 * 100 / 30 = 2 processes
+    assert registration_concurrency(20, threads=4, memory_per_job=30) == (2, 4)
+    # Always at least one
+    assert registration_concurrency(20, threads=4, memory_per_job=1000) == (1, 4)
+
+    monkeypatch.setattr(elastix_registration.os, 'cpu_count', lambda: 2)
+    assert registration_concurrency(20, threads=4) == (1, 2)
+
+
+def test_run_jobs_retries_and_isolates_failures():
+    calls = {'flaky': 0, 'bad': 0, 'good': 0}
+
+    def job(name, fails):
+        def run():
+            calls[name] += 1
+            if calls[name] <= fails:
+                raise RuntimeError(name)
+        return run
+
+    failed = run_jobs({'flaky': job('flaky', 1), 'bad': job('bad', 10), 'good': job('good', 0)}, processes=2,
+                      retries=2)
+
+    assert list(failed) == ['bad']
+    assert calls == {'flaky': 2, 'bad': 3, 'good': 1}
+
+    # A negative number of retries still runs each job once
+    calls = {'flaky': 0, 'bad': 0, 'good': 0}
+    failed = run_jobs({'flaky': job('flaky', 1), 'good': job('good', 0)}, processes=1, retries=-1)
+    assert list(failed) == ['flaky']
+    assert calls['good'] == 1
+
+
+def _fake_elastix(fail_once: set, filetype='nrrd'):
+    def run_elastix(args):
+        outdir = Path(args['outdir'])
+        name = outdir.name
+        if name in fail_once:
+            fail_once.remove(name)
+            (outdir / 'partial_output').touch()
+            raise RuntimeError('elastix failed')
+        img = sitk.ReadImage(args['mov'])
+        sitk.WriteImage(img, str(outdir / f'result.0.{filetype}'))
+        (outdir / 'TransformParameters.0.txt').touch()
+    return run_elastix
+
+
+def test_target_based_registration(tmp_path, monkeypatch):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    for i in range(4):
+        sitk.WriteImage(sitk.GetImageFromArray(np.full((4, 5, 6), i, dtype=np.uint8)), str(inputs / f'spec{i}.nrrd'))
+    fixed = inputs / 'spec0.nrrd'
+
+    monkeypatch.setattr(elastix_registration, 'run_elastix', _fake_elastix({'spec2'}))
+
+    stage_dir = tmp_path / 'rigid'
+    reg = TargetBasedRegistration(tmp_path / 'elastix_params.txt', inputs, stage_dir, 'nrrd', 4, None)
+    reg.set_target(fixed)
+    reg.max_processes = 2
+    reg.run()
+
+    for i in range(4):
+        outdir = stage_dir / f'spec{i}'
+        assert sorted(p.name for p in outdir.iterdir()) == \
+            ['TransformParameters.0.txt', common.INDV_REG_METADATA, f'spec{i}.nrrd']
+        assert sitk.GetArrayFromImage(sitk.ReadImage(str(outdir / f'spec{i}.nrrd')))[0, 0, 0] == i
+
+    # A registration that keeps failing is reported after the others have been done
+    monkeypatch.setattr(elastix_registration, 'run_elastix', _fake_elastix({'spec1'}))
+    common.mkdir_force(stage_dir)
+    reg.retries = 0
+    with pytest.raises(RuntimeError, match='spec1'):
+        reg.run()
+    assert (stage_dir / 'spec3' / 'spec3.nrrd').is_file()
+
+
+def test_pipelined_stages(tmp_path, monkeypatch):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    for i in range(3):
+        sitk.WriteImage(sitk.GetImageFromArray(np.full((4, 5, 6), i, dtype=np.uint8)), str(inputs / f'spec{i}.nrrd'))
+    fixed = inputs / 'spec0.nrrd'
+
+    registered = []
+    fake_elastix = _fake_elastix(set())
+
+    def run_elastix(args):
+        registered.append((Path(args['mov']).relative_to(tmp_path).parts[0], Path(args['outdir']).name))
+        fake_elastix(args)
+
+    monkeypatch.setattr(elastix_registration, 'run_elastix', run_elastix)
+    monkeypatch.setattr(common, 'available_memory', lambda: 1e12)
+
+    stages = []
+    movdir = inputs
+    for stage_id in ['rigid', 'affine']:
+        reg = TargetBasedRegistration(tmp_path / 'elastix_params.txt', movdir, tmp_path / stage_id, 'nrrd', 8, None)
+        reg.set_target(fixed)
+        stages.append(reg)
+        movdir = reg.stagedir
+
+    elastix_registration.run_pipelined(stages, max_processes=1)
+
+    # With one process, each specimen goes through both stages before the next starts
+    assert registered == [('inputs', 'spec0'), ('rigid', 'spec0'),
+                          ('inputs', 'spec1'), ('rigid', 'spec1'),
+                          ('inputs', 'spec2'), ('rigid', 'spec2')]
+    for i in range(3):
+        assert (tmp_path / 'affine' / f'spec{i}' / f'spec{i}.nrrd').is_file()
+
+
+@pytest.mark.parametrize('transformix_works', [True, False])
+def test_fix_folding_replaces_image(tmp_path, monkeypatch, transformix_works):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    sitk.WriteImage(sitk.GetImageFromArray(np.full((4, 5, 6), 1, dtype=np.uint8)), str(inputs / 'spec.nii'))
+
+    def unfold(bs, outfile, iterative):
+        bs.num_corrected = 3
+
+    def transformix(cmd):
+        if not transformix_works:
+            raise subprocess.CalledProcessError(1, cmd)
+        out = Path(cmd[cmd.index('-out') + 1])
+        sitk.WriteImage(sitk.GetImageFromArray(np.full((4, 5, 6), 7, dtype=np.uint8)), str(out / 'result.nii'))
+
+    monkeypatch.setattr(elastix_registration, 'run_elastix', _fake_elastix(set(), 'nii'))
+    monkeypatch.setattr(elastix_registration, 'BSplineParse', lambda path: SimpleNamespace())
+    monkeypatch.setattr(elastix_registration, 'unfold_bsplines', unfold)
+    monkeypatch.setattr(elastix_registration.subprocess, 'check_output', transformix)
+
+    reg = TargetBasedRegistration(tmp_path / 'elastix_params.txt', inputs, tmp_path / 'deformable', 'nii', 4, None)
+    reg.set_target(inputs / 'spec.nii')
+    reg.fix_folding = True
+    registered = tmp_path / 'deformable' / 'spec' / 'spec.nii'
+
+    if transformix_works:
+        reg.register_specimen(inputs / 'spec.nii')
+        assert sitk.GetArrayFromImage(sitk.ReadImage(str(registered)))[0, 0, 0] == 7
+        assert not (registered.parent / 'result.nii').exists()
+    else:
+        with pytest.raises(subprocess.CalledProcessError):
+            reg.register_specimen(inputs / 'spec.nii')
+        assert sitk.GetArrayFromImage(sitk.ReadImage(str(registered)))[0, 0, 0] == 1  # Not removed
@@ -0,0 +1,92 @@
+"""
+TransformParameters should write back the files it reads byte for byte, change only the lines it replaces, and drop
+cached files once they change on disk.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from lama.elastix.transform_parameters import TransformParameters, read_transform_parameters, format_value
+
+TFORM = '''(Transform "BSplineTransform")
+(NumberOfParameters 6)
+(TransformParameters 0.100000 -0.200000 0.300000 1.000000 2.000000 -3.500000)
+(InitialTransformParametersFileName "NoInitialTransform")
+(FixedImageDimension 3)
+(Size 7 6 9)
+(GridSpacing 4.000000 4.000000 4.500000)
+
+// ResampleInterpolator specific
+(FinalBSplineInterpolationOrder 3)
+(ResultImagePixelType "float")
+'''
+
+
+@pytest.fixture
+def tform(tmp_path):
+    path = tmp_path / 'TransformParameters.0.txt'
+    path.write_text(TFORM)
+    return path
+
+
+def test_values(tform):
+    tp = read_transform_parameters(tform)
+
+    assert tp.transform == 'BSplineTransform'
+    assert tp['NumberOfParameters'] == 6
+    assert tp.get_list('Size') == [7, 6, 9]
+    assert tp.get('GridSpacing') == [4.0, 4.0, 4.5]
+    assert tp.get('Missing', 'default') == 'default'
+    assert 'ResultImagePixelType' in tp and 'ResampleInterpolator' not in tp
+    np.testing.assert_array_equal(tp.parameters, [0.1, -0.2, 0.3, 1, 2, -3.5])
+    np.testing.assert_array_equal(tp.coefficients(), [[0.1, 0.3, 2], [-0.2, 1, -3.5]])  # x, y and z of 2 points
+    with pytest.raises(ValueError):
+        tp.parameters[0] = 1  # Shared by the cache
+
+
+def test_round_trip(tform, tmp_path):
+    out = tmp_path / 'out.txt'
+    read_transform_parameters(tform).write(out)
+    assert out.read_text() == TFORM
+
+
+def test_replace(tform, tmp_path):
+    tp = read_transform_parameters(tform)
+    new = tp.replace({'InitialTransformParametersFileName': '/a/b.txt', 'FinalBSplineInterpolationOrder': 1,
+                      'WriteResultImage': False, 'Size': [3, 4, 5]})
+    assert tp.get('FinalBSplineInterpolationOrder') == 3  # Unchanged
+    assert 'WriteResultImage' not in new
+
+    new = tp.replace({'WriteResultImage': 'false', 'Size': '3 4 5'}, add_missing=True, raw=True)
+    out = tmp_path / 'out.txt'
+    new.write(out)
+    text = out.read_text()
+    assert '(Size 3 4 5)\n' in text and text.endswith('(WriteResultImage false)\n')
+
+    assert format_value('8') == '8'
+    assert format_value('Compose') == '"Compose"'
+    assert format_value(False) == '"false"'
+    assert format_value([1, 2.5]) == '1 2.5'
+
+
+def test_with_parameters(tform, tmp_path):
+    tp = read_transform_parameters(tform)
+    coefs = tp.coefficients() * 2
+    out = tmp_path / 'out.txt'
+    tp.with_parameters(coefs).write(out)
+
+    np.testing.assert_allclose(TransformParameters.read(out).parameters, tp.parameters * 2)
+    with pytest.raises(ValueError):
+        tp.with_parameters(np.zeros(5))
+
+
+def test_cache(tform):
+    tp = read_transform_parameters(tform)
+    assert read_transform_parameters(tform) is tp
+
+    tp.replace({'Size': [1, 1, 1]}).write(tform)
+    stat = tform.stat()
+    os.utime(tform, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))  # Make sure the change is seen
+    assert read_transform_parameters(tform).get_list('Size') == [1, 1, 1]